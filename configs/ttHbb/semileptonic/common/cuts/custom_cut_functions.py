@@ -1,5 +1,6 @@
 from collections.abc import Iterable
 import awkward as ak
+from configs.ttHbb.semileptonic.common.workflows.ttbar_id import TTBAR_IDS, ttbar_id_mask
 
 def semileptonic(events, params, year, sample, **kwargs):
 
@@ -50,23 +51,17 @@ def eq_genTtbarId_100(events, params, year, sample, **kwargs):
     54 : "tt+b2b",
     55 : "tt+2b2b",
     56 : "tt+B",
+
+    The values of genTtbarId % 100 are computed by the processor after the preselection and read from the events
+    (see `get_ttbar_id`): the mask is a single lookup of the selected IDs.
     """
-    allowed_ids = [0, 41, 42, 43, 44, 45, 46, 51, 52, 53, 54, 55, 56]
     if type(params["genTtbarId"]) == int:
-        if params["genTtbarId"] in allowed_ids:
-            return events.genTtbarId % 100 == params["genTtbarId"]
-        else:
-            raise Exception(f"The cut on genTtbarId % 100 must be an integer between 0 and 56.\nPossible choices:{allowed_ids}")
+        ids = [params["genTtbarId"]]
     elif isinstance(params["genTtbarId"], Iterable):
-        mask = ak.zeros_like(events.event, dtype=bool)
-        for _id in params["genTtbarId"]:
-            if _id in allowed_ids:
-                mask = mask | (events.genTtbarId % 100 == _id)
-            else:
-                raise Exception(f"The cut on genTtbarId % 100 must be an integer between 0 and 56.\nPossible choices:{allowed_ids}")
-        return mask
+        ids = list(params["genTtbarId"])
     else:
-        raise Exception(f'params["genTtbarId"] must be an integer or an iterable of integers between 0 and 56.\nPossible choices:{allowed_ids}')
+        raise Exception(f'params["genTtbarId"] must be an integer or an iterable of integers between 0 and 56.\nPossible choices:{TTBAR_IDS}')
+    return ak.Array(ttbar_id_mask(events, ids))
 
 def spanet_sr(events, params, year, sample, **kwargs):
 
@@ -0,0 +1,169 @@
+'''
+Memoisation of the cut masks shared by the categories and the subsamples.
+
+The same cut (e.g. `get_ttlf_max(ttlf_wp)` or `get_nObj_eq(4, coll="JetGood")`) is used by many categories
+and subsamples: the StandardSelection of pocket_coffea evaluates each cut once per selection, but every
+selection of the chunk (the categories and the subsamples of each sample) evaluates it again, and two
+Cut objects with the same function and parameters but different names are evaluated separately.
+The masks are cached here by (function, parameters, collection) for the events of the current chunk and
+variation: each distinct cut is evaluated once, whatever selection and name it is used with.
+'''
+import json
+import threading
+import weakref
+import numpy as np
+import awkward as ak
+from pocket_coffea.lib.categorization import StandardSelection, MaskStorage
+
+
+class CutMaskCache(threading.local):
+    '''Cache of the masks of the cuts evaluated on the events of the current chunk and variation.
+    The cache is emptied as soon as a cut is requested on different events (new chunk or new variation):
+    only a weak reference to the events is kept. The cache is local to each thread, so that the threads
+    of a worker processing different chunks do not share masks.
+
+    `report()` gives the number of cut evaluations done and saved on the current events.'''
+
+    def __init__(self):
+        self._events = None
+        self.masks = {}
+        self.evaluated = 0
+        self.reused = 0
+
+    @staticmethod
+    def get_key(cut, **kwargs):
+        '''Key of the mask of `cut`: the cuts with the same function, parameters and collection give the same mask.
+        The arguments passed by the processor to the cut functions (year, sample, isMC) are part of the key.'''
+        return (
+            cut.function,
+            json.dumps(cut.params, sort_keys=True, default=str),
+            cut.collection,
+            tuple(sorted(kwargs.items())),
+        )
+
+    def is_current(self, events):
+        return (self._events is not None) and (self._events() is events)
+
+    def reset(self, events=None):
+        self._events = weakref.ref(events) if events is not None else None
+        self.masks = {}
+        self.evaluated = 0
+        self.reused = 0
+
+    def get_mask(self, cut, events, processor_params, **kwargs):
+        '''Get the mask of `cut` on the events, evaluating the cut only if it has not been evaluated yet on these events.'''
+        if not self.is_current(events):
+            self.reset(events)
+        key = self.get_key(cut, **kwargs)
+        if key in self.masks:
+            self.reused += 1
+        else:
+            self.masks[key] = cut.get_mask(events, processor_params, **kwargs)
+            self.evaluated += 1
+        return self.masks[key]
+
+    def add_reused(self, n):
+        '''Count `n` uses of the masks of the cache not requested through `get_mask` (e.g. the cuts shared by the categories of a selection).'''
+        self.reused += n
+
+    def report(self, events=None):
+        '''Number of cut evaluations done (`evaluated`) and saved (`reused`) on the current events: `reused` counts
+        all the uses of the cuts by the categories of the selections beyond the first evaluation of each distinct cut.
+        If `events` is given and the cache has not been used on them, all the counts are zero.'''
+        if (events is not None) and not self.is_current(events):
+            return {"evaluated": 0, "reused": 0}
+        return {"evaluated": self.evaluated, "reused": self.reused}
+
+    def __repr__(self):
+        return f"CutMaskCache(masks={len(self.masks)}, evaluated={self.evaluated}, reused={self.reused})"
+
+
+_cut_cache = CutMaskCache()
+
+def get_cut_cache():
+    '''Get the cut mask cache of the current thread.'''
+    return _cut_cache
+
+
+def fill_cut_evaluations(output, events, dataset, variation):
+    '''Add the number of cut evaluations done and saved on the events of the chunk to the output of the processor,
+    under `cut_evaluations` by dataset and variation: the counts are summed over the chunks.'''
+    report = get_cut_cache().report(events)
+    if report["evaluated"] + report["reused"] == 0:
+        return
+    output.setdefault("cut_evaluations", {}).setdefault(dataset, {})[variation] = report
+
+
+class MemoizedSelection(StandardSelection):
+    '''StandardSelection taking the masks of the cuts from the cut mask cache, so that the cuts shared with the
+    other selections of the chunk are evaluated once (see `CutMaskCache`).
+
+    The masks of the cuts are stored as packed bitsets (8 events per byte) and the mask of each category
+    is the bitwise AND of the bitsets of its cuts. The cuts of each category are ordered by the number of categories
+    using them and the AND of each prefix of the ordered cuts is cached: the combinations of cuts shared by several
+    categories (e.g. the ttlf cut and the SPANet region of `CR` and of `4jCR`) are computed once.
+    The selections with cuts on a collection (dim=2 masks) use the MaskStorage of the StandardSelection.
+    '''
+
+    def __init__(self, categories):
+        super().__init__(categories)
+        # Number of categories using each cut
+        usage = {}
+        for cuts in self.categories.values():
+            for cut_id in cuts:
+                usage[cut_id] = usage.get(cut_id, 0) + 1
+        self.nshared = sum(usage.values()) - len(usage)
+        self.ordered_categories = {
+            category: tuple(sorted(cuts, key=lambda cut_id: (-usage[cut_id], cut_id)))
+            for category, cuts in self.categories.items()
+        }
+        self.bitsets = {}
+        self.cache = {}
+        self.nevents = None
+
+    def prepare(self, events, processor_params, **kwargs):
+        cut_cache = get_cut_cache()
+        self.cache.clear()
+        self.bitsets.clear()
+        if self.is_multidim:
+            if f"n{self.multidim_collection}" in events.fields:
+                counts = events[f"n{self.multidim_collection}"]
+            else:
+                counts = ak.num(events[self.multidim_collection])
+            self.storage = MaskStorage(dim=2, counts=counts)
+            for cut in self.cut_functions:
+                self.storage.add(cut.id, cut_cache.get_mask(cut, events, processor_params, **kwargs))
+        else:
+            self.nevents = len(events)
+            for cut in self.cut_functions:
+                mask = cut_cache.get_mask(cut, events, processor_params, **kwargs)
+                self.bitsets[(cut.id,)] = np.packbits(np.asarray(ak.to_numpy(mask), dtype=bool))
+        cut_cache.add_reused(self.nshared)
+        self.ready = True
+
+    def get_bitset(self, cut_ids):
+        '''Bitset of the AND of the cuts `cut_ids`, built from the cached bitset of the AND of all the cuts but the last one.'''
+        if cut_ids not in self.bitsets:
+            self.bitsets[cut_ids] = np.bitwise_and(self.get_bitset(cut_ids[:-1]), self.bitsets[cut_ids[-1:]])
+        return self.bitsets[cut_ids]
+
+    def get_mask(self, category):
+        if not self.ready:
+            raise Exception(
+                "Before using the selection, call the prepare method to fill the masks"
+            )
+        if self.is_multidim:
+            return super().get_mask(category)
+        if category not in self.cache:
+            cut_ids = self.ordered_categories[category]
+            if len(cut_ids) == 0:
+                self.cache[category] = np.ones(self.nevents, dtype=bool)
+            else:
+                self.cache[category] = np.unpackbits(self.get_bitset(cut_ids), count=self.nevents).view(bool)
+        return self.cache[category]
+
+    def __str__(self):
+        return f"MemoizedSelection {[m for m in self.categories]}, ({len(self.categories)} categories)"
+
+    def __repr__(self):
+        return self.__str__()
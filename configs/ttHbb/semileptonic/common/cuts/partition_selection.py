@@ -0,0 +1,245 @@
+'''
+Categorization of the events by partitions of mutually exclusive axes (e.g. jet multiplicity bin,
+DCTR bin, SPANet region, lepton flavour).
+
+Each axis assigns to each event the index of its bin, computed with a single `digitize` or lookup
+of one column of the events. The index of the partition of the event is then built from the indices
+of all the axes, once per chunk and variation. The categories are unions of partitions, selected by the
+labels of the bins of some of the axes: the mask of each category is a single lookup of the partition index
+in a boolean table, instead of the AND of the masks of several cuts evaluated over the whole chunk.
+The histograms of the categories are filled from the events grouped by partition index (see `PartitionHistManager`).
+'''
+from abc import ABC, abstractmethod
+from itertools import product
+import numpy as np
+import awkward as ak
+from pocket_coffea.lib.categorization import StandardSelection, CartesianSelection
+
+
+def _get_column(events, field):
+    '''Get the column `field` of the events as a numpy array: `field` is the name of the column
+    (e.g. `nJetGood` or `spanet_output.tthbb_transformed`) or a function(events) returning the column.'''
+    if callable(field):
+        values = field(events)
+    else:
+        values = events[tuple(field.split("."))] if "." in field else events[field]
+    if isinstance(values, ak.Array):
+        if values.ndim > 1:
+            raise ValueError(f"The column {field} of a partition axis should have one value per event.")
+        if values.layout.is_option:
+            # The missing values are outside all the bins
+            values = ak.fill_none(ak.values_astype(values, np.float64), np.nan)
+        values = ak.to_numpy(values)
+    return np.asarray(values)
+
+
+class RegionIndexColumn:
+    '''Column of the region index (see `BinnedRegionIndex`) of the values of two columns of the events,
+    to be used as the field of a partition axis (e.g. the DCTR region from `nJetGood` and `dctr_output.weight`).'''
+    def __init__(self, region_index, x, y):
+        self.region_index = region_index
+        self.x = x
+        self.y = y
+
+    @property
+    def __name__(self):
+        return f"region_index({self.x}, {self.y})"
+
+    def __call__(self, events):
+        return self.region_index(_get_column(events, self.x), _get_column(events, self.y))
+
+
+def get_lepton_flavour(events):
+    '''Flavour of the lepton of the events with exactly one good lepton: 0 for electrons, 1 for muons, -1 otherwise.'''
+    n_electrons = ak.to_numpy(events.nElectronGood)
+    n_muons = ak.to_numpy(events.nMuonGood)
+    return np.where((n_electrons == 1) & (n_muons == 0), 0, np.where((n_muons == 1) & (n_electrons == 0), 1, -1))
+
+
+class PartitionAxis(ABC):
+    '''Axis of mutually exclusive bins of the events. The events outside all the bins
+    (or with a missing value) are assigned to an additional bin with index `nbins`.
+
+    :param name: name of the axis
+    :param field: column of the events (name or function(events), see `_get_column`)
+    :param labels: labels of the bins
+    '''
+    def __init__(self, name, field, labels):
+        self.name = name
+        self.field = field
+        self.labels = list(labels)
+        if len(set(self.labels)) != len(self.labels):
+            raise ValueError(f"The labels of the partition axis {name} should be unique: {self.labels}")
+
+    @property
+    def nbins(self):
+        return len(self.labels)
+
+    def get_bin(self, label):
+        if label not in self.labels:
+            raise ValueError(f"Bin `{label}` not found in the partition axis {self.name}: {self.labels}")
+        return self.labels.index(label)
+
+    @abstractmethod
+    def get_index(self, events):
+        '''Index of the bin of each event, `nbins` for the events outside all the bins.'''
+
+    def serialize(self):
+        return {"name": self.name, "field": getattr(self.field, "__name__", self.field), "labels": self.labels}
+
+
+class BinnedAxis(PartitionAxis):
+    '''Axis of the bins of a variable: the bins include the lower edge and exclude the upper edge.
+    If the last edge is inf, the last bin includes inf.
+
+    :param edges: edges of the bins, strictly increasing
+    '''
+    def __init__(self, name, field, edges, labels):
+        super().__init__(name, field, labels)
+        self.edges = np.asarray(edges, dtype=np.float64)
+        if len(self.edges) != self.nbins + 1:
+            raise ValueError(f"{len(self.edges)} edges for the {self.nbins} bins of the partition axis {name}.")
+        if np.any(np.diff(self.edges) <= 0):
+            raise ValueError(f"The bin edges should be strictly increasing: {self.edges}")
+
+    def get_index(self, events):
+        values = _get_column(events, self.field).astype(np.float64)
+        # 0 below the first edge, len(edges) above the last edge or for NaN
+        index = np.digitize(values, self.edges) - 1
+        if np.isposinf(self.edges[-1]):
+            index[values == np.inf] = self.nbins - 1
+        index[index < 0] = self.nbins
+        return index
+
+    def serialize(self):
+        return {**super().serialize(), "edges": self.edges.tolist()}
+
+
+class CategoricalAxis(PartitionAxis):
+    '''Axis of the values of an integer variable (e.g. a class or a region index).
+
+    :param labels: dictionary {value: label} of the bins
+    '''
+    def __init__(self, name, field, labels):
+        super().__init__(name, field, labels.values())
+        self.values = np.asarray(list(labels.keys()), dtype=np.int64)
+        self.order = np.argsort(self.values)
+        self.sorted_values = self.values[self.order]
+
+    def get_index(self, events):
+        values = _get_column(events, self.field)
+        valid = np.isfinite(values) if values.dtype.kind == "f" else np.ones(len(values), dtype=bool)
+        values = np.where(valid, values, 0).astype(np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_values, values), self.nbins - 1)
+        found = valid & (self.sorted_values[pos] == values)
+        return np.where(found, self.order[pos], self.nbins)
+
+    def serialize(self):
+        return {**super().serialize(), "values": self.values.tolist()}
+
+
+class PartitionSelection(CartesianSelection):
+    '''Categorization of the events by the partitions of a list of mutually exclusive axes.
+
+    Each category is defined by a dictionary {axis name: label or list of labels} selecting bins of some of the axes:
+    the category includes the events in the selected bins of these axes, for any value of the other axes
+    (also outside all their bins). By default the categories are the cartesian product of the bins of all the axes,
+    named by the labels joined by `separator`.
+    The partition index of the events is computed once in `prepare()`, and the mask of each category
+    is a lookup of the index in the boolean table of its partitions.
+    Common categories defined by cuts (StandardSelection or dictionary of cuts) can be added with `common_cats`.
+
+    :param axes: list of PartitionAxis objects
+    :param categories: dictionary {category name: {axis name: label or list of labels}}
+    :param common_cats: categories defined by cuts, outside of the partitions
+    :param separator: separator of the labels in the names of the default categories
+    '''
+    def __init__(self, axes, categories=None, common_cats=None, separator="_"):
+        self.axes = list(axes)
+        self.axes_dict = {axis.name: axis for axis in self.axes}
+        if len(self.axes_dict) != len(self.axes):
+            raise ValueError(f"The names of the partition axes should be unique: {[axis.name for axis in self.axes]}")
+        # Each axis has one more bin for the events outside all the bins
+        self.shape = tuple(axis.nbins + 1 for axis in self.axes)
+        if categories is None:
+            categories = {
+                separator.join(labels): dict(zip(self.axes_dict.keys(), labels))
+                for labels in product(*[axis.labels for axis in self.axes])
+            }
+        self.partition_categories = {name: dict(selection) for name, selection in categories.items()}
+        self.tables = {name: self.build_table(selection) for name, selection in self.partition_categories.items()}
+
+        # The common categories are set up by the CartesianSelection, without multicuts:
+        # its categories are replaced by the ones of the partitions
+        super().__init__([], common_cats)
+        overlap = set(self.common_cats.keys()) & set(self.partition_categories.keys())
+        if len(overlap) > 0:
+            raise ValueError(f"Categories defined both by cuts and by partitions: {overlap}")
+        self.categories = list(self.common_cats.keys()) + list(self.partition_categories.keys())
+        self.cat_multi_index = list(self.categories)
+        self.categories_dict = dict(zip(self.categories, self.cat_multi_index))
+        self.partition_index = None
+
+    def build_table(self, selection):
+        '''Boolean table over the partitions of the events selected by `selection` ({axis name: label or list of labels}).'''
+        bins = []
+        for axis_name in selection:
+            if axis_name not in self.axes_dict:
+                raise ValueError(f"Partition axis {axis_name} not found: {list(self.axes_dict.keys())}")
+        for axis in self.axes:
+            if axis.name in selection:
+                labels = selection[axis.name]
+                labels = [labels] if isinstance(labels, str) else list(labels)
+                bins.append([axis.get_bin(label) for label in labels])
+            else:
+                # All the bins, including the events outside all the bins
+                bins.append(list(range(axis.nbins + 1)))
+        table = np.zeros(self.shape, dtype=bool)
+        table[np.ix_(*bins)] = True
+        return table.ravel()
+
+    def prepare(self, events, processor_params, **kwargs):
+        self.cache.clear()
+        if self.has_common_cats:
+            self.common_cats.prepare(events, processor_params, **kwargs)
+        index = np.zeros(len(events), dtype=np.int64)
+        for axis, size in zip(self.axes, self.shape):
+            index = index * size + axis.get_index(events)
+        self.partition_index = index
+
+    def partition_counts(self):
+        '''Number of events in each partition, as an array with the shape of the partitions.'''
+        return np.bincount(self.partition_index, minlength=int(np.prod(self.shape))).reshape(self.shape)
+
+    def get_mask(self, category):
+        if category not in self.categories_dict:
+            raise ValueError(f"Requested category ({category}) does not exists")
+        if category not in self.partition_categories:
+            return self.common_cats.get_mask(category)
+        if self.partition_index is None:
+            raise Exception(
+                "Before using the selection, call the prepare method to compute the partitions"
+            )
+        if category not in self.cache:
+            self.cache[category] = self.tables[category][self.partition_index]
+        return self.cache[category]
+
+    def get_masks(self):
+        for category in self.categories:
+            yield category, self.get_mask(category)
+
+    def __str__(self):
+        return f"PartitionSelection {[axis.name for axis in self.axes]}, ({len(self.categories)} categories)"
+
+    def __repr__(self):
+        return self.__str__()
+
+    def serialize(self):
+        return {
+            "type": "PartitionSelection",
+            "common_categories": self.common_cats.serialize() if self.has_common_cats else {},
+            "axes": [axis.serialize() for axis in self.axes],
+            "categories": self.partition_categories,
+            "is_multidim": self.is_multidim,
+            "multidim_collection": self.multidim_collection,
+        }
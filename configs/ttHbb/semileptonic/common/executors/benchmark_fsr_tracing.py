@@ -0,0 +1,130 @@
+'''Scaling of the parallel tracing of the W decays and of the FSR emissions with the number of threads.
+
+The serial kernels of `common.workflows.genpart_index` and their `prange` versions are run on the same decay trees,
+on the W of each event and on a matrix of partons per event as the 7 partons of `PartonMatchingProcessorWithFSR`:
+the output of the parallel kernels is required to be identical to the serial one for each number of threads
+and the throughput (events/s) is reported. The number of threads is limited by `NUMBA_NUM_THREADS`.
+The decay trees are generated randomly, with the number of particles per event of the GenPart collection of NanoAOD.
+
+Usage:
+    python -m configs.ttHbb.semileptonic.common.executors.benchmark_fsr_tracing --threads 1 2 4 8 \
+        --nevents 200000 -o benchmark_fsr_tracing.json
+'''
+import json
+import time
+import argparse
+import numpy as np
+import awkward as ak
+import numba
+
+from ..workflows.genpart_index import GenPartIndex, STATUS_FLAGS
+
+def generate_genparts(nevents, mean_particles=80, nparts=7, seed=42):
+    '''Generate random decay trees of `nevents` events: each particle has a random mother among the previous particles
+    of the event and the particles without children are flagged as last copies.
+    Returns the GenPart collection, the global index of a W per event and the global indices (nevents, nparts) of the partons.'''
+    rng = np.random.default_rng(seed)
+    counts = np.maximum(rng.poisson(mean_particles, size=nevents), 1)
+    offsets = np.zeros(nevents + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    nparticles = offsets[-1]
+    local_index = np.arange(nparticles) - np.repeat(offsets[:-1], counts)
+    mother = np.floor(rng.uniform(size=nparticles) * local_index).astype(np.int64)
+    mother[local_index == 0] = -1
+    has_children = np.zeros(nparticles, dtype=bool)
+    has_children[(mother + np.repeat(offsets[:-1], counts))[mother >= 0]] = True
+    statusFlags = rng.integers(0, 1 << 15, size=nparticles)
+    statusFlags = np.where(has_children, statusFlags & ~(1 << STATUS_FLAGS["isLastCopy"]), statusFlags | (1 << STATUS_FLAGS["isLastCopy"]))
+    genparts = ak.zip({
+        "pdgId": ak.unflatten(rng.choice([1, 2, 3, 4, 5, -5, 11, 13, 21, 24, -24, 111, 211], size=nparticles).astype(np.int32), counts),
+        "status": ak.unflatten(rng.choice([1, 2, 22, 23], size=nparticles).astype(np.int32), counts),
+        "statusFlags": ak.unflatten(statusFlags.astype(np.int32), counts),
+        "genPartIdxMother": ak.unflatten(mother.astype(np.int32), counts),
+        "pt": ak.unflatten(rng.exponential(50., size=nparticles).astype(np.float32), counts),
+        "eta": ak.unflatten(rng.normal(0., 2., size=nparticles).astype(np.float32), counts),
+        "phi": ak.unflatten(rng.uniform(-np.pi, np.pi, size=nparticles).astype(np.float32), counts),
+    })
+    W_idx = offsets[:-1] + np.floor(rng.uniform(size=nevents) * counts).astype(np.int64)
+    parts_idx = offsets[:-1, None] + np.floor(rng.uniform(size=(nevents, nparts)) * counts[:, None]).astype(np.int64)
+    return genparts, W_idx, parts_idx
+
+
+def trace(index, W_idx, parts_idx, max_deltaR):
+    '''Tracing of `PartonMatchingProcessorWithFSR`: decay of the W from the top and from the anti-top, FSR of the partons.'''
+    W_top = index.W_decays(W_idx)
+    W_antitop = index.W_decays(W_idx)
+    emissions = index.hardest_emissions(parts_idx, max_deltaR)
+    return W_top, W_antitop, emissions
+
+
+def time_function(function, warmup=1, repeat=3):
+    '''Best time over `repeat` runs of `function`, after `warmup` runs.'''
+    for _ in range(warmup):
+        function()
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_threads(genparts, W_idx, parts_idx, threads, max_deltaR=1., warmup=1, repeat=3):
+    '''Compare the serial tracing with the parallel tracing on each number of `threads`.'''
+    index = GenPartIndex(genparts)
+    nevents = len(W_idx)
+    reference = trace(index, W_idx, parts_idx, max_deltaR)
+    serial_time = time_function(lambda: trace(index, W_idx, parts_idx, max_deltaR), warmup, repeat)
+    results = [{"threads": 1, "parallel": False, "events_per_s": nevents / serial_time, "speedup": 1.}]
+
+    index.parallel = True
+    default_threads = numba.get_num_threads()
+    try:
+        for nthreads in threads:
+            if nthreads > numba.config.NUMBA_NUM_THREADS:
+                print(f"Skipping {nthreads} threads: only {numba.config.NUMBA_NUM_THREADS} threads available (NUMBA_NUM_THREADS).")
+                continue
+            numba.set_num_threads(nthreads)
+            output = trace(index, W_idx, parts_idx, max_deltaR)
+            identical = all(np.array_equal(a, b) for a, b in zip(
+                [*output[0], *output[1], output[2]], [*reference[0], *reference[1], reference[2]]
+            ))
+            parallel_time = time_function(lambda: trace(index, W_idx, parts_idx, max_deltaR), warmup, repeat)
+            results.append({
+                "threads": nthreads, "parallel": True, "identical": bool(identical),
+                "events_per_s": nevents / parallel_time, "speedup": serial_time / parallel_time,
+            })
+    finally:
+        numba.set_num_threads(default_threads)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling of the parallel W decay and FSR tracing with the number of threads")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="Numbers of threads of the parallel tracing")
+    parser.add_argument("-n", "--nevents", type=int, default=200000, help="Number of events")
+    parser.add_argument("--particles", type=int, default=80, help="Average number of generator particles per event")
+    parser.add_argument("--max-deltaR", type=float, default=1., help="Maximum deltaR of the FSR emissions")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of warm-up runs")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic events")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output JSON file")
+    args = parser.parse_args(argv)
+
+    genparts, W_idx, parts_idx = generate_genparts(args.nevents, mean_particles=args.particles, seed=args.seed)
+    results = benchmark_threads(genparts, W_idx, parts_idx, args.threads, max_deltaR=args.max_deltaR,
+                                warmup=args.warmup, repeat=args.repeat)
+    for result in results:
+        print(json.dumps(result))
+
+    if any(not result.get("identical", True) for result in results):
+        raise RuntimeError("The output of the parallel tracing differs from the serial tracing.")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved benchmark results: {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+'''Offline benchmark of the SPANet and DCTR inference on a single CPU node.
+
+The models are run on synthetic events, with a realistic jet multiplicity of the semileptonic
+preselection, or on a small Parquet sample with the `JetGood`, `MET` and `LeptonGood` collections
+(e.g. saved with `ak.to_parquet(events[["JetGood", "MET", "LeptonGood"]], ...)`).
+Each combination of the configuration grid is run on the same events and the results are saved as JSON:
+throughput (events/s), p50/p99 latency per batch and peak RSS of the process.
+With `--jet-buckets` the end-to-end SPANet inference with buckets of jet multiplicity is compared
+with the fixed padding to 16 jets: the speed-up and the maximum difference of the scores are reported.
+The results can be used to choose the inference options in `run_options_inference.yaml`
+and in the workflow options (`spanet_batch_size`, `spanet_inference_threads`, `spanet_intra_op_num_threads`).
+
+Usage:
+    python -m configs.ttHbb.semileptonic.common.executors.benchmark_inference --spanet spanet.onnx --dctr model.onnx \
+        --nevents 100000 --batch-size 1024 8192 --intra-op-threads 1 2 4 --max-jets 16 --jet-buckets 6 8 10 16 -o benchmark.json
+'''
+import sys
+import json
+import time
+import argparse
+import itertools
+import resource
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import awkward as ak
+
+from ..workflows.spanet_input_builder import SpanetInputBuilder
+from ..workflows.workflow_spanet import run_batched_inference, run_bucketed_inference, SPANET_MAX_JETS
+
+SPANET_OUTPUT_NAMES = ["EVENT/tthbb", "EVENT/ttbb", "EVENT/ttcc", "EVENT/ttlf"]
+DCTR_OUTPUT_NAMES = ["output"]
+OPT_LEVELS = ["disable", "basic", "extended", "all"]
+
+def generate_events(nevents, seed=42, njet_min=4, njet_max=16, njet_decay=0.55):
+    '''Generate synthetic events with the `JetGood`, `MET` and `LeptonGood` collections.
+    The jet multiplicity follows a geometric distribution starting from `njet_min`, as after the
+    semileptonic preselection (most of the events with 4 to 7 jets), clipped at `njet_max`.'''
+    rng = np.random.default_rng(seed)
+    njet = np.minimum(njet_min + rng.geometric(1 - njet_decay, size=nevents) - 1, njet_max)
+    ntot = int(np.sum(njet))
+    # Jets ordered by pt in each event
+    pt = 30. + rng.exponential(50., size=ntot)
+    event_index = np.repeat(np.arange(nevents), njet)
+    order = np.lexsort((-pt, event_index))
+    pt = pt[order]
+    btag = rng.uniform(size=ntot)
+    jets = ak.unflatten(ak.zip({
+        "pt": pt.astype(np.float32),
+        "eta": rng.uniform(-2.5, 2.5, size=ntot).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, size=ntot).astype(np.float32),
+        "btag_L": (btag > 0.3).astype(np.int32),
+        "btag_M": (btag > 0.6).astype(np.int32),
+        "btag_H": (btag > 0.85).astype(np.int32),
+    }), njet)
+    leptons = ak.unflatten(ak.zip({
+        "pt": (30. + rng.exponential(40., size=nevents)).astype(np.float32),
+        "eta": rng.uniform(-2.4, 2.4, size=nevents).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, size=nevents).astype(np.float32),
+        "is_electron": rng.integers(0, 2, size=nevents).astype(bool),
+    }), np.ones(nevents, dtype=np.int64))
+    met = ak.zip({
+        "pt": (20. + rng.exponential(50., size=nevents)).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, size=nevents).astype(np.float32),
+    })
+    return ak.zip({"JetGood": jets, "LeptonGood": leptons, "MET": met}, depth_limit=1)
+
+
+def load_events(filename, nevents=None):
+    '''Load the `JetGood`, `MET` and `LeptonGood` collections from a Parquet file.'''
+    events = ak.from_parquet(filename, columns=["JetGood", "MET", "LeptonGood"])
+    if nevents is not None:
+        events = events[:nevents]
+    return events
+
+
+def create_session(model_path, intra_op_num_threads=1, opt_level="all"):
+    import onnxruntime as ort
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }[opt_level]
+    sess_options.intra_op_num_threads = intra_op_num_threads
+    return ort.InferenceSession(model_path, sess_options=sess_options, providers=['CPUExecutionProvider'])
+
+
+def get_peak_rss_mb():
+    '''Peak resident memory of the process so far, in MB.'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def time_batches(model_session, input_feed, output_names, batch_size, n_threads=1):
+    '''Run the model over the batches of the input and return the total time and the latency of each batch.'''
+    nevents = len(next(iter(input_feed.values())))
+    starts = list(range(0, nevents, batch_size))
+
+    def _run_batch(start):
+        feed = {key: value[start:start + batch_size] for key, value in input_feed.items()}
+        t0 = time.perf_counter()
+        model_session.run(output_names=output_names, input_feed=feed)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            latencies = list(pool.map(_run_batch, starts))
+    else:
+        latencies = [_run_batch(start) for start in starts]
+    return time.perf_counter() - t0, np.array(latencies)
+
+
+class TimedSession:
+    '''Wrapper of an ONNX session recording the latency of each call.'''
+    def __init__(self, session):
+        self.session = session
+        self.latencies = []
+
+    def run(self, output_names, input_feed):
+        t0 = time.perf_counter()
+        outputs = self.session.run(output_names=output_names, input_feed=input_feed)
+        self.latencies.append(time.perf_counter() - t0)
+        return outputs
+
+
+def compare_bucketed(model_session, events, jet_buckets, batch_size, n_threads, warmup=1, repeat=3):
+    '''Run the SPANet inference end-to-end (input building and inference) with all the events
+    padded to 16 jets and with the buckets of jet multiplicity `jet_buckets`.
+    Return the timing of both modes and the maximum difference of the scores.'''
+    def _run_fixed(session):
+        input_feed = SpanetInputBuilder(max_jets=SPANET_MAX_JETS).build(events)
+        return run_batched_inference(session, input_feed, SPANET_OUTPUT_NAMES, batch_size=batch_size, n_threads=n_threads)
+
+    def _run_bucketed(session):
+        return run_bucketed_inference(session, events, SPANET_OUTPUT_NAMES, jet_buckets, batch_size=batch_size, n_threads=n_threads)
+
+    timings = {}
+    outputs = {}
+    for mode, func in [("fixed", _run_fixed), ("bucketed", _run_bucketed)]:
+        for _ in range(warmup):
+            func(model_session)
+        session = TimedSession(model_session)
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            outputs[mode] = func(session)
+            times.append(time.perf_counter() - t0)
+        timings[mode] = (float(np.median(times)), np.array(session.latencies))
+    max_abs_diff = max(
+        float(np.max(np.abs(fixed[:,1] - bucketed[:,1]))) for fixed, bucketed in zip(outputs["fixed"], outputs["bucketed"])
+    )
+    return timings, max_abs_diff
+
+
+def summarize(model, config, nevents, total_time, latencies, **extra):
+    return {
+        "model": model,
+        **config,
+        "nevents": nevents,
+        "events_per_second": nevents / total_time,
+        "total_time_s": total_time,
+        "latency_p50_ms": 1e3 * float(np.percentile(latencies, 50)),
+        "latency_p99_ms": 1e3 * float(np.percentile(latencies, 99)),
+        "peak_rss_mb": get_peak_rss_mb(),
+        **extra,
+    }
+
+
+def benchmark_spanet(model_path, events, grid, warmup=1, repeat=3):
+    results = []
+    for intra_op, opt_level, batch_size, n_threads, max_jets in itertools.product(
+        grid["intra_op_num_threads"], grid["opt_level"], grid["batch_size"], grid["inference_threads"], grid["max_jets"]
+    ):
+        config = {"intra_op_num_threads": intra_op, "opt_level": opt_level, "batch_size": batch_size,
+                  "inference_threads": n_threads, "max_jets": max_jets}
+        session = create_session(model_path, intra_op_num_threads=intra_op, opt_level=opt_level)
+        t0 = time.perf_counter()
+        input_feed = SpanetInputBuilder(max_jets=max_jets).build(events)
+        build_time = time.perf_counter() - t0
+        for _ in range(warmup):
+            time_batches(session, input_feed, SPANET_OUTPUT_NAMES, batch_size, n_threads)
+        runs = [time_batches(session, input_feed, SPANET_OUTPUT_NAMES, batch_size, n_threads) for _ in range(repeat)]
+        total_time = float(np.median([r[0] for r in runs]))
+        latencies = np.concatenate([r[1] for r in runs])
+        results.append(summarize("spanet", config, len(events), total_time, latencies, input_build_time_s=build_time))
+        print(json.dumps(results[-1]))
+
+    # Comparison of the inference with buckets of jet multiplicity and with fixed padding to 16 jets
+    if grid.get("jet_buckets") is not None:
+        for intra_op, opt_level, batch_size, n_threads in itertools.product(
+            grid["intra_op_num_threads"], grid["opt_level"], grid["batch_size"], grid["inference_threads"]
+        ):
+            config = {"intra_op_num_threads": intra_op, "opt_level": opt_level, "batch_size": batch_size,
+                      "inference_threads": n_threads}
+            session = create_session(model_path, intra_op_num_threads=intra_op, opt_level=opt_level)
+            timings, max_abs_diff = compare_bucketed(session, events, grid["jet_buckets"], batch_size, n_threads, warmup=warmup, repeat=repeat)
+            for mode, (total_time, latencies) in timings.items():
+                extra = {"max_jets": SPANET_MAX_JETS} if mode == "fixed" else {"jet_buckets": list(grid["jet_buckets"])}
+                results.append(summarize(f"spanet_end_to_end_{mode}", config, len(events), total_time, latencies, **extra))
+            results[-1]["speedup"] = timings["fixed"][0] / timings["bucketed"][0]
+            results[-1]["max_abs_diff_scores"] = max_abs_diff
+            print(json.dumps(results[-2]))
+            print(json.dumps(results[-1]))
+    return results
+
+
+def benchmark_dctr(model_path, nevents, grid, warmup=1, repeat=3, seed=42):
+    '''The DCTR model takes a flat matrix of features: the inputs are generated with the number of
+    features read from the model (standardised features, or raw ones for a fused model).'''
+    results = []
+    rng = np.random.default_rng(seed)
+    data = None
+    for intra_op, opt_level, batch_size, n_threads in itertools.product(
+        grid["intra_op_num_threads"], grid["opt_level"], grid["batch_size"], grid["inference_threads"]
+    ):
+        config = {"intra_op_num_threads": intra_op, "opt_level": opt_level, "batch_size": batch_size,
+                  "inference_threads": n_threads}
+        session = create_session(model_path, intra_op_num_threads=intra_op, opt_level=opt_level)
+        model_input = session.get_inputs()[0]
+        if data is None:
+            data = rng.normal(size=(nevents, model_input.shape[1])).astype(np.float32)
+        input_feed = {model_input.name: data}
+        for _ in range(warmup):
+            time_batches(session, input_feed, DCTR_OUTPUT_NAMES, batch_size, n_threads)
+        runs = [time_batches(session, input_feed, DCTR_OUTPUT_NAMES, batch_size, n_threads) for _ in range(repeat)]
+        total_time = float(np.median([r[0] for r in runs]))
+        latencies = np.concatenate([r[1] for r in runs])
+        results.append(summarize("dctr", config, nevents, total_time, latencies))
+        print(json.dumps(results[-1]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the SPANet and DCTR inference on CPU")
+    parser.add_argument("--spanet", type=str, default=None, help="SPANet ONNX model")
+    parser.add_argument("--dctr", type=str, default=None, help="DCTR ONNX model")
+    parser.add_argument("-n", "--nevents", type=int, default=50000, help="Number of events")
+    parser.add_argument("--parquet", type=str, default=None, help="Parquet file with the JetGood, MET and LeptonGood collections (default: synthetic events)")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[8192], help="Number of events per batch")
+    parser.add_argument("--intra-op-threads", type=int, nargs="+", default=[1], help="Number of threads of the ONNX runtime")
+    parser.add_argument("--inference-threads", type=int, nargs="+", default=[1], help="Number of threads running the batches concurrently")
+    parser.add_argument("--opt-level", type=str, nargs="+", default=["all"], choices=OPT_LEVELS, help="Graph optimisation level")
+    parser.add_argument("--max-jets", type=int, nargs="+", default=[16], help="Padding length of the SPANet jets")
+    parser.add_argument("--jet-buckets", type=int, nargs="+", default=None, help="Padding lengths of the buckets of jet multiplicity to compare with the fixed padding to 16 jets (e.g. 6 8 10 16)")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of warm-up runs for each configuration")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs for each configuration")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic events")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output JSON file")
+    args = parser.parse_args(argv)
+
+    if (args.spanet is None) and (args.dctr is None):
+        parser.error("At least one of --spanet and --dctr should be given.")
+
+    grid = {
+        "batch_size": args.batch_size,
+        "intra_op_num_threads": args.intra_op_threads,
+        "inference_threads": args.inference_threads,
+        "opt_level": args.opt_level,
+        "max_jets": args.max_jets,
+        "jet_buckets": sorted(args.jet_buckets) if args.jet_buckets is not None else None,
+    }
+    results = []
+    if args.spanet is not None:
+        if args.parquet is not None:
+            events = load_events(args.parquet, args.nevents)
+        else:
+            events = generate_events(args.nevents, seed=args.seed)
+        results += benchmark_spanet(args.spanet, events, grid, warmup=args.warmup, repeat=args.repeat)
+    if args.dctr is not None:
+        results += benchmark_dctr(args.dctr, args.nevents, grid, warmup=args.warmup, repeat=args.repeat, seed=args.seed)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved benchmark results: {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
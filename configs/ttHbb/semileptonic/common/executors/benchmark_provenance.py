@@ -0,0 +1,148 @@
+'''Regression check and throughput comparison of the parton provenance kernels.
+
+The compiled kernels of `common.workflows.parton_provenance`, filling a preallocated int32 buffer,
+are compared with the PocketCoffea functions filling an `ak.ArrayBuilder` on the same chunks of partons:
+the provenance codes are required to be identical and the throughput (events/s) of both implementations is reported.
+The partons are generated with the LHE ordering of the ttHbb, ttbb (4FS) and tt (5FS) semileptonic samples,
+or read from the `pdgId` of the `Parton` collection saved in a Parquet file (e.g. by the ntuples exporter).
+
+Usage:
+    python -m configs.ttHbb.semileptonic.common.executors.benchmark_provenance --process ttHbb ttbb4F tt5F \
+        --nevents 200000 --chunks 5 -o benchmark_provenance.json
+'''
+import json
+import time
+import argparse
+import numpy as np
+import awkward as ak
+
+from ..workflows import parton_provenance
+
+PROCESSES = ["ttHbb", "ttbb4F", "tt5F"]
+
+def generate_partons(process, nevents, seed=42, isr_fraction=0.4):
+    '''Generate the pdgId of the partons of semileptonic events of `process`, in the LHE order:
+    - ttHbb: [radiation], b, bbar, W decay quarks, b and bbar from the Higgs decay
+    - ttbb4F: g->bb b-quarks, [radiation], b, bbar, W decay quarks
+    - tt5F: [radiation], b, bbar, W decay quarks
+    The hadronic W comes from the top or the anti-top with equal probability; a fraction `isr_fraction`
+    of the events has an additional parton (gluon or light quark).'''
+    rng = np.random.default_rng(seed)
+    has_isr = rng.uniform(size=nevents) < isr_fraction
+    isr = rng.choice([21, 21, 21, 1, -1, 2, -2, 3, -3, 4, -4], size=nevents)
+    # Hadronic W+ (from the top): (-1 or -3, 2 or 4), W- (from the anti-top): (1 or 3, -2 or -4)
+    hadronic_top = rng.uniform(size=nevents) < 0.5
+    down = rng.choice([1, 3], size=nevents)
+    up = rng.choice([2, 4], size=nevents)
+    q1 = np.where(hadronic_top, -down, down)
+    q2 = np.where(hadronic_top, up, -up)
+    bb = np.tile([5, -5], (nevents, 1))
+
+    if process == "ttHbb":
+        columns = [isr[:, None], bb, q1[:, None], q2[:, None], bb]
+        isr_position = 0
+    elif process == "ttbb4F":
+        columns = [bb, isr[:, None], bb, q1[:, None], q2[:, None]]
+        isr_position = 2
+    elif process == "tt5F":
+        columns = [isr[:, None], bb, q1[:, None], q2[:, None]]
+        isr_position = 0
+    else:
+        raise ValueError(f"Unknown process `{process}`: available processes {PROCESSES}.")
+    table = np.concatenate(columns, axis=1)
+    # Remove the additional radiation from the events without it
+    keep = np.ones(table.shape, dtype=bool)
+    keep[:, isr_position] = has_isr
+    return ak.unflatten(table[keep], np.sum(keep, axis=1))
+
+
+def load_partons(filename, nevents=None):
+    '''Load the pdgId of the `Parton` collection from a Parquet file.'''
+    partons = ak.from_parquet(filename, columns=["Parton.pdgId"])
+    if nevents is not None:
+        partons = partons[:nevents]
+    return partons.Parton.pdgId
+
+
+def get_arraybuilder_provenance(process):
+    '''Provenance function of PocketCoffea filling an `ak.ArrayBuilder`.'''
+    from pocket_coffea.lib import parton_provenance as pocket_coffea_provenance
+    function = getattr(pocket_coffea_provenance, f"get_partons_provenance_{process}")
+    return lambda pdgIds: function(ak.Array(pdgIds, behavior={}), ak.ArrayBuilder()).snapshot()
+
+
+def time_function(function, chunks, warmup=1, repeat=3):
+    '''Best time over `repeat` runs of `function` on all the `chunks`, after `warmup` runs on the first chunk.'''
+    for _ in range(warmup):
+        function(chunks[0])
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for chunk in chunks:
+            function(chunk)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_process(process, partons, nchunks=1, warmup=1, repeat=3):
+    '''Compare the provenance of the kernels and of the ArrayBuilder functions on `partons` split in `nchunks` chunks.'''
+    chunk_size = int(np.ceil(len(partons) / nchunks))
+    chunks = [partons[start:start + chunk_size] for start in range(0, len(partons), chunk_size)]
+    kernel = getattr(parton_provenance, f"get_partons_provenance_{process}")
+    result = {"process": process, "nevents": len(partons), "chunks": len(chunks)}
+
+    kernel_time = time_function(kernel, chunks, warmup, repeat)
+    result["kernel_events_per_s"] = len(partons) / kernel_time
+    try:
+        arraybuilder = get_arraybuilder_provenance(process)
+    except ImportError:
+        print("PocketCoffea not available: only the kernels are timed, the regression check is skipped.")
+        return result
+
+    # Regression check: same nested structure and same provenance codes
+    identical = True
+    for chunk in chunks:
+        new = kernel(chunk)
+        reference = arraybuilder(chunk)
+        identical &= (ak.to_list(ak.num(new, axis=1)) == ak.to_list(ak.num(reference, axis=1))) and \
+            np.array_equal(ak.to_numpy(ak.flatten(new)), ak.to_numpy(ak.flatten(reference)))
+    result["identical"] = bool(identical)
+    arraybuilder_time = time_function(arraybuilder, chunks, warmup, repeat)
+    result["arraybuilder_events_per_s"] = len(partons) / arraybuilder_time
+    result["speedup"] = arraybuilder_time / kernel_time
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the compiled parton provenance kernels with the ArrayBuilder implementation")
+    parser.add_argument("--process", type=str, nargs="+", default=PROCESSES, choices=PROCESSES, help="Provenance functions to compare")
+    parser.add_argument("-n", "--nevents", type=int, default=200000, help="Number of events")
+    parser.add_argument("--chunks", type=int, default=1, help="Number of chunks the events are split into")
+    parser.add_argument("--parquet", type=str, default=None, help="Parquet file with the `Parton` collection (default: synthetic events)")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of warm-up runs")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic events")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output JSON file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for process in args.process:
+        if args.parquet is not None:
+            partons = load_partons(args.parquet, args.nevents)
+        else:
+            partons = generate_partons(process, args.nevents, seed=args.seed)
+        result = benchmark_process(process, partons, nchunks=args.chunks, warmup=args.warmup, repeat=args.repeat)
+        print(json.dumps(result))
+        results.append(result)
+
+    if any(not result.get("identical", True) for result in results):
+        raise RuntimeError("The provenance of the kernels differs from the ArrayBuilder implementation.")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Saved benchmark results: {args.output}")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import os
+from omegaconf import OmegaConf
+from pocket_coffea.executors.executors_T3_CH_PSI import DaskExecutorFactory
+from dask.distributed import WorkerPlugin, Worker
+from configs.ttHbb.semileptonic.common.weights.correction_cache import get_correction_cache, get_correction_files
+
+
+class WorkerCorrectionPreloadPlugin(WorkerPlugin):
+    '''Load on each worker, when it starts, the correctionlib files used by the custom weights into the
+    CorrectionSet cache of the worker process, so that the first chunks do not pay the parsing of the files.
+    The files are given explicitly or read from the parameters (see `get_correction_files`).'''
+    def __init__(self, files=None, params=None, years=None):
+        super().__init__()
+        self.files = list(files) if files is not None else []
+        if params is not None:
+            self.files += [f for f in get_correction_files(params, years) if f not in self.files]
+        if len(self.files) == 0:
+            raise ValueError("No correction file to preload. Please specify the files or the parameters with the correction files.")
+
+    async def setup(self, worker: Worker):
+        get_correction_cache().preload(self.files)
+
+    async def teardown(self, worker: Worker):
+        get_correction_cache().clear()
+
+
+def register_correction_preload_plugin(dask_client, files=None, params=None, years=None):
+    '''Register the correction preloading plugin on the workers of the Dask client.'''
+    correction_preload_plugin = WorkerCorrectionPreloadPlugin(files=files, params=params, years=years)
+    dask_client.register_worker_plugin(correction_preload_plugin)
+    return correction_preload_plugin
+
+
+class CorrectionPreloadExecutorFactory(DaskExecutorFactory):
+    '''Dask executor preloading on the workers the correction files of the custom weights.
+    The files are listed in the `preload_corrections` run option and/or, if the `preload_corrections_from_params`
+    run option is set, collected from the parameters of the configuration (`parameters_dump.yaml`, saved by the runner
+    in the output folder) for the years in the `preload_corrections_years` run option (all the years if not set).'''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+    def get_parameters(self):
+        '''Parameters of the configuration being run, as saved by the runner in the output folder.'''
+        path = os.path.join(self.outputdir, "parameters_dump.yaml")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The parameters of the configuration are not saved in the output folder ({path}): cannot collect the correction files to preload.")
+        return OmegaConf.load(path)
+
+    def setup(self):
+        super().setup()
+        params = self.get_parameters() if self.run_options.get("preload_corrections_from_params", False) else None
+        register_correction_preload_plugin(
+            self.dask_client,
+            files=self.run_options.get("preload_corrections", None),
+            params=params,
+            years=self.run_options.get("preload_corrections_years", None),
+        )
+
+
+def get_executor_factory(executor_name, **kwargs):
+    return CorrectionPreloadExecutorFactory(**kwargs)
@@ -0,0 +1,115 @@
+'''Fuse the preprocessing of the DCTR model in a single ONNX graph.
+
+The fused graph takes the raw input features in float32 and contains:
+- the standardisation of the features with the StandardScaler fitted during the training, (x - mean) / scale;
+- the DCTR model;
+- the transformation of the output score to the DCTR weight, out / (1 - out).
+The outputs of the fused graph are the score (`output`, same as the original model) and the weight (`weight`).
+The list of the input features and a flag are saved in the metadata of the model, so that the
+`DCTRInferenceProcessor` recognises a fused model and skips the preprocessing.
+
+Usage:
+    python -m configs.ttHbb.semileptonic.common.executors.fuse_dctr_model -m model.onnx -s standard_scaler.pkl \
+        -f njet nbjet ht ht_b ht_light mbb_closest drbb_min bjet_pt_3 -o model_fused.onnx
+'''
+import json
+import pickle
+import argparse
+import numpy as np
+
+# Keys of the metadata of the fused model
+FUSED_METADATA_KEY = "dctr_fused_preprocessing"
+FEATURES_METADATA_KEY = "dctr_input_features"
+WEIGHT_OUTPUT_NAME = "weight"
+
+def is_fused_model(model_session):
+    '''Check if the ONNX session runs a DCTR model with fused preprocessing.'''
+    return model_session.get_modelmeta().custom_metadata_map.get(FUSED_METADATA_KEY, "false") == "true"
+
+
+def get_fused_input_features(model_session):
+    '''Get the list of input features of a fused DCTR model.'''
+    return json.loads(model_session.get_modelmeta().custom_metadata_map[FEATURES_METADATA_KEY])
+
+
+def fuse_dctr_model(model_file, scaler_file, output_file, input_features, output_name="output"):
+    '''Write the fused ONNX graph of the DCTR model `model_file` with the StandardScaler
+    saved in `scaler_file`. `input_features` is the ordered list of the input features of the model.'''
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    model = onnx.load(model_file)
+    graph = model.graph
+    with open(scaler_file, "rb") as f:
+        scaler = pickle.load(f)
+
+    if len(graph.input) != 1:
+        raise ValueError(f"The DCTR model should have a single input, found {[i.name for i in graph.input]}.")
+    if output_name not in [o.name for o in graph.output]:
+        raise ValueError(f"Output `{output_name}` not found in the DCTR model.")
+    n_features = getattr(scaler, "n_features_in_", len(input_features))
+    if n_features != len(input_features):
+        raise ValueError(f"The standard scaler has {n_features} features, while {len(input_features)} input features are given.")
+
+    input_name = graph.input[0].name
+    scaled_name = f"{input_name}_scaled"
+    # The nodes of the model now read the standardised features
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name == input_name:
+                node.input[i] = scaled_name
+
+    preprocessing = []
+    current = input_name
+    if getattr(scaler, "mean_", None) is not None:
+        graph.initializer.append(numpy_helper.from_array(scaler.mean_.astype(np.float32), "scaler_mean"))
+        preprocessing.append(helper.make_node("Sub", [current, "scaler_mean"], [f"{input_name}_centered"]))
+        current = f"{input_name}_centered"
+    if getattr(scaler, "scale_", None) is not None:
+        graph.initializer.append(numpy_helper.from_array(scaler.scale_.astype(np.float32), "scaler_scale"))
+        preprocessing.append(helper.make_node("Div", [current, "scaler_scale"], [scaled_name]))
+    else:
+        preprocessing.append(helper.make_node("Identity", [current], [scaled_name]))
+
+    # Weight transformation: out / (1 - out)
+    graph.initializer.append(numpy_helper.from_array(np.array(1., dtype=np.float32), "weight_one"))
+    postprocessing = [
+        helper.make_node("Sub", ["weight_one", output_name], ["weight_denominator"]),
+        helper.make_node("Div", [output_name, "weight_denominator"], [WEIGHT_OUTPUT_NAME]),
+    ]
+
+    nodes = preprocessing + list(graph.node) + postprocessing
+    del graph.node[:]
+    graph.node.extend(nodes)
+
+    # The graph input keeps the original name and takes the raw features in float32
+    new_input = helper.make_tensor_value_info(input_name, TensorProto.FLOAT, ["batch", len(input_features)])
+    del graph.input[:]
+    graph.input.append(new_input)
+    output_info = next(o for o in graph.output if o.name == output_name)
+    weight_info = onnx.ValueInfoProto()
+    weight_info.CopyFrom(output_info)
+    weight_info.name = WEIGHT_OUTPUT_NAME
+    graph.output.append(weight_info)
+
+    for key, value in [(FUSED_METADATA_KEY, "true"), (FEATURES_METADATA_KEY, json.dumps(list(input_features)))]:
+        entry = model.metadata_props.add()
+        entry.key = key
+        entry.value = value
+
+    onnx.checker.check_model(model)
+    onnx.save(model, output_file)
+    return output_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fuse the StandardScaler and the weight transformation in the DCTR ONNX model")
+    parser.add_argument("-m", "--model", type=str, required=True, help="DCTR ONNX model")
+    parser.add_argument("-s", "--scaler", type=str, required=True, help="Pickle file of the StandardScaler")
+    parser.add_argument("-f", "--features", nargs="+", required=True, help="Input features of the model, in the order of the columns used in the training (the order of `get_input_features`)")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Output fused ONNX model")
+    parser.add_argument("--output-name", type=str, default="output", help="Name of the score output of the model")
+    args = parser.parse_args()
+
+    fuse_dctr_model(args.model, args.scaler, args.output, args.features, output_name=args.output_name)
+    print(f"Saved fused DCTR model: {args.output}")
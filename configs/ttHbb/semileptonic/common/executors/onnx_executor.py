@@ -1,38 +1,39 @@
 import os
 from pocket_coffea.executors.executors_T3_CH_PSI import DaskExecutorFactory
 from dask.distributed import WorkerPlugin, Worker, Client
+from configs.ttHbb.semileptonic.common.executors.session_registry import REGISTRY_KEY, registry_from_run_options
 
 
-class WorkerInferenceSessionPlugin(WorkerPlugin):    
-    def __init__(self, model_path, session_name):
+class WorkerSessionRegistryPlugin(WorkerPlugin):
+    '''Install on each worker a registry of the ONNX sessions for all the `*_model` keys of the run options.
+    The sessions are created lazily by the processors the first time they are requested,
+    and the number of sessions kept in memory is bounded by the `onnx_max_sessions` run option.'''
+    def __init__(self, run_options):
         super().__init__()
-        self.model_path = model_path
-        self.session_name = session_name
-        if self.model_path is None:
-            raise ValueError(f"{self.session_name}: No path to the ONNX model specified.")
+        self.registry = registry_from_run_options(run_options)
+        if len(self.registry.models) == 0:
+            raise ValueError("No ONNX model specified in the run options. Please specify at least one `*_model` key.")
 
     async def setup(self, worker: Worker):
         if os.path.exists("/afs/cern.ch/work"):
             import sys
             sys.path.append("/afs/cern.ch/work/m/mmarcheg/ttHbb/envs/configs/lib/python3.11/site-packages/")
-        import onnxruntime as ort
 
-        sess_options = ort.SessionOptions()
+        # The registry is unpickled without sessions: they are loaded on first use
+        worker.data[REGISTRY_KEY] = self.registry
 
-        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-        sess_options.intra_op_num_threads = 1
-        
-        session = ort.InferenceSession(
-            self.model_path,
-            sess_options = sess_options,
-            providers=['CPUExecutionProvider']
-        )
+    async def teardown(self, worker: Worker):
+        registry = worker.data.pop(REGISTRY_KEY, None)
+        if registry is not None:
+            registry.clear()
 
-        worker.data[f"model_session_{self.session_name}"] = session
 
-        
-# Create an instance of the plugin
-#inference_session_plugin = WorkerInferenceSessionPlugin()
+def register_session_registry_plugin(dask_client, run_options):
+    '''Register the ONNX session registry plugin on the workers of the Dask client.'''
+    session_registry_plugin = WorkerSessionRegistryPlugin(run_options)
+    dask_client.register_worker_plugin(session_registry_plugin)
+    return session_registry_plugin
+
 
 class OnnxExecutorFactory(DaskExecutorFactory):
 
@@ -41,11 +42,8 @@ class OnnxExecutorFactory(DaskExecutorFactory):
 
     def setup(self):
         super().setup()
-        # now setting up and registering the ONNX plugin
-        self.spanet_model_path = self.run_options.get("spanet_model", None)
-        inference_session_plugin = WorkerInferenceSessionPlugin(self.spanet_model_path, "spanet")
-        # Registering the session plugin
-        self.dask_client.register_worker_plugin(inference_session_plugin)
+        # now setting up and registering the ONNX session registry plugin
+        register_session_registry_plugin(self.dask_client, self.run_options)
 
 
 def get_executor_factory(executor_name, **kwargs):
@@ -1,5 +1,5 @@
 from pocket_coffea.executors.executors_cern_swan import DaskExecutorFactory
-from .onnx_executor import WorkerInferenceSessionPlugin
+from configs.ttHbb.semileptonic.common.executors.onnx_executor import register_session_registry_plugin
 
 class OnnxExecutorFactory(DaskExecutorFactory):
 
@@ -8,14 +8,8 @@ class OnnxExecutorFactory(DaskExecutorFactory):
 
     def setup(self):
         super().setup()
-        # now setting up and registering the ONNX plugin
-        self.spanet_model_path = self.run_options.get("spanet_model", None)
-        self.dctr_model_path = self.run_options.get("dctr_model", None)
-        inference_session_plugin = WorkerInferenceSessionPlugin(self.spanet_model_path, "spanet")
-        inference_session_plugin_dctr = WorkerInferenceSessionPlugin(self.dctr_model_path, "dctr")
-        # Registering the session plugin
-        self.dask_client.register_worker_plugin(inference_session_plugin)
-        self.dask_client.register_worker_plugin(inference_session_plugin_dctr)
+        # now setting up and registering the ONNX session registry plugin
+        register_session_registry_plugin(self.dask_client, self.run_options)
 
 def get_executor_factory(executor_name, **kwargs):
     return OnnxExecutorFactory(**kwargs)
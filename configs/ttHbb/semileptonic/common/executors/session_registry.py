@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Key of the session registry in the `data` of the Dask worker
+REGISTRY_KEY = "onnx_session_registry"
+
+class InferenceSessionRegistry:
+    '''Registry of the ONNX inference sessions used by the processors, indexed by model name.
+    The models are registered with the path of the ONNX file and the sessions are created lazily
+    the first time they are requested, so that a process never loads a model it does not use.
+    The number of sessions kept in memory is bounded by `max_sessions`: when the limit is exceeded
+    the least recently used session is dropped and recreated on the next request.
+
+    :param models: dictionary {name: path} of the ONNX models to register
+    :param max_sessions: maximum number of sessions kept in memory (None: no limit)
+    :param intra_op_num_threads: default number of threads used internally by the ONNX runtime
+    '''
+
+    def __init__(self, models=None, max_sessions=None, intra_op_num_threads=1):
+        if (max_sessions is not None) and (max_sessions < 1):
+            raise ValueError("The maximum number of ONNX sessions should be a positive integer or None.")
+        self.max_sessions = max_sessions
+        self.intra_op_num_threads = intra_op_num_threads
+        self._models = {}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        if models is not None:
+            for name, model_path in models.items():
+                self.register(name, model_path)
+
+    def __getstate__(self):
+        # The sessions and the lock cannot be pickled: only the configuration is shipped
+        return {
+            "max_sessions": self.max_sessions,
+            "intra_op_num_threads": self.intra_op_num_threads,
+            "_models": self._models,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def models(self):
+        return {name: model["path"] for name, model in self._models.items()}
+
+    @property
+    def loaded(self):
+        return list(self._sessions.keys())
+
+    def register(self, name, model_path, intra_op_num_threads=None):
+        if model_path is None:
+            raise ValueError(f"{name}: No path to the ONNX model specified.")
+        if not model_path.endswith(".onnx"):
+            raise ValueError(f"{name}: The model path `{model_path}` should be the path of an ONNX model.")
+        if intra_op_num_threads is None:
+            intra_op_num_threads = self.intra_op_num_threads
+        with self._lock:
+            model = {"path": model_path, "intra_op_num_threads": intra_op_num_threads}
+            if self._models.get(name, model) != model:
+                # The model has changed: the old session is dropped
+                self._sessions.pop(name, None)
+            self._models[name] = model
+
+    def _create_session(self, model):
+        import onnxruntime as ort
+
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = model["intra_op_num_threads"]
+        return ort.InferenceSession(
+            model["path"],
+            sess_options=sess_options,
+            providers=['CPUExecutionProvider']
+        )
+
+    def get(self, name, model_path=None, intra_op_num_threads=None):
+        '''Get the session of the model `name`, creating it if needed.
+        If the model is not registered yet, it is registered with `model_path`.
+        A model already registered keeps its path: in this way the models
+        configured in the run options have the precedence over the workflow options.'''
+        if name not in self._models:
+            if model_path is None:
+                raise KeyError(f"Model `{name}` not found in the ONNX session registry. Registered models: {list(self._models.keys())}")
+            self.register(name, model_path, intra_op_num_threads=intra_op_num_threads)
+        with self._lock:
+            if name in self._sessions:
+                self._sessions.move_to_end(name)
+                return self._sessions[name]
+            session = self._create_session(self._models[name])
+            self._sessions[name] = session
+            if self.max_sessions is not None:
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            return session
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def __repr__(self):
+        return f"InferenceSessionRegistry(models={list(self._models.keys())}, loaded={self.loaded}, max_sessions={self.max_sessions})"
+
+
+def get_models_from_run_options(run_options):
+    '''Get the dictionary {name: path} of all the `*_model` keys in the run options.'''
+    return {
+        key[:-len("_model")]: value for key, value in run_options.items()
+        if key.endswith("_model") and (value is not None)
+    }
+
+
+def registry_from_run_options(run_options):
+    '''Build the session registry from the `*_model` keys of the run options.
+    The optional keys `onnx_max_sessions` and `{name}_intra_op_num_threads`
+    configure the LRU limit and the threads of each session.'''
+    models = get_models_from_run_options(run_options)
+    registry = InferenceSessionRegistry(max_sessions=run_options.get("onnx_max_sessions", None))
+    for name, model_path in models.items():
+        registry.register(name, model_path, intra_op_num_threads=run_options.get(f"{name}_intra_op_num_threads", 1))
+    return registry
+
+
+# Registry used by the processes which are not Dask workers (e.g. iterative and futures executors)
+_local_registry = None
+
+def get_session_registry():
+    '''Get the session registry of the current process: the one installed by the
+    worker plugin on a Dask worker, a process-wide one otherwise.'''
+    global _local_registry
+    try:
+        from dask.distributed import get_worker
+        worker = get_worker()
+    except (ImportError, ValueError):
+        worker = None
+
+    if (worker is not None) and (REGISTRY_KEY in worker.data):
+        return worker.data[REGISTRY_KEY]
+    if _local_registry is None:
+        _local_registry = InferenceSessionRegistry()
+    return _local_registry
+
+
+def get_inference_session(name, model_path=None, intra_op_num_threads=None):
+    '''Get the ONNX session of the model `name` from the registry of the current process.'''
+    return get_session_registry().get(name, model_path=model_path, intra_op_num_threads=intra_op_num_threads)
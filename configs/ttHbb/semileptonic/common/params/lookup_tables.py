@@ -0,0 +1,141 @@
+import os
+import copy
+import json
+import yaml
+import numpy as np
+from .region_index import BinnedRegionIndex, DCTR_N_QUANTILES, DCTR_NJET_EDGES, DCTR_NJET_KEYS
+
+# Jet multiplicity from which the njet reweighting takes the same value (inclusive bin >= 7 jets)
+NJET_REWEIGHTING_INCLUSIVE = 7
+
+class NjetLookupTable:
+    '''Value by jet multiplicity stored as a dense array indexed by the number of jets:
+    the last value of the array is taken for all the higher multiplicities.
+
+    :param values: values for 0, 1, ..., len(values) - 1 jets
+    '''
+    def __init__(self, values):
+        self.values = np.asarray(values, dtype=np.float64)
+        if (self.values.ndim != 1) or (len(self.values) == 0):
+            raise ValueError(f"The values of the jet multiplicity table should be a non-empty 1D array: {values}")
+
+    @classmethod
+    def from_map(cls, values_by_njet, inclusive_from, default=1.):
+        '''Build the table from the dictionary {njet: value}: the multiplicities below the first key get `default`
+        and all the multiplicities from `inclusive_from` on get the value of the highest multiplicity of the dictionary.'''
+        values_by_njet = {int(nj): value for nj, value in values_by_njet.items()}
+        njets = sorted(values_by_njet.keys())
+        missing = [nj for nj in range(njets[0], inclusive_from + 1) if nj not in values_by_njet]
+        if len(missing) > 0:
+            raise ValueError(f"Missing jet multiplicities {missing} in the table {values_by_njet}.")
+        values = np.full(inclusive_from + 1, default, dtype=np.float64)
+        for nj in range(njets[0], inclusive_from):
+            values[nj] = values_by_njet[nj]
+        values[inclusive_from] = values_by_njet[njets[-1]]
+        return cls(values)
+
+    def __call__(self, njet):
+        '''Get the values for the jet multiplicities `njet`.'''
+        return np.take(self.values, np.minimum(np.asarray(njet), len(self.values) - 1))
+
+
+# Tables compiled by the current process, keyed by (kind, path, key): (modification time of the file, table)
+_tables = {}
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_lookup_table(kind, filename, key, build):
+    '''Get the table `kind` compiled by `build(filename, key)` from the entry `key` of the file `filename`.
+    The table is compiled once per process and compiled again only if the file is modified.'''
+    path = os.path.abspath(filename)
+    mtime = _mtime(path)
+    cached = _tables.get((kind, path, key), None)
+    if (cached is None) or ((mtime is not None) and (cached[0] != mtime)):
+        cached = (mtime, build(path, key))
+        _tables[(kind, path, key)] = cached
+    return cached[1]
+
+
+def compile_njet_reweighting(filename, key):
+    with open(filename) as f:
+        reweighting_map_njet = yaml.safe_load(f)[key]
+    return NjetLookupTable.from_map(reweighting_map_njet, inclusive_from=NJET_REWEIGHTING_INCLUSIVE)
+
+
+def get_njet_reweighting_table(filename, key):
+    '''Get the table of the njet reweighting saved under `key` in the YAML `filename`.'''
+    return get_lookup_table("njet_reweighting", filename, key, compile_njet_reweighting)
+
+
+def parse_weight_cuts(filename, key=None):
+    with open(filename) as f:
+        w_cuts = json.load(f)
+    for k in w_cuts.keys():
+        if len(w_cuts[k]) != DCTR_N_QUANTILES:
+            raise ValueError(f"The DCTR weight cuts `{k}` in {filename} should have {DCTR_N_QUANTILES} quantiles, found {len(w_cuts[k])}.")
+        # Set the limit of the last quantile for each key as inf
+        w_cuts[k][DCTR_N_QUANTILES - 1][1] = float("inf")
+    return w_cuts
+
+
+def load_weight_cuts(filename):
+    '''Load the DCTR weight cuts by jet multiplicity from the JSON `filename`,
+    with the upper limit of the last quantile (H) of each key set to inf.
+    The file is parsed once per process: a copy of the cached table is returned.'''
+    return copy.deepcopy(get_lookup_table("dctr_weight_cuts", filename, None, parse_weight_cuts))
+
+
+def compile_dctr_region_index(filename, key=None):
+    w_cuts = load_weight_cuts(filename)
+    return BinnedRegionIndex.from_intervals(DCTR_NJET_EDGES, [w_cuts[k] for k in DCTR_NJET_KEYS])
+
+
+def get_dctr_region_index(filename):
+    '''Get the region index of the DCTR weight cuts saved in `filename`:
+    4j: 1, 2, 3; 5j: 4, 5, 6; 6j: 7, 8, 9; >=7j: 10, 11, 12.'''
+    return get_lookup_table("dctr_region_index", filename, None, compile_dctr_region_index)
+
+
+class LookupTables:
+    '''Lookup tables of the DCTR parameters (njet reweighting and region index of the weight cuts), compiled
+    by the process creating the processor and shipped to the workers with it, so that the workers do not read the files.
+    The tables are accessed by kind: `njet_reweighting` and `dctr_region_index`.'''
+    def __init__(self, tables=None):
+        self.tables = dict(tables) if tables is not None else {}
+
+    @classmethod
+    def from_params(cls, params):
+        '''Compile the tables of the files configured in the `dctr` section of the parameters.'''
+        dctr = params.get("dctr", None)
+        if dctr is None:
+            return cls()
+        tables = {}
+        njet_reweighting = dctr.get("njet_reweighting", None)
+        if njet_reweighting is not None:
+            tables["njet_reweighting"] = get_njet_reweighting_table(njet_reweighting["file"], njet_reweighting["key"])
+        weight_cuts = dctr.get("weight_cuts", None)
+        if (weight_cuts is not None) and ("by_njet" in weight_cuts):
+            tables["dctr_region_index"] = get_dctr_region_index(weight_cuts["by_njet"]["file"])
+        return cls(tables)
+
+    def get(self, kind):
+        '''Get the table `kind`.'''
+        if kind not in self.tables:
+            raise KeyError(f"The lookup table `{kind}` is not configured in the `dctr` parameters (available: {list(self.tables)}).")
+        return self.tables[kind]
+
+    @property
+    def njet_reweighting(self):
+        return self.get("njet_reweighting")
+
+    @property
+    def dctr_region_index(self):
+        return self.get("dctr_region_index")
+
+    def __repr__(self):
+        return f"LookupTables({list(self.tables)})"
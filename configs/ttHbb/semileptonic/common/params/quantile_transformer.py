@@ -1,13 +1,212 @@
 import os
 import pickle
 import numpy as np
+import numba
+import awkward as ak
 from scipy.stats import norm
 from sklearn.base import BaseEstimator, TransformerMixin
 
+@numba.njit
+def uniform_grid_lookup(X, x_min, inv_step, grid, exact, knot_start, quantiles, reference, out):
+    '''Interpolate the values of `X` on the quantile curve with a uniform grid of cells
+    starting at `x_min` with spacing 1/`inv_step`. The cell of each value is found with index arithmetic:
+    - in the cells where the linear resampling is accurate the value is interpolated between
+      the curve values on the cell edges `grid`;
+    - in the cells flagged as `exact` the value is interpolated on the original knots, searching
+      only the knots of the cell (starting from `knot_start`), as `np.interp` does.
+    The values outside the curve are clipped to its edges.'''
+    n_cells = grid.shape[0] - 1
+    n_knots = quantiles.shape[0]
+    for i in range(X.shape[0]):
+        x = X[i]
+        if x != x:
+            out[i] = np.nan
+            continue
+        if x <= quantiles[0]:
+            out[i] = reference[0]
+            continue
+        if x >= quantiles[n_knots - 1]:
+            out[i] = reference[n_knots - 1]
+            continue
+        t = (x - x_min) * inv_step
+        k = min(int(t), n_cells - 1)
+        if not exact[k]:
+            frac = t - k
+            out[i] = grid[k] + frac * (grid[k + 1] - grid[k])
+            continue
+        # Binary search of the last knot <= x among the knots of the cell
+        lo = max(knot_start[k] - 1, 0)
+        hi = knot_start[k + 1] - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if quantiles[mid] <= x:
+                lo = mid
+            else:
+                hi = mid - 1
+        if quantiles[lo] == x:
+            out[i] = reference[lo]
+            continue
+        slope = (reference[lo + 1] - reference[lo]) / (quantiles[lo + 1] - quantiles[lo])
+        value = slope * (x - quantiles[lo]) + reference[lo]
+        if value != value:
+            # Same treatment of the non-finite reference quantiles as `np.interp`
+            value = slope * (x - quantiles[lo + 1]) + reference[lo + 1]
+            if (value != value) and (reference[lo] == reference[lo + 1]):
+                value = reference[lo]
+        out[i] = value
+
+
+@numba.njit
+def compress_centroids(means, weights, total_weight, compression):
+    '''Merge the consecutive centroids (sorted by mean) as long as the merged centroid spans
+    less than one unit of the scale function k(q) = compression/(2*pi) * arcsin(2q - 1).
+    The centroids are merged in place: the number of centroids left is returned.'''
+    n = means.shape[0]
+    if n == 0:
+        return 0
+    norm = compression / (2. * np.pi)
+    out = 0
+    cum_before = 0.
+    mean = means[0]
+    weight = weights[0]
+    k_left = norm * np.arcsin(-1.)
+    for i in range(1, n):
+        q_right = min(max((cum_before + weight + weights[i]) / total_weight, 0.), 1.)
+        if norm * np.arcsin(2. * q_right - 1.) - k_left <= 1.:
+            new_weight = weight + weights[i]
+            if new_weight != 0.:
+                mean = mean + (means[i] - mean) * weights[i] / new_weight
+            weight = new_weight
+        else:
+            means[out] = mean
+            weights[out] = weight
+            out += 1
+            cum_before += weight
+            k_left = norm * np.arcsin(2. * min(max(cum_before / total_weight, 0.), 1.) - 1.)
+            mean = means[i]
+            weight = weights[i]
+    means[out] = mean
+    weights[out] = weight
+    return out + 1
+
+
+class WeightedQuantileSketch:
+    '''Mergeable streaming sketch of the weighted quantiles of a distribution (t-digest style).
+    The values are summarised by a sorted list of centroids (mean, weight). When the buffer is full
+    the consecutive centroids are merged, with a maximum weight of each centroid of
+    `rank_error` times the total weight at the median, and smaller towards the tails:
+    this bounds the error on the rank of the quantiles, up to the overlap of the centroids
+    coming from different chunks. The memory used is of the order of 1/`rank_error` centroids,
+    independently of the number of values.
+
+    Sketches built on different chunks (e.g. by different workers) are combined with `merge` or `+`,
+    so that they can be used as accumulators in the output of the processors.
+
+    :param rank_error: target error on the rank of the quantiles (fraction of the total weight)
+    :param buffer_size: number of centroids buffered before compressing (default: 5/`rank_error`)
+    '''
+    def __init__(self, rank_error=1e-4, buffer_size=None):
+        if not 0 < rank_error < 1:
+            raise ValueError("The rank error of the quantile sketch should be in (0, 1).")
+        self.rank_error = rank_error
+        self.compression = np.pi / rank_error
+        self.buffer_size = buffer_size if buffer_size is not None else int(5 / rank_error)
+        self.means = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def total_weight(self):
+        return np.sum(self.weights)
+
+    def __len__(self):
+        return len(self.means)
+
+    def _add_centroids(self, means, weights):
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind="stable")
+        self.means = means[order]
+        self.weights = weights[order]
+        if len(self.means) > self.buffer_size:
+            self.compress()
+
+    def compress(self):
+        total_weight = self.total_weight
+        if (len(self.means) == 0) or (total_weight <= 0):
+            return self
+        n = compress_centroids(self.means, self.weights, total_weight, self.compression)
+        self.means = self.means[:n].copy()
+        self.weights = self.weights[:n].copy()
+        return self
+
+    def update(self, X, weights):
+        '''Add the values `X` with the corresponding `weights` to the sketch.'''
+        X = np.asarray(X, dtype=np.float64).ravel()
+        weights = np.asarray(weights, dtype=np.float64).ravel()
+        if len(X) != len(weights):
+            raise ValueError(f"The number of values ({len(X)}) and weights ({len(weights)}) should be the same.")
+        valid = np.isfinite(X) & np.isfinite(weights)
+        X, weights = X[valid], weights[valid]
+        if len(X) == 0:
+            return self
+        self.min = min(self.min, np.min(X))
+        self.max = max(self.max, np.max(X))
+        self._add_centroids(X, weights)
+        return self
+
+    def merge(self, other):
+        '''Merge the centroids of the sketch `other` into this sketch.'''
+        if len(other) == 0:
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._add_centroids(other.means, other.weights)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __add__(self, other):
+        result = WeightedQuantileSketch(rank_error=min(self.rank_error, other.rank_error),
+                                        buffer_size=max(self.buffer_size, other.buffer_size))
+        return result.merge(self).merge(other)
+
+    def quantiles(self, probabilities):
+        '''Get the values of the quantiles at the given `probabilities`.'''
+        self.compress()
+        if len(self.means) == 0:
+            raise ValueError("The quantiles of an empty sketch are not defined.")
+        # Each centroid is placed at the middle of its cumulative weight
+        cum_weights = np.cumsum(self.weights)
+        total_weight = cum_weights[-1]
+        positions = np.maximum.accumulate((cum_weights - 0.5 * self.weights) / total_weight)
+        positions = np.concatenate([[0.], np.clip(positions, 0., 1.), [1.]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+        return np.interp(probabilities, positions, values)
+
+
 class WeightedQuantileTransformer(BaseEstimator, TransformerMixin):
-    def __init__(self, n_quantiles=1000, output_distribution='normal'):
+    '''Quantile transformer with weighted events.
+
+    If `lookup_tolerance` is set, a lookup table on a uniform grid of `lookup_size` cells
+    (default: one cell per quantile) is built once when the quantiles are fitted or loaded,
+    and `transform` finds the cell of each value with index arithmetic instead of a binary search
+    over all the knots. In the cells where the linear resampling of the quantile curve deviates
+    by less than `lookup_tolerance` from the exact interpolation the resampled curve is used,
+    in the others the exact interpolation on the few knots of the cell.
+    With `lookup_tolerance=0` the output is the same as the exact interpolation, up to rounding.
+
+    The quantiles can be fitted on a stream of chunks that does not fit in memory:
+    see `fit` and `WeightedQuantileSketch`.
+    '''
+    def __init__(self, n_quantiles=1000, output_distribution='normal', lookup_tolerance=None, lookup_size=None, sketch_rank_error=1e-4):
         self.n_quantiles = n_quantiles
         self.output_distribution = output_distribution
+        self.sketch_rank_error = sketch_rank_error
+        self.lookup_tolerance = lookup_tolerance
+        self.lookup_size = lookup_size
     
     def save(self, filename):
         with open(filename, 'wb') as f:
@@ -18,6 +217,55 @@ class WeightedQuantileTransformer(BaseEstimator, TransformerMixin):
         if not extension == '.pkl':
             raise ValueError(f"Invalid file extension '{os.path.splitext(filename)[1]}'. Only '.pkl' files are supported.")
         self.quantiles_, self.reference_quantiles_ = np.load(filename, allow_pickle=True)
+        self.lookup_ = None
+        if self.lookup_tolerance is not None:
+            self.build_lookup(self.lookup_tolerance)
+
+    def build_lookup(self, tolerance):
+        '''Build the lookup table used by `transform`.
+        Both the quantile curve and its resampling are piecewise linear, so the maximum deviation
+        in each cell is attained on the knots of the curve, where it is evaluated exactly.'''
+        self.lookup_ = None
+        quantiles = np.ascontiguousarray(self.quantiles_, dtype=np.float64)
+        reference = np.ascontiguousarray(self.reference_quantiles_, dtype=np.float64)
+        x_min, x_max = quantiles[0], quantiles[-1]
+        if not x_max > x_min:
+            return self
+        n_cells = self.lookup_size if self.lookup_size is not None else len(quantiles)
+        inv_step = n_cells / (x_max - x_min)
+        edges = x_min + np.arange(n_cells + 1) / inv_step
+        edges[-1] = x_max
+        grid = np.interp(edges, quantiles, reference)
+
+        # Cell of each knot, computed as in the lookup, and first knot of each cell
+        t = (quantiles - x_min) * inv_step
+        knot_cell = np.minimum(t.astype(np.int64), n_cells - 1)
+        knot_start = np.searchsorted(knot_cell, np.arange(n_cells + 1), side="left")
+
+        # Deviation of the resampled curve on the knots. The non-finite reference quantiles
+        # (e.g. the edges of the normal distribution) always require the exact interpolation.
+        frac = t - knot_cell
+        with np.errstate(invalid="ignore"):
+            approx = grid[knot_cell] + frac * (grid[knot_cell + 1] - grid[knot_cell])
+            error = np.abs(approx - reference)
+        bad = ~(error <= tolerance)
+        exact = np.zeros(n_cells, dtype=bool)
+        exact[knot_cell[bad]] = True
+        # A knot on the lower edge of a cell also bounds the previous cell
+        on_edge = bad & (frac == 0) & (knot_cell > 0)
+        exact[knot_cell[on_edge] - 1] = True
+        exact |= ~np.isfinite(grid[:-1]) | ~np.isfinite(grid[1:])
+
+        self.lookup_ = {
+            "x_min": x_min,
+            "inv_step": inv_step,
+            "grid": grid,
+            "exact": exact,
+            "knot_start": knot_start,
+            "quantiles": quantiles,
+            "reference": reference,
+        }
+        return self
 
     def _weighted_quantiles(self, X, weights):
         # Calculate weighted quantiles
@@ -31,10 +279,22 @@ class WeightedQuantileTransformer(BaseEstimator, TransformerMixin):
         return quantiles
     
     def fit(self, X, y=None, sample_weight=None):
-        if sample_weight is None:
+        '''Fit the weighted quantiles. `X` can be:
+        - an array of values, with the weights in `sample_weight` (exact quantiles, all the values in memory);
+        - an iterator of (values, weights) chunks, summarised by a `WeightedQuantileSketch`
+          with rank error `sketch_rank_error`;
+        - a `WeightedQuantileSketch` already filled (e.g. merged from the outputs of several workers).'''
+        if isinstance(X, WeightedQuantileSketch):
+            self.quantiles_ = X.quantiles(np.linspace(0, 1, self.n_quantiles))
+        elif (sample_weight is None) and not isinstance(X, (np.ndarray, ak.Array)) and hasattr(X, "__iter__"):
+            sketch = WeightedQuantileSketch(rank_error=self.sketch_rank_error)
+            for X_chunk, weights_chunk in X:
+                sketch.update(X_chunk, weights_chunk)
+            self.quantiles_ = sketch.quantiles(np.linspace(0, 1, self.n_quantiles))
+        elif sample_weight is None:
             raise ValueError("Sample weights must be provided.")
-        
-        self.quantiles_ = self._weighted_quantiles(X, sample_weight)
+        else:
+            self.quantiles_ = self._weighted_quantiles(X, sample_weight)
         
         if self.output_distribution == 'normal':
             self.reference_quantiles_ = norm.ppf(np.linspace(0, 1, self.n_quantiles))
@@ -43,9 +303,62 @@ class WeightedQuantileTransformer(BaseEstimator, TransformerMixin):
         else:
             raise ValueError(f"Unknown output distribution '{self.output_distribution}'.")
         
+        self.lookup_ = None
+        if self.lookup_tolerance is not None:
+            self.build_lookup(self.lookup_tolerance)
         return self
     
     def transform(self, X):
+        lookup = getattr(self, "lookup_", None)
+        if lookup is not None:
+            X = np.asarray(X, dtype=np.float64)
+            transformed_X = np.empty(X.size, dtype=np.float64)
+            uniform_grid_lookup(np.ascontiguousarray(X).ravel(), lookup["x_min"], lookup["inv_step"], lookup["grid"], lookup["exact"],
+                                lookup["knot_start"], lookup["quantiles"], lookup["reference"], transformed_X)
+            return transformed_X.reshape(X.shape)
         # Interpolate based on weighted quantiles
         transformed_X = np.interp(X, self.quantiles_, self.reference_quantiles_)
         return transformed_X
+
+
+# Transformers loaded by the current process, keyed by (path, modification time, parameters)
+_transformers = {}
+
+def load_quantile_transformer(filename, n_quantiles, output_distribution, lookup_tolerance=None):
+    '''Get the transformer saved in `filename`. The file is read (and the lookup grid built)
+    once per process and read again only if it is modified.'''
+    key = (os.path.abspath(filename), os.stat(filename).st_mtime_ns, n_quantiles, output_distribution, lookup_tolerance)
+    if key not in _transformers:
+        transformer = WeightedQuantileTransformer(
+            n_quantiles=n_quantiles,
+            output_distribution=output_distribution,
+            lookup_tolerance=lookup_tolerance
+        )
+        transformer.load(filename)
+        _transformers[key] = transformer
+    return _transformers[key]
+
+
+def _sketch_parquet_file(filename, column, weight_column, rank_error):
+    events = ak.from_parquet(filename, columns=[column, weight_column])
+    sketch = WeightedQuantileSketch(rank_error=rank_error)
+    return sketch.update(ak.to_numpy(ak.flatten(events[column], axis=None)),
+                         ak.to_numpy(ak.flatten(events[weight_column], axis=None)))
+
+
+def sketch_from_parquet(files, column, weight_column, rank_error=1e-4, workers=1):
+    '''Build the quantile sketch of the `column` of the Parquet `files` (e.g. exported ntuples),
+    weighted by `weight_column`. The files are processed in parallel by `workers` processes
+    and the sketches are merged at the end.'''
+    from concurrent.futures import ProcessPoolExecutor
+
+    args = [(filename, column, weight_column, rank_error) for filename in files]
+    sketch = WeightedQuantileSketch(rank_error=rank_error)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for partial in pool.map(_sketch_parquet_file, *zip(*args)):
+                sketch.merge(partial)
+    else:
+        for arg in args:
+            sketch.merge(_sketch_parquet_file(*arg))
+    return sketch
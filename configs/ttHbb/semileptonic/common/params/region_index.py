@@ -0,0 +1,68 @@
+import numpy as np
+
+class BinnedRegionIndex:
+    '''Integer index of the regions defined by two binned variables: each bin of the first variable
+    (e.g. the jet multiplicity) has its own binning of the second variable (e.g. the DCTR weight).
+    The regions are numbered consecutively starting from `first_index`, bin by bin of the first variable:
+    the events outside all the regions get the index 0.
+    The bins include the lower edge and exclude the upper edge.
+
+    :param edges: edges of the bins of the first variable (the last edge can be inf)
+    :param sub_edges: list with the edges of the bins of the second variable, one for each bin of the first variable
+    :param first_index: index of the first region
+    '''
+    def __init__(self, edges, sub_edges, first_index=1):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.sub_edges = [np.asarray(e, dtype=np.float64) for e in sub_edges]
+        if len(self.sub_edges) != len(self.edges) - 1:
+            raise ValueError(f"{len(self.edges) - 1} bins of the first variable, but {len(self.sub_edges)} binnings of the second variable.")
+        for e in [self.edges, *self.sub_edges]:
+            if np.any(np.diff(e) <= 0):
+                raise ValueError(f"The bin edges should be strictly increasing: {e}")
+        n_regions = [len(e) - 1 for e in self.sub_edges]
+        self.offsets = first_index + np.concatenate([[0], np.cumsum(n_regions)[:-1]]).astype(np.int64)
+        self.n_regions = int(np.sum(n_regions))
+        self.compile()
+
+    @classmethod
+    def from_intervals(cls, edges, intervals, first_index=1):
+        '''Build the index from the list of contiguous [lo, hi] intervals of the second variable for each bin of the first variable.'''
+        sub_edges = []
+        for bin_intervals in intervals:
+            for (_, hi), (lo, _) in zip(bin_intervals[:-1], bin_intervals[1:]):
+                if hi != lo:
+                    raise ValueError(f"The intervals should be contiguous: {bin_intervals}")
+            sub_edges.append([bin_intervals[0][0]] + [hi for _, hi in bin_intervals])
+        return cls(edges, sub_edges, first_index=first_index)
+
+    def compile(self):
+        '''Build the dense table of the region index by bin of the first variable and interval of the union
+        of all the binnings of the second variable: the position of a value in the union of the edges
+        determines its position in each binning, so that the index is found with one searchsorted per variable.
+        The first and last rows of the table are the underflow and overflow of the first variable.'''
+        self.union_edges = np.unique(np.concatenate(self.sub_edges))
+        table = np.zeros((len(self.edges) + 1, len(self.union_edges) + 1), dtype=np.int64)
+        for i, sub_edges in enumerate(self.sub_edges):
+            # Position in the binning of the second variable of the values in each interval of the union of the edges
+            pos = np.searchsorted(sub_edges, self.union_edges, side="right")
+            pos = np.concatenate([[0], pos])
+            # pos = 0 below the first edge, pos = len(sub_edges) above the last edge
+            inside = (pos > 0) & (pos < len(sub_edges))
+            table[i + 1] = np.where(inside, self.offsets[i] + pos - 1, 0)
+        self.table = table
+
+    def __call__(self, x, y):
+        '''Get the region index of the events with values `x` and `y` of the two variables.'''
+        # NaN values are sorted after the last edge: they fall in the overflow of the first variable
+        # or above the last edge of the second variable
+        ibin = np.searchsorted(self.edges, np.asarray(x), side="right")
+        pos = np.searchsorted(self.union_edges, np.asarray(y), side="right")
+        return np.take(self.table.ravel(), ibin * self.table.shape[1] + pos)
+
+
+# Number of quantiles (L, M, H) of the DCTR weight for each jet multiplicity
+DCTR_N_QUANTILES = 3
+
+# Bins of jet multiplicity of the DCTR regions and corresponding keys of the weight cuts
+DCTR_NJET_EDGES = [4, 5, 6, 7, float("inf")]
+DCTR_NJET_KEYS = ["njet=4", "njet=5", "njet=6", "njet>=7"]
@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import OrderedDict
+import correctionlib
+
+# Sections of the parameters with the correctionlib files used by the custom weights, by year
+CORRECTION_PARAMETERS = [
+    "jet_scale_factors.btagSF",
+    "btagSF_calibration",
+    "btagSF_calibration_ttsplit",
+    "ttlf_calibration",
+]
+
+class CorrectionSetCache:
+    '''Cache of the correctionlib CorrectionSet objects loaded from file, shared by all the weights of the process.
+    The CorrectionSets are indexed by the absolute path and the modification time of the file,
+    so that a file modified on disk is parsed again. The number of CorrectionSets kept in memory
+    is bounded by `max_files`: when the limit is exceeded the least recently used one is dropped.
+
+    :param max_files: maximum number of CorrectionSets kept in memory (None: no limit)
+    '''
+
+    def __init__(self, max_files=16):
+        if (max_files is not None) and (max_files < 1):
+            raise ValueError("The maximum number of cached correction files should be a positive integer or None.")
+        self.max_files = max_files
+        self._csets = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # The CorrectionSets and the lock cannot be pickled: only the configuration is shipped
+        return {"max_files": self.max_files}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def get_key(path):
+        path = os.path.abspath(path)
+        return (path, os.stat(path).st_mtime_ns)
+
+    @property
+    def loaded(self):
+        return [path for path, _ in self._csets.keys()]
+
+    def get(self, path):
+        '''Get the CorrectionSet of the file `path`, parsing the file if it is not cached or if it has been modified.'''
+        key = self.get_key(path)
+        with self._lock:
+            if key in self._csets:
+                self._csets.move_to_end(key)
+                self.hits += 1
+                return self._csets[key]
+        # The file is parsed outside of the lock, so that the other threads can read the cached files
+        cset = correctionlib.CorrectionSet.from_file(key[0])
+        with self._lock:
+            self.misses += 1
+            # Drop the CorrectionSets of the previous versions of the file
+            for old_key in [k for k in self._csets if k[0] == key[0] and k != key]:
+                del self._csets[old_key]
+            cset = self._csets.setdefault(key, cset)
+            self._csets.move_to_end(key)
+            if self.max_files is not None:
+                while len(self._csets) > self.max_files:
+                    self._csets.popitem(last=False)
+            return cset
+
+    def preload(self, paths):
+        '''Load the CorrectionSets of all the files `paths`.'''
+        for path in paths:
+            self.get(path)
+
+    def clear(self):
+        with self._lock:
+            self._csets.clear()
+
+    def __repr__(self):
+        return f"CorrectionSetCache(loaded={self.loaded}, max_files={self.max_files}, hits={self.hits}, misses={self.misses})"
+
+
+# Cache shared by all the weights of the process
+_correction_cache = CorrectionSetCache()
+
+def get_correction_cache():
+    '''Get the CorrectionSet cache of the current process.'''
+    return _correction_cache
+
+
+def get_correction_set(path):
+    '''Get the CorrectionSet of the file `path` from the cache of the current process.'''
+    return _correction_cache.get(path)
+
+
+def get_correction(path, name):
+    '''Get the correction `name` of the file `path` from the cache of the current process.'''
+    return _correction_cache.get(path)[name]
+
+
+def get_correction_files(params, years=None):
+    '''Get the list of the correctionlib files of the custom weights in the parameters (sections `CORRECTION_PARAMETERS`),
+    for all the years or only for `years`.'''
+    files = []
+    for section in CORRECTION_PARAMETERS:
+        node = params
+        for key in section.split("."):
+            node = node.get(key, None) if node is not None else None
+        if node is None:
+            continue
+        for year, conf in node.items():
+            if (years is not None) and (year not in years):
+                continue
+            path = conf.get("file", None) if hasattr(conf, "get") else None
+            if (path is not None) and (path not in files):
+                files.append(path)
+    return files
@@ -1,11 +1,58 @@
 import numpy as np
 import awkward as ak
-import correctionlib
-from configs.ttHbb.semileptonic.common.cuts.custom_cut_functions import eq_genTtbarId_100
-from collections import defaultdict
+from configs.ttHbb.semileptonic.common.weights.correction_cache import get_correction
+from configs.ttHbb.semileptonic.common.workflows.ttbar_id import TTBAR_CLASSES, get_ttbar_class
 from pocket_coffea.lib.weights import WeightWrapper, WeightLambda, WeightData, WeightDataMultiVariation
 
 
+# Subsamples of the tt+jets samples with a dedicated btag calibration, indexed by the ttbar class of the events
+TTBAR_SUBSAMPLES = TTBAR_CLASSES
+
+
+def get_btag_jes_variation(variation):
+    '''Convert the name of the JES shape variation to the name of the btag SF systematic:
+    from JES_VariationUp to up_jesVariation.'''
+    if variation.startswith("JES_Total") and variation[-2:] == "Up":
+        return "up_jes"
+    elif variation.startswith("JES_Total") and variation[-4:] == "Down":
+        return "down_jes"
+    # we need to remove the possible jet type
+    variation = variation.replace("_AK4PFchs", "")
+    variation = variation.replace("_AK4PFPuppi", "")
+    if variation[-2:] == "Up":
+        return f"up_jes{variation[4:-2]}"
+    elif variation[-4:] == "Down":
+        return f"down_jes{variation[4:-4]}"
+    raise ValueError(f"The JES variation {variation} should end with `Up` or `Down`.")
+
+
+def get_btag_sf_matrix(corr, rows, flavour, abseta, pt, discr):
+    '''Matrix (n_rows, n_jets) of the per-jet btag SF for the `rows` [(systematic, mask)]: the SF of the systematic
+    is evaluated only on the jets selected by the mask (all the jets if None), the other jets take the central SF.
+    The central SF is evaluated once and shared by all the rows.'''
+    central = corr.evaluate("central", flavour, abseta, pt, discr)
+    sf = np.empty((len(rows), len(central)), dtype=np.float64)
+    sf[:] = central
+    for i, (systematic, mask) in enumerate(rows):
+        if systematic == "central":
+            continue
+        if mask is None:
+            sf[i] = corr.evaluate(systematic, flavour, abseta, pt, discr)
+        elif np.any(mask):
+            sf[i, mask] = corr.evaluate(systematic, flavour[mask], abseta[mask], pt[mask], discr[mask])
+    return sf
+
+
+def prod_by_event(values, offsets):
+    '''Product of the per-jet `values` (n_rows, n_jets) over the jets of each event, defined by the `offsets`,
+    for all the rows at once with a single `np.multiply.reduceat`. The product is 1 for the events without jets.'''
+    out = np.ones((values.shape[0], len(offsets) - 1), dtype=values.dtype)
+    nonempty = offsets[1:] > offsets[:-1]
+    if np.any(nonempty):
+        out[:, nonempty] = np.multiply.reduceat(values, offsets[:-1][nonempty], axis=1)
+    return out
+
+
 def sf_btag_withcalibration_ttsplit(events, params, sample, jets, year, njets, jetsHt, variations=["central"]):
     '''
     DeepJet (or other taggers) AK4 btagging SF.
@@ -23,22 +70,15 @@ def sf_btag_withcalibration_ttsplit(events, params, sample, jets, year, njets, j
     '''
     btagSF = params.jet_scale_factors.btagSF[year]
     btag_discriminator = params.btagging.working_point[year]["btagging_algorithm"]
-    cset = correctionlib.CorrectionSet.from_file(btagSF.file)
-    corr = cset[btagSF.name]
+    corr = get_correction(btagSF.file, btagSF.name)
 
     ttbar_sample = False
     if sample in ["TTbbSemiLeptonic", "TTToSemiLeptonic"]:
         ttbar_sample = True
-        cset_calib = correctionlib.CorrectionSet.from_file(
-            params.btagSF_calibration_ttsplit[year]["file"]
-        )
         ## CAREFUL: This is the calibration file specific for the ttbar split
-        corr_calib = cset_calib[params.btagSF_calibration_ttsplit[year]["name"]]
+        corr_calib = get_correction(params.btagSF_calibration_ttsplit[year]["file"], params.btagSF_calibration_ttsplit[year]["name"])
     else:
-        cset_calib = correctionlib.CorrectionSet.from_file(
-            params.btagSF_calibration[year]["file"]
-        )
-        corr_calib = cset_calib[params.btagSF_calibration[year]["name"]]
+        corr_calib = get_correction(params.btagSF_calibration[year]["file"], params.btagSF_calibration[year]["name"])
 
     flavour = ak.to_numpy(ak.flatten(jets.hadronFlavour))
     abseta = np.abs(ak.to_numpy(ak.flatten(jets.eta)))
@@ -46,103 +86,71 @@ def sf_btag_withcalibration_ttsplit(events, params, sample, jets, year, njets, j
     discr = ak.to_numpy(ak.flatten(jets[btag_discriminator]))
     njets = ak.to_numpy(njets)
     jetsHt = ak.to_numpy(jetsHt)
+    offsets = np.zeros(len(njets) + 1, dtype=np.int64)
+    np.cumsum(njets, out=offsets[1:])
 
-    central_SF_byjet = corr.evaluate("central", flavour, abseta, pt, discr)
-
-
-    def _get_sf_variation_with_mask(variation, mask):
-        index = (np.indices(discr.shape)).flatten()[mask]
-        # Copying the central SF
-        sf = np.copy(central_SF_byjet)
-        w = corr.evaluate(variation, flavour[mask], abseta[mask], pt[mask], discr[mask])
-        sf[index] = w
-        sf_out = ak.prod(ak.unflatten(sf, njets), axis=1)
-        return sf_out
-
-    output = {}
+    # Rows of the matrix of the per-jet SF: (output variation, index in the output list, btag systematic, jets affected)
+    c_mask = flavour == 4
+    notc_mask = ~c_mask
+    rows = []
     for variation in variations:
         if variation == "central":
-            output[variation] = [ak.prod(ak.unflatten(central_SF_byjet, njets), axis=1)]
+            rows.append(("central", 0, "central", None))
+        elif "cferr" in variation:
+            # Computing the scale factor only on c-flavour jets
+            rows.append((variation, 1, f"up_{variation}", c_mask))
+            rows.append((variation, 2, f"down_{variation}", c_mask))
+        elif variation.startswith("JES") and "AK4" in variation:
+            # This is a special case where a dedicate btagSF is computed for up and down Jes shape variations.
+            # This is not an up/down variation, but a single modified SF.
+            # N.B: It is a central SF
+            rows.append(("central", 0, get_btag_jes_variation(variation), notc_mask))
+        else:
+            # Computing the scale factor only NON c-flavour jets
+            rows.append((variation, 1, f"up_{variation}", notc_mask))
+            rows.append((variation, 2, f"down_{variation}", notc_mask))
+
+    sf_byevent = prod_by_event(
+        get_btag_sf_matrix(corr, [(systematic, mask) for _, _, systematic, mask in rows], flavour, abseta, pt, discr),
+        offsets
+    )
+    output = {}
+    for (variation, position, _, _), sf in zip(rows, sf_byevent):
+        if variation == "central":
+            output[variation] = [sf]
         else:
             # Nominal sf==1
-            nominal = np.ones(ak.num(njets, axis=0))
-            # Systematic variations
-            if "cferr" in variation:
-                # Computing the scale factor only on c-flavour jets
-                c_mask = flavour == 4
-                output[variation] = [
-                    nominal,
-                    _get_sf_variation_with_mask(f"up_{variation}", c_mask),
-                    _get_sf_variation_with_mask(f"down_{variation}", c_mask),
-                ]
-
-            elif variation.startswith("JES") and "AK4" in variation:
-                # We need to convert the name of the variation
-                # from JES_VariationUp to  up_jesVariation
-                if variation.startswith("JES_Total") and variation[-2:] == "Up":
-                    btag_jes_var = "up_jes"
-                elif variation.startswith("JES_Total") and variation[-4:] == "Down":
-                    btag_jes_var = "down_jes"
-                else:
-                    # we need to remove the possible jet type
-                    variation = variation.replace("_AK4PFchs", "")
-                    variation = variation.replace("_AK4PFPuppi", "")
-                    if variation[-2:] == "Up":
-                        btag_jes_var = f"up_jes{variation[4:-2]}"
-                    elif variation[-4:] == "Down":
-                        btag_jes_var = f"down_jes{variation[4:-4]}"
-                # This is a special case where a dedicate btagSF is computed for up and down Jes shape variations.
-                # This is not an up/down variation, but a single modified SF.
-                # N.B: It is a central SF
-                notc_mask = flavour != 4
-                output["central"] = [_get_sf_variation_with_mask(btag_jes_var, notc_mask)]
-            else:
-                # Computing the scale factor only NON c-flavour jets
-                notc_mask = flavour != 4
-                output[variation] = [
-                    nominal,
-                    _get_sf_variation_with_mask(f"up_{variation}", notc_mask),
-                    _get_sf_variation_with_mask(f"down_{variation}", notc_mask),
-                ]
+            output.setdefault(variation, [np.ones(len(njets)), None, None])[position] = sf
     # now multiplying by the calibration
     output_final = {}
 
     if ttbar_sample:
-        # need to split events in ttbar parts
-        lf_mask = eq_genTtbarId_100(events, params={"genTtbarId": [0]}, year=year, sample=sample)
-        cc_mask = eq_genTtbarId_100(events, params={"genTtbarId": [41, 42, 43, 44, 45, 46]}, year=year, sample=sample)
-        bb_mask = eq_genTtbarId_100(events, params={"genTtbarId": [51, 52, 53, 54, 55, 56]}, year=year, sample=sample)
-
-        output_by_flavour = defaultdict(dict)
-        subsamples = ["tt+LF", "tt+C", "tt+B"]
+        # need to split events in ttbar parts: the events are partitioned once in tt+LF, tt+C, tt+B
+        # and the calibration of each subsample is evaluated only on its own events.
+        # The events not belonging to any of the subsamples get a null weight.
+        ttbar_class = get_ttbar_class(events)
+        partitions = [
+            (subsample, np.flatnonzero(ttbar_class == i)) for i, subsample in enumerate(TTBAR_SUBSAMPLES)
+        ]
+
+        def _calibrate(sf, calib_variation):
+            sf = np.asarray(sf)
+            out = np.zeros(len(njets), dtype=np.float64)
+            for subsample, index in partitions:
+                if len(index) == 0:
+                    continue
+                out[index] = sf[index] * corr_calib.evaluate(f"{sample}__{sample}_{subsample}", calib_variation,
+                                                             njets[index], jetsHt[index])
+            return out
 
         for var, sf in output.items():
-            if var =="central":
-                for subsample in subsamples:
-                    output_by_flavour[subsample][var] = [sf[0]*corr_calib.evaluate(f"{sample}__{sample}_{subsample}",
-                                                                "nominal",
-                                                                njets, jetsHt)]
-
-            else:
-                for subsample in subsamples:
-                    output_by_flavour[subsample][var] = [
-                        sf[0], #nominal
-                        sf[1] * corr_calib.evaluate(f"{sample}__{sample}_{subsample}", f"sf_btag_{var}Up",njets, jetsHt), #up
-                        sf[2] * corr_calib.evaluate(f"{sample}__{sample}_{subsample}", f"sf_btag_{var}Down", njets, jetsHt) #down
-                    ]
-
-        # Now using the maskes
-        for var in output:
             if var == "central":
-                output_final[var] = [lf_mask*output_by_flavour["tt+LF"][var][0] + 
-                                     cc_mask*output_by_flavour["tt+C"][var][0] + 
-                                     bb_mask*output_by_flavour["tt+B"][var][0]]
-
+                output_final[var] = [_calibrate(sf[0], "nominal")]
             else:
                 output_final[var] = [
                     sf[0], #nominal
-                    lf_mask*output_by_flavour["tt+LF"][var][1] + cc_mask*output_by_flavour["tt+C"][var][1] + bb_mask*output_by_flavour["tt+B"][var][1],
-                    lf_mask*output_by_flavour["tt+LF"][var][2] + cc_mask*output_by_flavour["tt+C"][var][2] + bb_mask*output_by_flavour["tt+B"][var][2]
+                    _calibrate(sf[1], f"sf_btag_{var}Up"), #up
+                    _calibrate(sf[2], f"sf_btag_{var}Down") #down
                 ]
     else:
         for var, sf in output.items():
@@ -1,27 +1,23 @@
-import yaml
 import numpy as np
 import awkward as ak
-import correctionlib
 from pocket_coffea.lib.weights.weights import WeightLambda, WeightWrapper, WeightData
 from pocket_coffea.lib.scale_factors import sf_L1prefiring
+from configs.ttHbb.semileptonic.common.weights.correction_cache import get_correction
+from configs.ttHbb.semileptonic.common.weights.weight_cache import ShapeInvariantWeight, cache_shape_invariant
+from configs.ttHbb.semileptonic.common.workflows.genpart_index import SAMPLES_TOP
 
-samples_top = ["TTbbSemiLeptonic", "TTToSemiLeptonic", "TTTo2L2Nu"]
+samples_top = SAMPLES_TOP
 
-SF_top_pt = WeightLambda.wrap_func(
-    name="sf_top_pt",
-    function=lambda params, metadata, events, size, shape_variations:
-            get_sf_top_pt(events, metadata),
-    has_variations=False
-    )
 
 def get_sf_top_pt(events, metadata):
+    '''Top pT reweighting from the pT of the last copy of the top and anti-top quarks (`top_pt`, `antitop_pt`),
+    computed by the processor from its GenPart index (see `GenPartIndexMixin.compute_top_pt`).'''
     if metadata["sample"] in samples_top:
         #print("Computing top pt reweighting for sample: ", metadata["sample"])
-        part = events.GenPart
-        part = part[~ak.is_none(part.parent, axis=1)]
-        part = part[part.hasFlags("isLastCopy")]
-        part = part[abs(part.pdgId) == 6]
-        part = part[ak.argsort(part.pdgId, ascending=False)]
+        if ("top_pt" not in events.fields) or ("antitop_pt" not in events.fields):
+            raise KeyError(f"The top pT reweighting requires the columns `top_pt` and `antitop_pt`, not computed by the workflow for sample {metadata['sample']}.")
+        top_pt = ak.to_numpy(events.top_pt)
+        antitop_pt = ak.to_numpy(events.antitop_pt)
 
         arg = {
             "a": 0.103,
@@ -29,36 +25,40 @@ def get_sf_top_pt(events, metadata):
             "c": -0.000134,
             "d": 0.973
         }
-        top_weight = arg["a"] * np.exp(arg["b"] * part.pt[:,0]) + arg["c"] * part.pt[:,0] + arg["d"]
-        antitop_weight = arg["a"] * np.exp(arg["b"] * part.pt[:,1]) + arg["c"] * part.pt[:,1] + arg["d"]
-        weight = np.sqrt(ak.prod([top_weight, antitop_weight], axis=0))
-        # for i in range(10):
-            # print("Top pt: {},   Top SF: {},   AntiTop pt :  {},   AntiTop SF: {}".format(part.pt[i,0], top_weight[i], part.pt[i,1], antitop_weight[i]))
-        return weight#, np.zeros(np.shape(weight)), ak.copy(weight)
+        top_weight = arg["a"] * np.exp(arg["b"] * top_pt) + arg["c"] * top_pt + arg["d"]
+        antitop_weight = arg["a"] * np.exp(arg["b"] * antitop_pt) + arg["c"] * antitop_pt + arg["d"]
+        weight = np.sqrt(top_weight * antitop_weight)
+        return weight
     else:
         return np.ones(len(events), dtype=np.float64)
 
+class SF_top_pt(ShapeInvariantWeight, WeightWrapper):
+    '''Top pT reweighting of the tt samples. It is a generator-level weight:
+    it is computed for the nominal shape variation and reused for the other shape variations.'''
+    name = "sf_top_pt"
+    has_variations = False
+
+    @cache_shape_invariant
+    def compute(self, events, size, shape_variation):
+        return WeightData(
+            name = self.name,
+            nominal = get_sf_top_pt(events, self._metadata)
+        )
+
 def sf_ttlf_calib(params, sample, year, njets, jetsHt):
     '''Correction to tt+LF background computed by correcting tt+LF to data minus the other backgrounds in 2D:
     njets-JetsHT bins. Each year has a different correction stored in the correctionlib format.'''
     assert sample == "TTToSemiLeptonic", "This weight is only for TTToSemiLeptonic sample"
-    cset = correctionlib.CorrectionSet.from_file(
-        params.ttlf_calibration[year]["file"]
-    )
-    corr = cset[params.ttlf_calibration[year]["name"]]
+    corr = get_correction(params.ttlf_calibration[year]["file"], params.ttlf_calibration[year]["name"])
     w = corr.evaluate(ak.to_numpy(njets), ak.to_numpy(jetsHt))
     return w
 
-def get_njet_reweighting(events, reweighting_map_njet, mask=None):
-    njet = ak.num(events.JetGood)
-    w_nj = np.ones(len(events))
-    if mask is None:
-        mask = np.ones(len(events), dtype=bool)
-    for nj in range(4,7):
-        mask_nj = (njet == nj)
-        w_nj = np.where(mask & mask_nj, reweighting_map_njet[nj], w_nj)
-    for nj in range(7,21):
-        w_nj = np.where(mask & (njet >= 7), reweighting_map_njet[nj], w_nj)
+def get_njet_reweighting(events, njet_table, mask=None):
+    '''Weight of the njet reweighting from the table of the weights by jet multiplicity (see `NjetLookupTable`).
+    The events outside `mask` get a weight of 1.'''
+    w_nj = njet_table(ak.to_numpy(ak.num(events.JetGood)))
+    if mask is not None:
+        w_nj = np.where(mask, w_nj, 1.)
     return w_nj
 
 DCTR_weight = WeightLambda.wrap_func(
@@ -68,7 +68,7 @@ DCTR_weight = WeightLambda.wrap_func(
     has_variations=False
     )
 
-class SF_ttlf_calib(WeightWrapper):
+class SF_ttlf_calib(ShapeInvariantWeight, WeightWrapper):
     name = "sf_ttlf_calib"
     has_variations = False
 
@@ -76,6 +76,11 @@ class SF_ttlf_calib(WeightWrapper):
         super().__init__(params, metadata)
         self.jet_coll = "JetGood"
 
+    def cache_inputs(self, events):
+        # The correction depends on the shape variation only through the number of jets and HT
+        return [events[f"n{self.jet_coll}"], ak.sum(events[self.jet_coll].pt, axis=1)]
+
+    @cache_shape_invariant
     def compute(self, events, size, shape_variation):
         jetsHt = ak.sum(events[self.jet_coll].pt, axis=1)
         out = sf_ttlf_calib(self._params,
@@ -92,22 +97,27 @@ class SF_ttlf_calib(WeightWrapper):
             #down = out[2]
             )
 
-class SF_njet_reweighting(WeightWrapper):
+class SF_njet_reweighting(ShapeInvariantWeight, WeightWrapper):
     '''Correction to tt+bb background computed to match data/MC in the number of jets.
-    The corection applied during training of the DCTR model is stored in a yaml file.'''
+    The corection applied during training of the DCTR model is stored in a yaml file: the table compiled from it
+    is shipped to the workers with the processor and passed to the weight in the metadata of the chunk (`lookup_tables`).'''
     name = "sf_njet_reweighting"
     has_variations = False
 
     def __init__(self, params, metadata):
         super().__init__(params, metadata)
         assert metadata["sample"] == "TTbbSemiLeptonic", "This weight is only for TTbbSemiLeptonic sample"
-        params_njet_reweighting = params.dctr["njet_reweighting"]
-        file, key = params_njet_reweighting["file"], params_njet_reweighting["key"]
-        with open(file, "r") as f:
-            self.reweighting_map_njet = yaml.safe_load(f)[key]
+        if "lookup_tables" not in metadata:
+            raise KeyError("The njet reweighting requires the lookup tables of the processor (see `DCTRInferenceProcessor`) in the metadata of the chunk.")
+        self.njet_table = metadata["lookup_tables"].njet_reweighting
+
+    def cache_inputs(self, events):
+        # The correction depends on the shape variation only through the number of jets
+        return [ak.num(events.JetGood)]
 
+    @cache_shape_invariant
     def compute(self, events, size, shape_variation):
-        out = get_njet_reweighting(events, self.reweighting_map_njet)
+        out = get_njet_reweighting(events, self.njet_table)
         return WeightData(
             name = self.name,
             nominal = out
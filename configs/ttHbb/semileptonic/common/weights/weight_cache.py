@@ -0,0 +1,127 @@
+import functools
+import numpy as np
+import awkward as ak
+from pocket_coffea.lib.weights.weights import WeightData, WeightDataMultiVariation
+from configs.ttHbb.semileptonic.common.workflows.feature_store import get_event_ids
+
+
+def _duplicated(sorted_ids):
+    '''Mask of the identifiers of the sorted array `sorted_ids` appearing more than once.'''
+    same = sorted_ids[1:] == sorted_ids[:-1]
+    duplicated = np.zeros(len(sorted_ids), dtype=bool)
+    duplicated[1:] |= same
+    duplicated[:-1] |= same
+    return duplicated
+
+
+def _weight_arrays(out):
+    '''Flat list of the arrays of a WeightData or WeightDataMultiVariation object.'''
+    if isinstance(out, WeightData):
+        return [out.nominal, out.up, out.down]
+    return [out.nominal, *out.up, *(out.down if out.down is not None else [])]
+
+
+def _with_weight_arrays(out, arrays):
+    '''Copy of the WeightData or WeightDataMultiVariation object `out` with the arrays replaced by `arrays`.'''
+    if isinstance(out, WeightData):
+        return WeightData(out.name, *arrays)
+    nvariations = len(out.variations)
+    return WeightDataMultiVariation(
+        name=out.name,
+        nominal=arrays[0],
+        variations=out.variations,
+        up=arrays[1:1 + nvariations],
+        down=arrays[1 + nvariations:] if out.down is not None else None,
+    )
+
+
+def _merge(cached, positions, reuse, new):
+    '''Arrays of the current events: the events with `reuse` take the cached values at `positions`,
+    the other events take the `new` values computed for them (in order).'''
+    merged = []
+    for cached_array, new_array in zip(cached, new):
+        if cached_array is None:
+            merged.append(None)
+            continue
+        cached_array = np.asarray(cached_array)
+        array = np.empty(len(reuse), dtype=cached_array.dtype if new_array is None else np.result_type(cached_array, np.asarray(new_array)))
+        array[reuse] = cached_array[positions[reuse]]
+        if new_array is not None:
+            array[~reuse] = np.asarray(new_array)
+        merged.append(array)
+    return merged
+
+
+class ShapeInvariantCache:
+    '''Result of a weight for the events of the nominal shape variation and the inputs it was computed from.'''
+    def __init__(self, event_ids, inputs, out):
+        self.order = np.argsort(event_ids, kind="stable")
+        self.sorted_ids = event_ids[self.order]
+        # The events whose identifier is not unique in the chunk cannot be matched to the nominal ones
+        self.ambiguous = _duplicated(self.sorted_ids)
+        self.inputs = inputs
+        self.out = out
+        self.arrays = [None if array is None else np.asarray(array) for array in _weight_arrays(out)]
+
+    def lookup(self, event_ids, inputs):
+        '''Position in the cached events of the `event_ids` and mask of the events whose inputs are unchanged.
+        The events with an identifier that is not unique, among the cached or the current events, are never reused.'''
+        if len(self.sorted_ids) == 0:
+            return np.zeros(len(event_ids), dtype=np.int64), np.zeros(len(event_ids), dtype=bool)
+        found = np.searchsorted(self.sorted_ids, event_ids)
+        found = np.minimum(found, len(self.sorted_ids) - 1)
+        reuse = (self.sorted_ids[found] == event_ids) & ~self.ambiguous[found]
+        order = np.argsort(event_ids, kind="stable")
+        duplicated = np.empty(len(event_ids), dtype=bool)
+        duplicated[order] = _duplicated(event_ids[order])
+        reuse &= ~duplicated
+        positions = self.order[found]
+        for cached, current in zip(self.inputs, inputs):
+            reuse &= cached[positions] == current
+        return positions, reuse
+
+
+def cache_shape_invariant(compute):
+    '''Decorator of the `compute` method of a WeightWrapper whose output only depends on the event and on the inputs
+    returned by its `cache_inputs(events)` method (a list of arrays with one value per event, empty for the
+    generator-level weights), and not on the shape variation otherwise.
+    The output computed for the nominal shape variation is cached in the weight object, that is created for each chunk.
+    For the other shape variations, the cached values are reused for the events found in the cache (by run,
+    luminosity block and event number) with unchanged inputs, and the weight is computed only for the other events
+    (including the events whose identifier is not unique in the chunk).'''
+    @functools.wraps(compute)
+    def wrapper(self, events, size, shape_variation):
+        event_ids = get_event_ids(events)
+        inputs = [np.asarray(ak.to_numpy(value)) for value in self.cache_inputs(events)]
+        cache = getattr(self, "_shape_invariant_cache", None)
+        if shape_variation == "nominal" or cache is None:
+            out = compute(self, events, size, shape_variation)
+            if shape_variation == "nominal":
+                self._shape_invariant_cache = ShapeInvariantCache(event_ids, inputs, out)
+            return out
+
+        positions, reuse = cache.lookup(event_ids, inputs)
+        self.cache_stats["reused"] += int(np.sum(reuse))
+        self.cache_stats["computed"] += int(np.sum(~reuse))
+        if np.all(reuse):
+            new = [None] * len(cache.arrays)
+        else:
+            new = _weight_arrays(compute(self, events[~reuse], int(np.sum(~reuse)), shape_variation))
+        return _with_weight_arrays(cache.out, _merge(cache.arrays, positions, reuse, new))
+    return wrapper
+
+
+class ShapeInvariantWeight:
+    '''Mixin of the WeightWrapper classes whose output does not depend on the shape variation other than
+    through the inputs declared by `cache_inputs`: the `compute` method has to be decorated with `cache_shape_invariant`.
+    `cache_stats` counts the events of the shape variations taking the cached nominal values or recomputed.'''
+    def cache_inputs(self, events):
+        '''Inputs of the weight that can change with the shape variation (e.g. number of jets and HT):
+        list of arrays with one value per event. By default the weight depends only on the event.'''
+        return []
+
+    @property
+    def cache_stats(self):
+        if "_cache_stats" not in self.__dict__:
+            self._cache_stats = {"reused": 0, "computed": 0}
+        return self._cache_stats
@@ -0,0 +1,143 @@
+import numpy as np
+import awkward as ak
+import numba
+
+from .record_fields import get_flat_fields
+
+# Observables of the b-jet pairs computed by `compute_bjet_pair_observables`, one value per event
+BJET_PAIR_OBSERVABLES = [
+    "deltaRbb_min",
+    "deltaEtabb_min",
+    "deltaPhibb_min",
+    "mbb_closest",
+    "mbb_min",
+    "mbb_max",
+    "deltaRbb_avg",
+    "ptbb_closest",
+    "htbb_closest",
+]
+
+@numba.njit
+def fill_bjet_pair_observables(offsets, pt, eta, phi, mass, observables, pair_offsets, pair_dr, pair_mass):
+    '''
+    Compute the observables of the b-jet pairs with a single loop over the unique pairs (i < j) of each event.
+    - offsets, pt, eta, phi, mass: offsets and flat content of the b-jet collection
+    - observables (nevents, 9): output, in the order of `BJET_PAIR_OBSERVABLES`.
+      The minimum deltaR, deltaEta and deltaPhi are computed only over the positive values, as the
+      `metric_table` with the `> 0` selection: they are left to inf if there is no positive value.
+    - pair_offsets: offsets of the pairs of each event, n*(n-1)/2 pairs for n b-jets
+    - pair_dr, pair_mass: output, deltaR and invariant mass of all the pairs sorted by increasing deltaR
+      (the pairs with the same deltaR keep the order of `ak.argcombinations`)
+    The events without pairs have NaN observables.
+    '''
+    nevents = offsets.shape[0] - 1
+    for iev in range(nevents):
+        start = offsets[iev]
+        n = offsets[iev + 1] - start
+        pstart = pair_offsets[iev]
+        npairs = pair_offsets[iev + 1] - pstart
+        dr_min = np.inf
+        deta_min = np.inf
+        dphi_min = np.inf
+        dr_closest = np.inf
+        dr_sum = 0.
+        mbb_min = np.inf
+        mbb_max = -np.inf
+        mbb_closest = np.nan
+        ptbb_closest = np.nan
+        htbb_closest = np.nan
+        ipair = 0
+        for i in range(n):
+            pt1 = pt[start + i]
+            px1 = pt1 * np.cos(phi[start + i])
+            py1 = pt1 * np.sin(phi[start + i])
+            pz1 = pt1 * np.sinh(eta[start + i])
+            e1 = np.sqrt(px1 * px1 + py1 * py1 + pz1 * pz1 + mass[start + i] * mass[start + i])
+            for j in range(i + 1, n):
+                pt2 = pt[start + j]
+                px2 = pt2 * np.cos(phi[start + j])
+                py2 = pt2 * np.sin(phi[start + j])
+                pz2 = pt2 * np.sinh(eta[start + j])
+                e2 = np.sqrt(px2 * px2 + py2 * py2 + pz2 * pz2 + mass[start + j] * mass[start + j])
+
+                deta = abs(eta[start + i] - eta[start + j])
+                dphi = abs((phi[start + i] - phi[start + j] + np.pi) % (2 * np.pi) - np.pi)
+                dr = np.sqrt(deta * deta + dphi * dphi)
+
+                px = px1 + px2
+                py = py1 + py2
+                pz = pz1 + pz2
+                e = e1 + e2
+                m2 = e * e - px * px - py * py - pz * pz
+                mbb = np.sqrt(m2) if m2 > 0. else 0.
+
+                if (dr > 0.) and (dr < dr_min):
+                    dr_min = dr
+                if (deta > 0.) and (deta < deta_min):
+                    deta_min = deta
+                if (dphi > 0.) and (dphi < dphi_min):
+                    dphi_min = dphi
+                if dr < dr_closest:
+                    dr_closest = dr
+                    mbb_closest = mbb
+                    ptbb_closest = np.sqrt(px * px + py * py)
+                    htbb_closest = pt1 + pt2
+                dr_sum += dr
+                mbb_min = min(mbb_min, mbb)
+                mbb_max = max(mbb_max, mbb)
+
+                # Insertion of the pair in the list sorted by deltaR (stable)
+                k = ipair
+                while (k > 0) and (pair_dr[pstart + k - 1] > dr):
+                    pair_dr[pstart + k] = pair_dr[pstart + k - 1]
+                    pair_mass[pstart + k] = pair_mass[pstart + k - 1]
+                    k -= 1
+                pair_dr[pstart + k] = dr
+                pair_mass[pstart + k] = mbb
+                ipair += 1
+
+        if npairs == 0:
+            mbb_min = np.nan
+            mbb_max = np.nan
+        observables[iev, 0] = dr_min
+        observables[iev, 1] = deta_min
+        observables[iev, 2] = dphi_min
+        observables[iev, 3] = mbb_closest
+        observables[iev, 4] = mbb_min
+        observables[iev, 5] = mbb_max
+        observables[iev, 6] = dr_sum / npairs if npairs > 0 else np.nan
+        observables[iev, 7] = ptbb_closest
+        observables[iev, 8] = htbb_closest
+
+
+def compute_bjet_pair_observables(bjets, with_pairs=False):
+    '''Compute the observables of the b-jet pairs of the collection `bjets` (e.g. `BJetGood`) with a single compiled pass:
+    the minimum deltaR, deltaEta and deltaPhi of all the pairs, the invariant mass, pT and HT of the closest pair,
+    the minimum and maximum invariant mass and the average deltaR of all the pairs.
+    If `with_pairs` is True, the invariant mass of all the pairs sorted by deltaR (`mbb`) is also returned.
+    Returns a dictionary {name: array}, with None for the events without b-jet pairs.'''
+    offsets, (pt, eta, phi, mass) = get_flat_fields(bjets, ["pt", "eta", "phi", "mass"])
+    nevents = len(offsets) - 1
+    njets = np.diff(offsets)
+    npairs = njets * (njets - 1) // 2
+    pair_offsets = np.zeros(nevents + 1, dtype=np.int64)
+    np.cumsum(npairs, out=pair_offsets[1:])
+
+    observables = np.empty((nevents, len(BJET_PAIR_OBSERVABLES)), dtype=np.float64)
+    pair_dr = np.empty(pair_offsets[-1], dtype=np.float64)
+    pair_mass = np.empty(pair_offsets[-1], dtype=np.float64)
+    fill_bjet_pair_observables(
+        offsets,
+        pt.astype(np.float64), eta.astype(np.float64), phi.astype(np.float64), mass.astype(np.float64),
+        observables, pair_offsets, pair_dr, pair_mass
+    )
+
+    # The minimum of the positive deltaR, deltaEta, deltaPhi is not defined if there is no positive value (inf)
+    valid = ~np.isinf(observables) & (npairs > 0)[:, None]
+    output = {
+        name: ak.mask(ak.Array(np.ascontiguousarray(observables[:, i])), valid[:, i])
+        for i, name in enumerate(BJET_PAIR_OBSERVABLES)
+    }
+    if with_pairs:
+        output["mbb"] = ak.unflatten(pair_mass, npairs)
+    return output
@@ -0,0 +1,240 @@
+import numpy as np
+import awkward as ak
+import numba
+
+from .record_fields import get_flat_fields
+
+MATCHING_METHODS = ["greedy", "hungarian"]
+
+@numba.njit
+def _delta_r(eta1, phi1, eta2, phi2, pi, twopi):
+    # Same operations as the `delta_r` of the coffea vector behaviours, in the precision of the inputs:
+    # the constants `pi` and `twopi` are given with the dtype of the inputs
+    deta = eta1 - eta2
+    dphi = (phi1 - phi2 + pi) % twopi - pi
+    return np.sqrt(dphi * dphi + deta * deta)
+
+
+@numba.njit
+def match_greedy(offsets1, eta1, phi1, offsets2, eta2, phi2, dr_min, pi, twopi, idx_out, dr_out):
+    '''
+    Unique deltaR matching of the objects of the first collection to the objects of the second collection,
+    taking the pairs by increasing deltaR, as `object_matching` of PocketCoffea.
+    - offsets1, eta1, phi1: offsets and flat content of the first collection (e.g. partons)
+    - offsets2, eta2, phi2: offsets and flat content of the second collection (e.g. jets)
+    - dr_min: maximum deltaR (excluded) of the matched pairs, with the dtype of the inputs
+    - idx_out: output, index in the event of the object of the first collection matched to each object
+      of the second collection (same length as `eta2`), -1 if not matched
+    - dr_out: output, deltaR of the matched pairs (same length as `eta2`)
+    Only the pairs with deltaR < dr_min are sorted: the pairs above the cut come after them in the deltaR ordering
+    and cannot change the matching. The pairs with the same deltaR keep the order of `ak.argcartesian`.
+    The pairs with NaN deltaR come first in the `ak.argsort` ordering: as in the original matching, they take
+    their objects before all the other pairs, but they are never matched.
+    '''
+    nevents = offsets1.shape[0] - 1
+    max_pairs = 0
+    max_objects = 0
+    for iev in range(nevents):
+        n1 = offsets1[iev + 1] - offsets1[iev]
+        n2 = offsets2[iev + 1] - offsets2[iev]
+        max_pairs = max(max_pairs, n1 * n2)
+        max_objects = max(max_objects, n1, n2)
+    pair_dr = np.empty(max_pairs, dtype=dr_out.dtype)
+    pair_i = np.empty(max_pairs, dtype=np.int64)
+    pair_j = np.empty(max_pairs, dtype=np.int64)
+    taken1 = np.empty(max_objects, dtype=np.bool_)
+    taken2 = np.empty(max_objects, dtype=np.bool_)
+
+    for iev in range(nevents):
+        start1 = offsets1[iev]
+        n1 = offsets1[iev + 1] - start1
+        start2 = offsets2[iev]
+        n2 = offsets2[iev + 1] - start2
+        idx_out[start2:start2 + n2] = -1
+        taken1[:n1] = False
+        taken2[:n2] = False
+        npairs = 0
+        for i in range(n1):
+            for j in range(n2):
+                dr = _delta_r(eta1[start1 + i], phi1[start1 + i], eta2[start2 + j], phi2[start2 + j], pi, twopi)
+                if np.isnan(dr):
+                    if not (taken1[i] or taken2[j]):
+                        taken1[i] = True
+                        taken2[j] = True
+                    continue
+                if not (dr < dr_min):
+                    continue
+                # Insertion of the pair in the list sorted by deltaR (stable)
+                k = npairs
+                while (k > 0) and (pair_dr[k - 1] > dr):
+                    pair_dr[k] = pair_dr[k - 1]
+                    pair_i[k] = pair_i[k - 1]
+                    pair_j[k] = pair_j[k - 1]
+                    k -= 1
+                pair_dr[k] = dr
+                pair_i[k] = i
+                pair_j[k] = j
+                npairs += 1
+
+        for k in range(npairs):
+            i = pair_i[k]
+            j = pair_j[k]
+            if not (taken1[i] or taken2[j]):
+                taken1[i] = True
+                taken2[j] = True
+                idx_out[start2 + j] = i
+                dr_out[start2 + j] = pair_dr[k]
+
+
+@numba.njit
+def _assign_hungarian(cost, n, m, u, v, p, way, minv, used, assignment):
+    # Shortest augmenting path algorithm for the rectangular assignment problem (n <= m) minimising the total cost.
+    # The arrays are 1-indexed as in the textbook formulation: p[j] is the row assigned to the column j.
+    u[:n + 1] = 0.
+    v[:m + 1] = 0.
+    p[:m + 1] = 0
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv[:m + 1] = np.inf
+        used[:m + 1] = False
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = np.inf
+            j1 = 0
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = cost[i0 - 1, j - 1] - u[i0] - v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+    for j in range(1, m + 1):
+        if p[j] != 0:
+            assignment[p[j] - 1] = j - 1
+
+
+@numba.njit
+def match_hungarian(offsets1, eta1, phi1, offsets2, eta2, phi2, dr_min, pi, twopi, idx_out, dr_out):
+    '''
+    Optimal unique deltaR matching of the objects of the first collection to the objects of the second collection:
+    the number of matched pairs with deltaR < dr_min is maximised and, among these assignments, the sum of their deltaR
+    is minimised. Same inputs and outputs as `match_greedy`.
+    '''
+    nevents = offsets1.shape[0] - 1
+    nmax = 0
+    for iev in range(nevents):
+        nmax = max(nmax, offsets1[iev + 1] - offsets1[iev], offsets2[iev + 1] - offsets2[iev])
+    cost = np.empty((nmax, nmax), dtype=np.float64)
+    pair_dr = np.empty((nmax, nmax), dtype=dr_out.dtype)
+    u = np.empty(nmax + 1, dtype=np.float64)
+    v = np.empty(nmax + 1, dtype=np.float64)
+    minv = np.empty(nmax + 1, dtype=np.float64)
+    p = np.empty(nmax + 1, dtype=np.int64)
+    way = np.zeros(nmax + 1, dtype=np.int64)
+    used = np.empty(nmax + 1, dtype=np.bool_)
+    assignment = np.empty(nmax, dtype=np.int64)
+
+    for iev in range(nevents):
+        start1 = offsets1[iev]
+        n1 = offsets1[iev + 1] - start1
+        start2 = offsets2[iev]
+        n2 = offsets2[iev + 1] - start2
+        idx_out[start2:start2 + n2] = -1
+        if n1 == 0 or n2 == 0:
+            continue
+        max_allowed = -1.
+        for i in range(n1):
+            for j in range(n2):
+                dr = _delta_r(eta1[start1 + i], phi1[start1 + i], eta2[start2 + j], phi2[start2 + j], pi, twopi)
+                pair_dr[i, j] = dr
+                if dr < dr_min:
+                    max_allowed = max(max_allowed, float(dr))
+        if max_allowed < 0.:
+            continue
+        # The forbidden pairs cost more than any assignment of allowed pairs,
+        # so that the number of matched pairs is maximised first
+        forbidden = 1. + min(n1, n2) * max_allowed
+        for i in range(n1):
+            for j in range(n2):
+                cost[i, j] = pair_dr[i, j] if pair_dr[i, j] < dr_min else forbidden
+        # The algorithm needs rows <= columns: transpose the problem if there are more objects in the first collection
+        if n1 <= n2:
+            _assign_hungarian(cost, n1, n2, u, v, p, way, minv, used, assignment)
+            for i in range(n1):
+                j = assignment[i]
+                if pair_dr[i, j] < dr_min:
+                    idx_out[start2 + j] = i
+                    dr_out[start2 + j] = pair_dr[i, j]
+        else:
+            cost_t = cost[:n1, :n2].T.copy()
+            _assign_hungarian(cost_t, n2, n1, u, v, p, way, minv, used, assignment)
+            for j in range(n2):
+                i = assignment[j]
+                if pair_dr[i, j] < dr_min:
+                    idx_out[start2 + j] = i
+                    dr_out[start2 + j] = pair_dr[i, j]
+
+
+def _pad_none(offsets, values, mask):
+    '''Jagged array with the given `offsets`, `values` and None where `mask` is False (option type only if needed).'''
+    content = ak.contents.NumpyArray(values)
+    if not np.all(mask):
+        index = np.where(mask, np.arange(len(values), dtype=np.int64), -1)
+        content = ak.contents.IndexedOptionArray(ak.index.Index64(index), content)
+    return ak.Array(ak.contents.ListOffsetArray(ak.index.Index64(offsets), content))
+
+
+def object_matching(obj, obj2, dr_min, method="greedy"):
+    '''Unique deltaR matching of the objects of the collection `obj` (e.g. partons) to the objects of the collection `obj2`
+    (e.g. jets), computed with a compiled loop over the flat eta and phi of the two collections.
+    Drop-in replacement of `pocket_coffea.lib.deltaR_matching.object_matching`: returns the matched objects of `obj`,
+    the matched objects of `obj2` and the deltaR of the matched pairs, with the structure of `obj2` and None where
+    there is no matching.
+
+    :param dr_min: maximum deltaR (excluded) of the matched pairs
+    :param method: `greedy` to match the pairs by increasing deltaR (same result as PocketCoffea),
+        `hungarian` to maximise the number of matched pairs and then minimise the sum of their deltaR
+    '''
+    if method == "greedy":
+        kernel = match_greedy
+    elif method == "hungarian":
+        kernel = match_hungarian
+    else:
+        raise ValueError(f"Unknown matching method `{method}`: available methods {MATCHING_METHODS}.")
+    offsets1, (eta1, phi1) = get_flat_fields(obj, ["eta", "phi"])
+    offsets2, (eta2, phi2) = get_flat_fields(obj2, ["eta", "phi"])
+    # The deltaR is computed in the precision of the inputs, as the `metric_table` of the collections
+    dtype = np.result_type(eta1, phi1, eta2, phi2)
+    idx = np.empty(len(eta2), dtype=np.int64)
+    dr = np.zeros(len(eta2), dtype=dtype)
+    kernel(
+        offsets1, eta1.astype(dtype), phi1.astype(dtype),
+        offsets2, eta2.astype(dtype), phi2.astype(dtype),
+        dtype.type(dr_min), dtype.type(np.pi), dtype.type(2 * np.pi), idx, dr
+    )
+    matched = idx >= 0
+    local_index2 = np.arange(len(eta2), dtype=np.int64) - np.repeat(offsets2[:-1], np.diff(offsets2))
+    idx_obj_padnone = _pad_none(offsets2, idx, matched)
+    idx_obj2_padnone = _pad_none(offsets2, local_index2, matched)
+    # The deltaR of the matched pairs is returned in float64 as by the ArrayBuilder of PocketCoffea
+    deltaR_padnone = _pad_none(offsets2, dr.astype(np.float64), matched)
+    return obj[idx_obj_padnone], obj2[idx_obj2_padnone], deltaR_padnone
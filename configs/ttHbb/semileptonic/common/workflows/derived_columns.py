@@ -0,0 +1,274 @@
+import fnmatch
+import awkward as ak
+from .bjet_pairs import BJET_PAIR_OBSERVABLES, compute_bjet_pair_observables
+from .record_fields import with_fields, get_working_point_labels
+
+# Collections built as a copy of another collection, whose derived fields are inherited from the original one
+# (e.g. `JetGoodMatched` is built from `JetGood` in the parton matching, after the derived columns are computed)
+INHERITED_COLLECTIONS = {
+    "JetGoodMatched": "JetGood",
+}
+
+class DerivedColumn:
+    '''Declaration of a group of derived columns computed by the same function.
+
+    :param provides: names of the columns computed by the function: `name` for the event-level columns,
+        `collection.field` for the fields of a collection. Shell-style wildcards are allowed (e.g. `JetGood.btag_*`).
+    :param function: function(processor, names) returning a dictionary {name: array} with (at least) the requested columns `names`
+    :param requires: names of the columns needed by the function: either other derived columns, computed before, or
+        columns and collections of the events (e.g. `BJetGood`), that must exist when the column is computed.
+    '''
+    def __init__(self, provides, function, requires=()):
+        self.provides = list(provides)
+        self.function = function
+        self.requires = list(requires)
+
+    def matches(self, name):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.provides)
+
+
+class DerivedColumnRegistry:
+    '''Registry of the derived columns of a workflow.'''
+    def __init__(self):
+        self.columns = []
+
+    def register(self, provides, requires=()):
+        '''Decorator registering `function` as the function computing the columns `provides`.'''
+        def decorator(function):
+            self.columns.append(DerivedColumn(provides, function, requires))
+            return function
+        return decorator
+
+    @staticmethod
+    def canonical_name(name):
+        '''Name of the column with the inherited collections replaced by the original ones.'''
+        if "." in name:
+            collection, field = name.split(".", 1)
+            return f"{INHERITED_COLLECTIONS.get(collection, collection)}.{field}"
+        return name
+
+    def find(self, name):
+        '''Get the declaration of the derived column `name`, or None if `name` is not a derived column.'''
+        name = self.canonical_name(name)
+        for column in self.columns:
+            if column.matches(name):
+                return column
+        return None
+
+    def resolve(self, names, strict=False):
+        '''Get the sorted list of the derived columns among `names`, with the inherited collections replaced by the original ones.
+        If `strict` is True, all the `names` have to be derived columns.'''
+        resolved = set()
+        for name in names:
+            if self.find(name) is None:
+                if strict:
+                    raise ValueError(f"`{name}` is not a registered derived column.")
+                continue
+            resolved.add(self.canonical_name(name))
+        return sorted(resolved)
+
+
+class DerivedColumns:
+    '''Lazy accessor of the derived columns of the events of the current chunk and variation.
+    Each column is computed on the first access, after its dependencies, and attached to `processor.events`:
+    the following accesses read it back from the events, so that the column follows the event selections.
+    A new accessor has to be created for each chunk and variation.'''
+    def __init__(self, registry, processor, variation):
+        self.registry = registry
+        self.processor = processor
+        self.variation = variation
+        self.computed = set()
+        self._computing = set()
+
+    def _read(self, name):
+        events = self.processor.events
+        if "." in name:
+            collection, field = name.split(".", 1)
+            return events[collection][field]
+        return events[name]
+
+    def _exists(self, name):
+        events = self.processor.events
+        if "." in name:
+            collection, field = name.split(".", 1)
+            return (collection in events.fields) and (field in events[collection].fields)
+        return name in events.fields
+
+    def _attach(self, values):
+        # The new fields of each collection are attached together, rebuilding the collection once
+        events = self.processor.events
+        fields_by_collection = {}
+        for name, value in values.items():
+            if "." in name:
+                collection, field = name.split(".", 1)
+                fields_by_collection.setdefault(collection, {})[field] = value
+            else:
+                events[name] = value
+            self.computed.add(name)
+        for collection, fields in fields_by_collection.items():
+            events[collection] = with_fields(events[collection], fields)
+
+    def _compute(self, column, names):
+        key = id(column)
+        if key in self._computing:
+            raise RuntimeError(f"Circular dependency of the derived columns {column.provides}.")
+        self._computing.add(key)
+        try:
+            for dependency in column.requires:
+                if self.registry.find(dependency) is not None:
+                    self.get(dependency)
+                elif not self._exists(dependency):
+                    raise KeyError(f"The derived columns {column.provides} require `{dependency}`, which is not available in the events (variation `{self.variation}`).")
+            values = column.function(self.processor, names)
+        finally:
+            self._computing.discard(key)
+        missing = [name for name in names if name not in values]
+        if missing:
+            raise KeyError(f"The function of the derived columns {column.provides} did not compute {missing}.")
+        self._attach(values)
+
+    def get(self, name):
+        '''Get the derived column `name`, computing it and its dependencies if they have not been computed yet.'''
+        name = self.registry.canonical_name(name)
+        if name not in self.computed:
+            column = self.registry.find(name)
+            if column is None:
+                raise KeyError(f"`{name}` is not a registered derived column.")
+            self._compute(column, [name])
+        return self._read(name)
+
+    def materialize(self, names):
+        '''Compute all the derived columns `names` that have not been computed yet.
+        The columns declared together are computed with a single call of their function.'''
+        pending = {}
+        for name in map(self.registry.canonical_name, names):
+            if name in self.computed:
+                continue
+            column = self.registry.find(name)
+            if column is None:
+                raise KeyError(f"`{name}` is not a registered derived column.")
+            pending.setdefault(id(column), (column, []))[1].append(name)
+        for column, column_names in pending.values():
+            if not all(name in self.computed for name in column_names):
+                self._compute(column, column_names)
+
+
+def _walk(obj):
+    '''Iterate over the leaf objects of nested dictionaries, lists, tuples and sets.'''
+    if isinstance(obj, dict):
+        for value in obj.values():
+            yield from _walk(value)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            yield from _walk(value)
+    else:
+        yield obj
+
+
+def requires_derived_columns(*names):
+    '''Decorator declaring the derived columns read by a cut function, a weight class or the function of a partition axis:
+    the workflows compute them before the function is called (see `get_config_columns`).'''
+    def decorator(obj):
+        obj.derived_columns = list(getattr(obj, "derived_columns", [])) + list(names)
+        return obj
+    return decorator
+
+
+def _declared_columns(obj):
+    return list(getattr(obj, "derived_columns", []))
+
+
+def get_cuts_columns(cuts):
+    '''Get the names of the derived columns declared by the functions of a list of `Cut` objects.'''
+    names = set()
+    for cut in _walk(cuts):
+        names.update(_declared_columns(getattr(cut, "function", None)))
+    return names
+
+
+def get_selection_columns(selection):
+    '''Get the names of the columns read by a categorization: the derived columns declared by the cut functions
+    of a dictionary of cuts, a StandardSelection or a CartesianSelection, and the columns of the axes of a PartitionSelection.'''
+    if isinstance(selection, dict):
+        return get_cuts_columns(selection)
+    names = set()
+    if getattr(selection, "has_common_cats", False):
+        names.update(get_selection_columns(selection.common_cats))
+    names.update(get_cuts_columns(list(getattr(selection, "cut_functions", []))))
+    for multicut in getattr(selection, "multicuts", []):
+        names.update(get_cuts_columns(multicut.cuts))
+    for axis in getattr(selection, "axes", []):
+        if isinstance(axis.field, str):
+            names.add(axis.field)
+        else:
+            names.update(_declared_columns(axis.field))
+    return names
+
+
+def get_preselection_columns(cfg):
+    '''Get the names of the derived columns declared by the preselection cuts of the configuration.'''
+    return get_cuts_columns(getattr(cfg, "preselections", []))
+
+
+def get_config_columns(cfg):
+    '''Get the names of the columns used after the preselection by the configuration:
+    the histograms (`Axis`), the output columns (`ColOut`), the categories and subsamples (see `get_selection_columns`)
+    and the weights (derived columns declared by the weight classes).
+    The names are `name` for the event-level columns, `collection.field` for the fields of a collection.'''
+    names = set()
+    for histconf in _walk(getattr(cfg, "variables", {})):
+        for axis in getattr(histconf, "axes", []):
+            coll, field = getattr(axis, "coll", None), getattr(axis, "field", None)
+            if coll is None or field is None:
+                continue
+            names.add(field if coll == "events" else f"{coll}.{field}")
+    for colout in _walk(getattr(cfg, "columns", {})):
+        collection, columns = getattr(colout, "collection", None), getattr(colout, "columns", None)
+        if collection is None or columns is None:
+            continue
+        names.update(columns if collection == "events" else [f"{collection}.{c}" for c in columns])
+    categories = getattr(cfg, "categories", None)
+    if categories is not None:
+        names.update(get_selection_columns(categories))
+    for subsamples in getattr(cfg, "subsamples", {}).values():
+        names.update(get_selection_columns(subsamples))
+    for weight_class in getattr(cfg, "weights_classes", None) or []:
+        names.update(_declared_columns(weight_class))
+    return names
+
+
+# Derived columns of the ttHbb workflows
+TTHBB_DERIVED_COLUMNS = DerivedColumnRegistry()
+
+@TTHBB_DERIVED_COLUMNS.register(["BJetGood_Ht"], requires=["BJetGood"])
+def bjetgood_ht(processor, names):
+    # Scalar sum of the transverse momenta of the b-jets
+    return {"BJetGood_Ht": ak.sum(abs(processor.events.BJetGood.pt), axis=1)}
+
+
+@TTHBB_DERIVED_COLUMNS.register(["LightJetGood_Ht"], requires=["LightJetGood"])
+def lightjetgood_ht(processor, names):
+    # Scalar sum of the transverse momenta of the light jets
+    return {"LightJetGood_Ht": ak.sum(abs(processor.events.LightJetGood.pt), axis=1)}
+
+
+@TTHBB_DERIVED_COLUMNS.register(["LeptonGood.is_electron"], requires=["LeptonGood"])
+def lepton_is_electron(processor, names):
+    return {"LeptonGood.is_electron": ak.values_astype(processor.events.LeptonGood.pdgId == 11, bool)}
+
+
+@TTHBB_DERIVED_COLUMNS.register(["JetGood.btag_*"], requires=["JetGood"])
+def jet_btag_labels(processor, names):
+    # Labels of the b-tagged jets at the different working points
+    btagging = processor.params.btagging.working_point[processor._year]
+    labels = get_working_point_labels(processor.events.JetGood[btagging["btagging_algorithm"]], btagging["btagging_WP"])
+    return {f"JetGood.btag_{wp}": value for wp, value in labels.items()}
+
+
+@TTHBB_DERIVED_COLUMNS.register([*BJET_PAIR_OBSERVABLES, "mbb"], requires=["BJetGood"])
+def bjet_pair_observables(processor, names):
+    # Observables of the b-jet pairs, computed with a single compiled loop over the unique b-jet pairs:
+    # minimum deltaR(b, b), deltaEta(b, b), deltaPhi(b, b), average deltaR(b, b),
+    # invariant mass, pT and HT of the closest b-jet pair, minimum and maximum invariant mass of all b-jet pairs.
+    # The invariant mass of all the pairs sorted by deltaR (`mbb`) is computed only if requested.
+    return compute_bjet_pair_observables(processor.events["BJetGood"], with_pairs="mbb" in names)
@@ -0,0 +1,122 @@
+import os
+import uuid
+import hashlib
+import numpy as np
+import awkward as ak
+
+# Structured type used to sort and join the events by their identifier
+EVENT_ID_DTYPE = np.dtype([("run", "<u4"), ("luminosityBlock", "<u4"), ("event", "<u8")])
+
+# Cache of the hashes of the model files, keyed by (path, modification time, size)
+_model_hashes = {}
+
+def get_model_hash(model_path, length=16):
+    '''Get the (truncated) sha256 hash of the content of the model file.
+    The hash is computed once per process and recomputed only if the file is modified.'''
+    stat = os.stat(model_path)
+    key = (os.path.abspath(model_path), stat.st_mtime_ns, stat.st_size)
+    if key not in _model_hashes:
+        sha = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        _model_hashes[key] = sha.hexdigest()
+    return _model_hashes[key][:length]
+
+
+def get_event_ids(events):
+    '''Get the structured array of the (run, luminosityBlock, event) identifiers of the events.'''
+    event_ids = np.empty(len(events), dtype=EVENT_ID_DTYPE)
+    for field in EVENT_ID_DTYPE.names:
+        event_ids[field] = ak.to_numpy(events[field])
+    return event_ids
+
+
+class FeatureStore:
+    '''On-disk store of per-event ML features (e.g. the SPANet and DCTR scores), saved as local Parquet files.
+    The features are keyed by the event identifier (run, luminosityBlock, event) and by the hash of the model file,
+    so that the stored features are automatically invalidated when the model changes.
+
+    The files are organised as:
+    `{path}/{name}/{model_hash}/{dataset}/{variation}/{input file hash}/{entrystart}-{entrystop}-{uid}.parquet`
+    in this way each chunk only reads the features of the events coming from the same input file.
+
+    :param path: root folder of the store
+    :param name: name of the model (e.g. `spanet`)
+    :param model_path: path of the model file, used to compute the hash
+    :param fields: names of the stored features
+    '''
+    def __init__(self, path, name, model_path, fields):
+        self.path = path
+        self.name = name
+        self.model_hash = get_model_hash(model_path)
+        self.fields = list(fields)
+
+    def _get_directory(self, events, variation):
+        metadata = events.metadata
+        file_hash = hashlib.sha1(metadata["filename"].encode()).hexdigest()[:16]
+        return os.path.join(self.path, self.name, self.model_hash, metadata["dataset"], variation, file_hash)
+
+    def load(self, events, variation):
+        '''Look up the features of the events in the store.
+        Returns a dictionary with an array for each field, filled with the stored features
+        (NaN for the events not found), and the boolean mask of the events not found in the store.'''
+        nevents = len(events)
+        features = {field: np.full(nevents, np.nan, dtype=np.float32) for field in self.fields}
+        missing = np.ones(nevents, dtype=bool)
+
+        directory = self._get_directory(events, variation)
+        if not os.path.isdir(directory):
+            return features, missing
+        files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".parquet"))
+        if len(files) == 0:
+            return features, missing
+
+        stored = ak.from_parquet(files)
+        stored_ids = get_event_ids(stored)
+        order = np.argsort(stored_ids, kind="stable")
+        stored_ids = stored_ids[order]
+
+        event_ids = get_event_ids(events)
+        idx = np.searchsorted(stored_ids, event_ids)
+        idx_clipped = np.minimum(idx, len(stored_ids) - 1)
+        found = (idx < len(stored_ids)) & (stored_ids[idx_clipped] == event_ids)
+        for field in self.fields:
+            values = ak.to_numpy(stored[field])[order]
+            features[field][found] = values[idx_clipped[found]]
+        missing[found] = False
+        return features, missing
+
+    def save(self, events, variation, features):
+        '''Save the features of the events in a new file of the store.
+        The file is written atomically, so that concurrent chunks never read partial files.'''
+        if len(events) == 0:
+            return
+        directory = self._get_directory(events, variation)
+        os.makedirs(directory, exist_ok=True)
+        columns = {field: ak.to_numpy(events[field]) for field in EVENT_ID_DTYPE.names}
+        for field in self.fields:
+            columns[field] = np.asarray(features[field], dtype=np.float32)
+        metadata = events.metadata
+        filename = f"{metadata.get('entrystart', 0)}-{metadata.get('entrystop', 0)}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_file = os.path.join(directory, f".{filename}.tmp")
+        ak.to_parquet(ak.zip(columns), tmp_file)
+        os.replace(tmp_file, os.path.join(directory, filename))
+
+
+def get_feature_store(workflow_options, name, model_path, fields):
+    '''Get the feature store of the model `name` if the `feature_store` workflow option is set, None otherwise.'''
+    path = workflow_options.get("feature_store", None)
+    if path is None:
+        return None
+    return FeatureStore(path, name, model_path, fields)
+
+
+def load_features(store, events, variation, fields):
+    '''Load the features from the `store` (if any).
+    Returns the dictionary of features and the mask of the events for which the inference is still needed.'''
+    if store is None:
+        nevents = len(events)
+        features = {field: np.full(nevents, np.nan, dtype=np.float32) for field in fields}
+        return features, np.ones(nevents, dtype=bool)
+    return store.load(events, variation)
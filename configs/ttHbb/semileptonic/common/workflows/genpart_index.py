@@ -0,0 +1,378 @@
+import numpy as np
+import awkward as ak
+import numba
+
+from .record_fields import get_flat_fields
+
+# Bits of the `statusFlags` of the NanoAOD GenPart collection, as in the `GenParticle` behavior of coffea
+STATUS_FLAGS = {
+    "isPrompt": 0,
+    "isDecayedLeptonHadron": 1,
+    "isTauDecayProduct": 2,
+    "isPromptTauDecayProduct": 3,
+    "isDirectTauDecayProduct": 4,
+    "isDirectPromptTauDecayProduct": 5,
+    "isDirectHadronDecayProduct": 6,
+    "isHardProcess": 7,
+    "fromHardProcess": 8,
+    "isHardProcessTauDecayProduct": 9,
+    "isDirectHardProcessTauDecayProduct": 10,
+    "fromHardProcessBeforeFSR": 11,
+    "isFirstCopy": 12,
+    "isLastCopy": 13,
+    "isLastCopyBeforeFSR": 14,
+}
+
+# Samples with top quarks, for which the top pT reweighting is computed
+SAMPLES_TOP = ["TTbbSemiLeptonic", "TTToSemiLeptonic", "TTTo2L2Nu"]
+
+GENPART_FIELDS = ["pdgId", "status", "statusFlags", "genPartIdxMother", "pt", "eta", "phi"]
+
+@numba.njit
+def build_decay_tree(offsets, mother_local, mother, children_offsets, children):
+    '''
+    Build the parent and children tables of the generator particles from the index of their mother.
+    - offsets: offsets of the particles of the events in the flat arrays
+    - mother_local: index of the mother of each particle in its event (-1 if there is no mother)
+    - mother: output, global index of the mother of each particle in the flat arrays (-1 if there is no mother)
+    - children_offsets (nparticles + 1), children (nparticles): output, compressed sparse row table of the children:
+      the global indices of the children of the particle `i` are `children[children_offsets[i]:children_offsets[i + 1]]`,
+      in increasing order as the `childrenIdxG` of coffea.
+    '''
+    children_offsets[:] = 0
+    for iev in range(offsets.shape[0] - 1):
+        start = offsets[iev]
+        n = offsets[iev + 1] - start
+        for i in range(start, start + n):
+            m = mother_local[i]
+            if m >= 0 and m < n:
+                mother[i] = start + m
+                children_offsets[start + m + 1] += 1
+            else:
+                mother[i] = -1
+    for i in range(mother.shape[0]):
+        children_offsets[i + 1] += children_offsets[i]
+    position = children_offsets[:-1].copy()
+    for i in range(mother.shape[0]):
+        m = mother[i]
+        if m >= 0:
+            children[position[m]] = i
+            position[m] += 1
+
+
+@numba.njit
+def select_first(offsets, mask, out, counts):
+    '''
+    Get the global indices of the first `out.shape[1]` particles of each event passing `mask`.
+    - offsets: offsets of the particles of the events
+    - mask: boolean mask of the particles
+    - out (nevents, n): output, global indices of the selected particles, -1 if there are less than n particles
+    - counts (nevents): output, number of particles of each event passing `mask` (also beyond n)
+    '''
+    nmax = out.shape[1]
+    for iev in range(offsets.shape[0] - 1):
+        out[iev, :] = -1
+        count = 0
+        for i in range(offsets[iev], offsets[iev + 1]):
+            if mask[i]:
+                if count < nmax:
+                    out[iev, count] = i
+                count += 1
+        counts[iev] = count
+
+
+@numba.njit
+def select_children(offsets, mask, children_offsets, children, out, counts):
+    '''
+    Get the children of the particles passing `mask`, concatenated by event in the order of their mothers.
+    - offsets: offsets of the particles of the events
+    - children_offsets, children: children table of the particles
+    - out: output, global indices of the children (large enough for all the children of the particles)
+    - counts (nevents): output, number of children of each event
+    Returns the total number of children.
+    '''
+    nout = 0
+    for iev in range(offsets.shape[0] - 1):
+        count = 0
+        for i in range(offsets[iev], offsets[iev + 1]):
+            if mask[i]:
+                for k in range(children_offsets[i], children_offsets[i + 1]):
+                    out[nout] = children[k]
+                    nout += 1
+                    count += 1
+        counts[iev] = count
+    return nout
+
+
+@numba.njit
+def _follow_last_copy(current, children_offsets, children, statusFlags):
+    # Follow the chain of first children of the particle `current` down to its last copy
+    while not (statusFlags[current] & (1 << 13)):
+        if children_offsets[current + 1] == children_offsets[current]:
+            break
+        current = children[children_offsets[current]]
+    return current
+
+
+@numba.njit
+def find_last_copies(idx, children_offsets, children, statusFlags, out):
+    '''
+    Follow the decay chain of the particles `idx` (global indices, -1 for missing particles) down to their last copy,
+    taking at each step the first child as the copy of the particle. The chain stops at particles without children.
+    - out: output, global indices of the last copies (-1 for the missing particles)
+    '''
+    for k in range(idx.shape[0]):
+        out[k] = _follow_last_copy(idx[k], children_offsets, children, statusFlags) if idx[k] >= 0 else idx[k]
+
+
+@numba.njit
+def _fill_W_decay(k, W_id, children_offsets, children, statusFlags, pdgId, is_leptonic, idx_children):
+    # Decay products of the last copy of the W `W_id`, written in the row `k` of the outputs
+    is_leptonic[k] = False
+    idx_children[k, 0] = 0
+    idx_children[k, 1] = 0
+    if W_id < 0:
+        return
+    current = _follow_last_copy(W_id, children_offsets, children, statusFlags)
+    for ich in range(children_offsets[current + 1] - children_offsets[current]):
+        child = children[children_offsets[current] + ich]
+        if 11 <= abs(pdgId[child]) <= 16:
+            is_leptonic[k] = True
+        if ich < 2:
+            idx_children[k, ich] = child
+
+
+@numba.njit
+def find_W_decays(W_idx, children_offsets, children, statusFlags, pdgId, is_leptonic, idx_children):
+    '''
+    Get the decay products of the Ws `W_idx` (global indices, -1 if the W is not found), same as `analyze_W_flat` of PocketCoffea.
+    - is_leptonic: output, True if the W decays leptonically
+    - idx_children (nW, 2): output, global indices of the first two children of the last copy of the W
+      (0 if the W is not found)
+    '''
+    for k in range(W_idx.shape[0]):
+        _fill_W_decay(k, W_idx[k], children_offsets, children, statusFlags, pdgId, is_leptonic, idx_children)
+
+
+@numba.njit(parallel=True)
+def find_W_decays_parallel(W_idx, children_offsets, children, statusFlags, pdgId, is_leptonic, idx_children):
+    '''Same as `find_W_decays`, with the Ws split across the numba threads.'''
+    for k in numba.prange(W_idx.shape[0]):
+        _fill_W_decay(k, W_idx[k], children_offsets, children, statusFlags, pdgId, is_leptonic, idx_children)
+
+
+@numba.njit
+def _hardest_emission(p_id, children_offsets, children, eta, phi, pt, pdgId, max_deltaR):
+    # Hardest child (not a meson) within `max_deltaR` of the parton `p_id`, or the parton itself if there is none
+    eta_original = eta[p_id]
+    phi_original = phi[p_id]
+    # Take all the children and consider the one with the highest pt
+    max_pt = -1
+    max_pt_idx = -1
+    for k in range(children_offsets[p_id], children_offsets[p_id + 1]):
+        child = children[k]
+        # Do not consider mesons
+        if abs(pdgId[child]) > 21:
+            continue
+        if np.sqrt((eta_original - eta[child])**2 + (phi_original - phi[child])**2) > max_deltaR:
+            continue
+        if pt[child] > max_pt:
+            max_pt_idx = child
+            max_pt = pt[child]
+    if max_pt == -1:
+        max_pt_idx = p_id
+    return max_pt_idx
+
+
+@numba.njit
+def find_hardest_emissions(parts_idx, children_offsets, children, eta, phi, pt, pdgId, max_deltaR, out):
+    '''
+    Get the hardest child of the partons `parts_idx` (nevents, nparts) of global indices within `max_deltaR`
+    from the parton, same as `analyze_parton_decays_flat_nomesons` of PocketCoffea: the mesons are not considered
+    and the parton itself is returned if none of its children is selected.
+    - out (nevents, nparts): output, global indices of the selected children
+    '''
+    for iev in range(parts_idx.shape[0]):
+        for ipart in range(parts_idx.shape[1]):
+            out[iev, ipart] = _hardest_emission(parts_idx[iev, ipart], children_offsets, children, eta, phi, pt, pdgId, max_deltaR)
+
+
+@numba.njit(parallel=True)
+def find_hardest_emissions_parallel(parts_idx, children_offsets, children, eta, phi, pt, pdgId, max_deltaR, out):
+    '''Same as `find_hardest_emissions`, with the events split across the numba threads.'''
+    for iev in numba.prange(parts_idx.shape[0]):
+        for ipart in range(parts_idx.shape[1]):
+            out[iev, ipart] = _hardest_emission(parts_idx[iev, ipart], children_offsets, children, eta, phi, pt, pdgId, max_deltaR)
+
+
+class GenPartIndex:
+    '''Index of the generator particles of a chunk of events, built once with a single pass over the flat GenPart arrays.
+    It holds the global offsets of the events, the flat pdgId, status, status flags and kinematics of the particles
+    and the parent and children tables (compressed sparse row), so that the decay tree can be traversed by compiled
+    functions instead of the cross-references (`parent`, `children`) of the GenPart collection.
+    All the indices returned by the queries are global indices in the flat GenPart arrays (`genparts_flat`).
+    The index is valid for the events it is built from: it has to be rebuilt if the events are filtered.
+    If `parallel` is True, the W decays and the FSR emissions are traced with the events split across the numba threads
+    (`NUMBA_NUM_THREADS`): each event is written by a single thread, so that the output does not depend on the number of threads.'''
+    def __init__(self, genparts, parallel=False):
+        self.genparts = genparts
+        self.parallel = parallel
+        self.offsets, (self.pdgId, self.status, self.statusFlags, self.genPartIdxMother, self.pt, self.eta, self.phi) = \
+            get_flat_fields(genparts, GENPART_FIELDS)
+        self.nevents = len(self.offsets) - 1
+        self.nparticles = len(self.pdgId)
+        self.mother = np.empty(self.nparticles, dtype=np.int64)
+        self.children_offsets = np.zeros(self.nparticles + 1, dtype=np.int64)
+        self.children = np.empty(self.nparticles, dtype=np.int64)
+        build_decay_tree(self.offsets, self.genPartIdxMother, self.mother, self.children_offsets, self.children)
+        self._genparts_flat = None
+
+    @property
+    def genparts_flat(self):
+        '''Flat GenPart collection, indexed by the global indices of the queries.'''
+        if self._genparts_flat is None:
+            self._genparts_flat = ak.flatten(self.genparts)
+        return self._genparts_flat
+
+    @staticmethod
+    def flags_bitmask(flags):
+        '''Bitmask of the status flags `flags` (name or list of names).'''
+        if isinstance(flags, str):
+            flags = [flags]
+        bitmask = 0
+        for flag in flags:
+            if flag not in STATUS_FLAGS:
+                raise ValueError(f"Unknown status flag `{flag}`: available flags {list(STATUS_FLAGS.keys())}.")
+            bitmask |= 1 << STATUS_FLAGS[flag]
+        return bitmask
+
+    def has_flags(self, flags):
+        '''Flat mask of the particles with all the status flags `flags`, as `GenPart.hasFlags`.'''
+        bitmask = self.flags_bitmask(flags)
+        return (self.statusFlags & bitmask) == bitmask
+
+    @property
+    def has_mother(self):
+        return self.mother >= 0
+
+    @property
+    def mother_pdgId(self):
+        '''pdgId of the mother of each particle (0 if there is no mother).'''
+        return np.where(self.has_mother, self.pdgId[self.mother], 0)
+
+    @property
+    def nchildren(self):
+        return np.diff(self.children_offsets)
+
+    @property
+    def local_index(self):
+        '''Index of each particle in its event.'''
+        return np.arange(self.nparticles, dtype=np.int64) - np.repeat(self.offsets[:-1], np.diff(self.offsets))
+
+    def select_first(self, mask, n=1):
+        '''Global indices (nevents, n) of the first `n` particles of each event passing the flat `mask`
+        (-1 if there are less than `n` particles) and number of particles of each event passing the mask.'''
+        out = np.empty((self.nevents, n), dtype=np.int64)
+        counts = np.empty(self.nevents, dtype=np.int64)
+        select_first(self.offsets, mask, out, counts)
+        return out, counts
+
+    def select_exactly(self, mask, n, name="particles"):
+        '''Global indices (nevents, n) of the particles passing the flat `mask`, requiring exactly `n` of them in each event.'''
+        out, counts = self.select_first(mask, n)
+        if np.any(counts != n):
+            raise ValueError(f"Expected exactly {n} {name} per event, found {np.unique(counts)}.")
+        return out
+
+    def select(self, mask):
+        '''Jagged GenPart collection of the particles passing the flat `mask`.'''
+        cumulative = np.zeros(self.nparticles + 1, dtype=np.int64)
+        np.cumsum(mask, out=cumulative[1:])
+        counts = cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+        return ak.unflatten(self.genparts_flat[np.flatnonzero(mask)], counts)
+
+    def children_of(self, mask):
+        '''Global indices of the children of the particles passing the flat `mask`, concatenated by event,
+        and number of children of each event.'''
+        out = np.empty(self.nparticles, dtype=np.int64)
+        counts = np.empty(self.nevents, dtype=np.int64)
+        nout = select_children(self.offsets, mask, self.children_offsets, self.children, out, counts)
+        return out[:nout], counts
+
+    def hard_process_daughters(self, pdgId, flags=("fromHardProcess",), ndaughters=2):
+        '''Jagged GenPart collection of the daughters of the particles with `pdgId` and status flags `flags`
+        decaying to `ndaughters` particles (e.g. the b-quarks of the H->bb decay), as `higgs.children` flattened by event.'''
+        mask = (self.pdgId == pdgId) & self.has_flags(list(flags)) & (self.nchildren == ndaughters)
+        idx, counts = self.children_of(mask)
+        return ak.unflatten(self.genparts_flat[idx], counts)
+
+    def last_copy(self, idx):
+        '''Global indices of the last copy of the particles `idx` (-1 for missing particles).'''
+        idx = np.ascontiguousarray(idx, dtype=np.int64)
+        out = np.empty(idx.shape[0], dtype=np.int64)
+        find_last_copies(idx, self.children_offsets, self.children, self.statusFlags, out)
+        return out
+
+    def last_copy_tops(self):
+        '''Global indices of the last copy of the top and anti-top quarks (first one in each event), with a mother,
+        and number of last copies of top and anti-top quarks in each event.'''
+        mask = self.has_mother & self.has_flags("isLastCopy")
+        top, ntop = self.select_first(mask & (self.pdgId == 6), 1)
+        antitop, nantitop = self.select_first(mask & (self.pdgId == -6), 1)
+        return top[:, 0], antitop[:, 0], ntop + nantitop
+
+    def W_decays(self, W_idx):
+        '''Decay products of the Ws `W_idx` (global indices, -1 if not found): is_leptonic flag and global indices (nW, 2)
+        of the decay products of the last copy of the W.'''
+        W_idx = np.ascontiguousarray(W_idx, dtype=np.int64)
+        is_leptonic = np.empty(W_idx.shape[0], dtype=np.bool_)
+        idx_children = np.empty((W_idx.shape[0], 2), dtype=np.int64)
+        kernel = find_W_decays_parallel if self.parallel else find_W_decays
+        kernel(W_idx, self.children_offsets, self.children, self.statusFlags, self.pdgId, is_leptonic, idx_children)
+        return is_leptonic, idx_children
+
+    def hardest_emissions(self, parts_idx, max_deltaR):
+        '''Global indices of the hardest child (not a meson) within `max_deltaR` of the partons `parts_idx` (nevents, nparts),
+        or of the parton itself if there is none: the partons after the FSR emission.'''
+        parts_idx = np.ascontiguousarray(parts_idx, dtype=np.int64)
+        out = np.empty(parts_idx.shape, dtype=np.int64)
+        kernel = find_hardest_emissions_parallel if self.parallel else find_hardest_emissions
+        kernel(parts_idx, self.children_offsets, self.children,
+               self.eta, self.phi, self.pt, self.pdgId, max_deltaR, out)
+        return out
+
+
+class GenPartIndexMixin:
+    '''Processor mixin giving access to the GenPart index of the current events of the chunk (`genpart_index`).
+    The index is built on the first use after the preselection and shared by all the steps of the processor
+    (parton matching, top pT, FSR tracing); the weights read the columns computed from it (e.g. `compute_top_pt`).
+    It is dropped every time the preselection filters the events, i.e. for each chunk and shape variation.
+    The W decays and the FSR emissions are traced in parallel if `parallel_fsr_tracing` is True.'''
+    parallel_fsr_tracing = False
+    _genpart_index = None
+
+    def reset_genpart_index(self):
+        self._genpart_index = None
+
+    @property
+    def genpart_index(self):
+        if self._genpart_index is None:
+            self._genpart_index = GenPartIndex(self.events.GenPart, parallel=self.parallel_fsr_tracing)
+        elif self._genpart_index.nevents != len(self.events):
+            raise RuntimeError("The GenPart index was built for other events: call `reset_genpart_index()` after filtering the events.")
+        return self._genpart_index
+
+    def apply_preselections(self, variation):
+        super().apply_preselections(variation=variation)
+        # The events have been filtered: the index of the selected events is built on the first use
+        self.reset_genpart_index()
+
+    def compute_top_pt(self):
+        '''Attach to the events the pT of the last copy of the top and anti-top quarks (`top_pt`, `antitop_pt`),
+        read by the top pT reweighting. Return the number of last copies of top and anti-top quarks in each event.'''
+        top_idx, antitop_idx, ntops = self.genpart_index.last_copy_tops()
+        if np.any(top_idx < 0) | np.any(antitop_idx < 0):
+            raise ValueError(f"Missing last copy of the top or anti-top quark in the events of sample {self._sample}.")
+        self.events["top_pt"] = self.genpart_index.pt[top_idx]
+        self.events["antitop_pt"] = self.genpart_index.pt[antitop_idx]
+        return ntops
@@ -0,0 +1,265 @@
+import numpy as np
+import awkward as ak
+from pocket_coffea.lib.hist_manager import HistManager
+from pocket_coffea.lib.weights.weights_manager import get_weights_by_cat_var, get_weights_by_cat_var_subsample
+from ..cuts.partition_selection import PartitionSelection
+
+
+class PartitionGroups:
+    '''Events of the chunk grouped by partition of the categories and of the subsamples.
+
+    The events are sorted once by the joint partition index of the categories and of the subsamples (if they are
+    also a PartitionSelection without common categories): the events of each partition are a contiguous slice
+    of the sorted indices. The events of a category and subsample are gathered from the slices of their partitions,
+    at a cost proportional to their number, instead of masking all the events of the chunk.
+    The categories defined by cuts (common categories) are selected by their masks.
+    '''
+    def __init__(self, categories, subsamples):
+        self.categories = categories
+        self.subsamples = subsamples
+        self.subsamples_partitioned = isinstance(subsamples, PartitionSelection) and not subsamples.has_common_cats
+        index = categories.partition_index
+        if self.subsamples_partitioned:
+            self.n_sub = int(np.prod(subsamples.shape))
+            index = index * self.n_sub + subsamples.partition_index
+        else:
+            self.n_sub = 1
+        n_partitions = int(np.prod(categories.shape)) * self.n_sub
+        self.order = np.argsort(index, kind="stable")
+        self.counts = np.bincount(index, minlength=n_partitions)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+        self.partitions = {
+            category: np.flatnonzero(table) for category, table in categories.tables.items()
+        }
+        if self.subsamples_partitioned:
+            self.subsample_partitions = {
+                subsample: np.flatnonzero(table) for subsample, table in subsamples.tables.items()
+            }
+
+    def gather(self, groups):
+        '''Sorted indices of the events of the partitions `groups`.'''
+        groups = groups[self.counts[groups] > 0]
+        if len(groups) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate([self.order[self.starts[g]:self.starts[g] + self.counts[g]] for g in groups]))
+
+    def get_indices(self):
+        '''Iterate over (category, subsample, indices of the events of the category and subsample).'''
+        subsample_masks = None if self.subsamples_partitioned else dict(self.subsamples.get_masks())
+        for category in self.categories.keys():
+            if category not in self.partitions:
+                # Category defined by cuts
+                cat_mask = np.asarray(self.categories.get_mask(category))
+                for subsample, subs_mask in self.subsamples.get_masks():
+                    yield category, subsample, np.flatnonzero(cat_mask & np.asarray(subs_mask))
+            elif self.subsamples_partitioned:
+                for subsample, sub_partitions in self.subsample_partitions.items():
+                    groups = (self.partitions[category][:, None] * self.n_sub + sub_partitions[None, :]).ravel()
+                    yield category, subsample, self.gather(groups)
+            else:
+                indices = self.gather(self.partitions[category])
+                for subsample, subs_mask in subsample_masks.items():
+                    yield category, subsample, indices[np.asarray(subs_mask)[indices]]
+
+
+class EventWeights:
+    '''Weights of the events of a category and subsample: the weight of each variation (times the weight of the subsample)
+    is gathered once from the weights of the chunk, and broadcast to the structure of the data of the histograms
+    of collections (as in `HistManager.mask_and_broadcast_weight`).'''
+    def __init__(self, weights, weights_sub, category, subsample, indices):
+        self.weights = weights[category]
+        self.weights_sub = weights_sub[subsample][category] if weights_sub is not None else None
+        self.indices = indices
+        self.by_event = {}
+
+    def get(self, variation, data_structure=None):
+        if variation not in self.by_event:
+            weight = np.asarray(self.weights.get(variation, self.weights["nominal"]))[self.indices]
+            if self.weights_sub is not None:
+                weight = weight * np.asarray(self.weights_sub.get(variation, self.weights_sub["nominal"]))[self.indices]
+            self.by_event[variation] = weight
+        weight = self.by_event[variation]
+        if (data_structure is not None) and (data_structure.ndim == 2):
+            if ak.any(ak.is_none(data_structure, axis=-1)):
+                data_structure = ak.fill_none(data_structure, 0.)
+            return ak.to_numpy(ak.flatten(data_structure * weight), allow_missing=False)
+        return weight
+
+
+def supports_grouped_fill(categories, subsamples, custom_weight=None):
+    '''The histograms can be filled by partition if the categories are a PartitionSelection and all the masks
+    are by event (no cuts on a collection), without custom weights.'''
+    if not isinstance(categories, PartitionSelection) or categories.partition_index is None:
+        return False
+    if custom_weight is not None:
+        return False
+    return not (getattr(categories, "is_multidim", False) or getattr(subsamples, "is_multidim", False))
+
+
+class PartitionHistManager(HistManager):
+    '''HistManager filling the histograms of the categories defined by partitions (see `PartitionSelection`)
+    from the events grouped by partition index (see `PartitionGroups`): the columns and the weights are gathered
+    once for each category and subsample from the events of its partitions, instead of masking all the events
+    of the chunk for each category and subsample.
+    The other categorizations, the cuts on collections and the custom weights are filled by the HistManager.'''
+
+    def fill_histograms(
+        self,
+        events,
+        categories,
+        shape_variation="nominal",
+        subsamples=None,
+        custom_fields=None,
+        custom_weight=None,
+    ):
+        if not supports_grouped_fill(categories, subsamples, custom_weight):
+            return super().fill_histograms(
+                events, categories, shape_variation=shape_variation, subsamples=subsamples,
+                custom_fields=custom_fields, custom_weight=custom_weight,
+            )
+
+        # Weights of the categories and of the subsamples, as in the HistManager
+        weights = {}
+        for category in self.available_categories:
+            weights[category] = get_weights_by_cat_var(
+                self.available_weights_variations_bycat[category],
+                self.weights_manager, category, shape_variation,
+            )
+        weights_sub = {}
+        if self.has_subsamples and self.isMC:
+            for subsample in self.subsamples:
+                weights_sub[subsample] = {}
+                for category in self.available_categories:
+                    avail = set(self.available_weights_variations_bysubsample_bycat[subsample][category]) | {"nominal"}
+                    weights_sub[subsample][category] = get_weights_by_cat_var_subsample(
+                        avail, self.weights_manager,
+                        self.sample + "__" + subsample, category, shape_variation,
+                    )
+
+        # Columns of the histograms, read once for all the categories and subsamples
+        columns = {}
+        for name, histo in self.histograms[self.subsamples[0]].items():
+            if (not histo.autofill) or histo.metadata_hist:
+                continue
+            if shape_variation != "nominal" and not any(
+                shape_variation in self.histograms[sub][name].hist_obj.axes["variation"]
+                for sub in self.subsamples
+            ):
+                continue
+            columns[name] = self.get_fill_columns(events, histo, custom_fields)
+
+        # The indices of the events of each category and subsample are gathered once from the partitions
+        for category, subsample, indices in PartitionGroups(categories, subsamples).get_indices():
+            if len(indices) == 0:
+                continue
+            event_weights = EventWeights(
+                weights, weights_sub if (self.has_subsamples and self.isMC) else None, category, subsample, indices
+            )
+            for name, (fill_categorical, fill_numeric, data_ndim) in columns.items():
+                self.fill_category(
+                    name, category, subsample, indices, fill_categorical, fill_numeric, data_ndim,
+                    event_weights, shape_variation,
+                )
+
+    @staticmethod
+    def get_fill_columns(events, histo, custom_fields):
+        '''Columns of the numerical and categorical axes of the histogram, for all the events.'''
+        fill_categorical = {}
+        fill_numeric = {}
+        data_ndim = None
+        for ax in histo.axes:
+            if ax.type in ["regular", "variable", "int"]:
+                if ax.coll == "events":
+                    data = events[ax.field]
+                elif ax.coll == "metadata":
+                    data = events.metadata[ax.field]
+                elif ax.coll == "custom":
+                    data = custom_fields[ax.field]
+                else:
+                    if ax.coll not in events.fields:
+                        raise ValueError(f"Collection {ax.coll} not found in events!")
+                    if ax.field not in events[ax.coll].fields:
+                        raise ValueError(f"Varible {ax.field} not found in {ax.coll} Collection!")
+                    if ax.pos is None:
+                        data = events[ax.coll][ax.field]
+                    elif ax.pos >= 0:
+                        data = ak.pad_none(events[ax.coll][ax.field], ax.pos + 1, axis=1)[:, ax.pos]
+                    else:
+                        raise Exception(f"Invalid position {ax.pos} requested for collection {ax.coll}")
+                if data_ndim is None:
+                    data_ndim = data.ndim
+                elif data_ndim != data.ndim:
+                    raise Exception(f"Incompatible shapes for Axis {ax} of hist {histo}")
+                fill_numeric[ax.name] = data
+            else:
+                if ax.coll == "metadata":
+                    fill_categorical[ax.name] = events.metadata[ax.field]
+                elif ax.coll == "custom":
+                    fill_categorical[ax.name] = custom_fields[ax.field]
+                else:
+                    raise NotImplementedError()
+        return fill_categorical, fill_numeric, data_ndim
+
+    def fill_category(self, name, category, subsample, indices, fill_categorical, fill_numeric, data_ndim,
+                      event_weights, shape_variation):
+        '''Fill the histogram `name` of the category and subsample with the events `indices`.'''
+        histo = self.histograms[subsample][name]
+        # Gather the columns of the events and flatten them, removing the missing values
+        all_axes_isnotnone = None
+        data_structure = None
+        fill_numeric_masked = {}
+        for field, data in fill_numeric.items():
+            masked_data = data[indices]
+            if data_ndim > 1:
+                if data_structure is None:
+                    data_structure = ak.ones_like(masked_data)
+                masked_data = ak.flatten(masked_data)
+            isnotnone = ~ak.is_none(masked_data)
+            all_axes_isnotnone = isnotnone if all_axes_isnotnone is None else (all_axes_isnotnone & isnotnone)
+            fill_numeric_masked[field] = masked_data
+        for key, value in fill_numeric_masked.items():
+            fill_numeric_masked[key] = ak.to_numpy(value[all_axes_isnotnone], allow_missing=False)
+        isnotnone = ak.to_numpy(all_axes_isnotnone)
+        fill = {**fill_categorical, **fill_numeric_masked}
+
+        if histo.no_weights:
+            try:
+                if self.isMC:
+                    histo.hist_obj.fill(cat=category, variation="nominal", **fill)
+                else:
+                    histo.hist_obj.fill(cat=category, **fill)
+            except Exception as e:
+                raise Exception(f"Cannot fill histogram: {name}, {histo} {e}")
+            return
+
+        if not self.isMC:
+            weight_data = event_weights.get("nominal", data_structure)
+            try:
+                histo.hist_obj.fill(cat=category, weight=weight_data[isnotnone], **fill)
+            except Exception as e:
+                raise Exception(f"Cannot fill histogram for Data: {name}, {histo} {e}")
+            return
+
+        if shape_variation == "nominal":
+            # Weights variations of the nominal shape
+            for variation in histo.hist_obj.axes["variation"]:
+                if variation in self.available_shape_variations or (
+                    self.has_subsamples and variation in self.available_shape_variations_bysubsample[subsample]
+                ):
+                    continue
+                weight_varied = event_weights.get(variation, data_structure)
+                try:
+                    histo.hist_obj.fill(cat=category, variation=variation, weight=weight_varied[isnotnone], **fill)
+                except Exception as e:
+                    raise Exception(f"Cannot fill histogram: {name}, {histo} {e}")
+        else:
+            in_full_sample = shape_variation in self.available_shape_variations_bycat[category]
+            in_subsample = (self.has_subsamples and
+                            shape_variation in self.available_shape_variations_bysubsample_bycat[subsample][category])
+            if not in_full_sample and not in_subsample:
+                return
+            weight_nom = event_weights.get("nominal", data_structure)
+            try:
+                histo.hist_obj.fill(cat=category, variation=shape_variation, weight=weight_nom[isnotnone], **fill)
+            except Exception as e:
+                raise Exception(f"Cannot fill histogram: {name}, {histo} {e}")
@@ -0,0 +1,161 @@
+import numpy as np
+import awkward as ak
+import numba
+
+# Provenance codes of the partons, as in `pocket_coffea.lib.parton_provenance`:
+# -1=unknown, 1=higgs (g->bb for ttbb), 2=hadronic top bquark, 3=leptonic top bquark,
+# 4=additional radiation, 5=hadronic W (from top) decay quarks
+
+@numba.njit
+def _fill_top_decays(pdgId, start, ib, ibbar, iq1, iq2, out):
+    '''Tag the b-quarks of the top and anti-top (positions `ib`, `ibbar` in the event) and the quarks
+    of the hadronic W decay (positions `iq1`, `iq2`) of the partons of the event starting at `start`.
+    The top (anti-top) partons are collected as in the lists `top`, `antitop` of the original functions:
+    an inconsistent event (e.g. hadronic anti-top without b-quark) raises an IndexError as the original list access.'''
+    top = np.empty(3, dtype=np.int64)
+    antitop = np.empty(3, dtype=np.int64)
+    ntop = 0
+    nantitop = 0
+    hadr_top = 0  # 1==top, -1 antitop
+    if pdgId[start + ib] == 5:
+        top[ntop] = ib
+        ntop += 1
+    if pdgId[start + ibbar] == -5:
+        antitop[nantitop] = ibbar
+        nantitop += 1
+    q1 = pdgId[start + iq1]
+    q2 = pdgId[start + iq2]
+    if (q1 == 3 or q1 == 1) and (q2 == -4 or q2 == -2):
+        # Antitop decaying hadronically
+        antitop[nantitop] = iq1
+        antitop[nantitop + 1] = iq2
+        nantitop += 2
+        hadr_top = -1
+    elif (q1 == -3 or q1 == -1) and (q2 == 4 or q2 == 2):
+        # Top decaying hadronically
+        top[ntop] = iq1
+        top[ntop + 1] = iq2
+        ntop += 2
+        hadr_top = 1
+
+    if hadr_top == -1:
+        if nantitop < 3 or ntop < 1:
+            raise IndexError("getitem out of range")
+        out[start + antitop[0]] = 2
+        out[start + antitop[1]] = 5
+        out[start + antitop[2]] = 5
+        out[start + top[0]] = 3
+    elif hadr_top == 1:
+        if ntop < 3 or nantitop < 1:
+            raise IndexError("getitem out of range")
+        out[start + top[0]] = 2
+        out[start + top[1]] = 5
+        out[start + top[2]] = 5
+        out[start + antitop[0]] = 3
+
+
+@numba.njit
+def fill_partons_provenance_ttHbb(offsets, pdgId, out):
+    '''
+    Provenance of the partons of ttH(bb) events, same as `get_partons_provenance_ttHbb` of PocketCoffea.
+    - offsets, pdgId: offsets and flat content of the pdgId of the partons (LHE partons followed by the Higgs decay products)
+    - out: output, provenance code of each parton (same length as `pdgId`)
+    '''
+    for iev in range(offsets.shape[0] - 1):
+        start = offsets[iev]
+        n = offsets[iev + 1] - start
+        out[start:start + n] = -1
+        offset = 0
+        if n == 7:
+            offset = 1
+            # the first particle is the additional radiation
+            out[start] = 4
+        if n == 6 or n == 7:
+            _fill_top_decays(pdgId, start, offset, 1 + offset, 2 + offset, 3 + offset, out)
+            # The higgs is at the bottom
+            out[start + 4 + offset] = 1
+            out[start + 5 + offset] = 1
+        else:
+            # This is not the semileptonic case
+            if n < 4:
+                raise IndexError("setitem out of range")
+            out[start] = 2
+            out[start + 1] = 3
+            out[start + 2] = 1
+            out[start + 3] = 1
+
+
+@numba.njit
+def fill_partons_provenance_ttbb4F(offsets, pdgId, out):
+    '''
+    Provenance of the partons of ttbb (4 flavour scheme) events, same as `get_partons_provenance_ttbb4F` of PocketCoffea.
+    - offsets, pdgId: offsets and flat content of the pdgId of the partons
+    - out: output, provenance code of each parton (same length as `pdgId`)
+    '''
+    for iev in range(offsets.shape[0] - 1):
+        start = offsets[iev]
+        n = offsets[iev + 1] - start
+        out[start:start + n] = -1
+        if n < 2:
+            raise IndexError("setitem out of range")
+        offset = 0
+        if n == 7:
+            offset = 1
+            # the third particle is the additional radiation
+            out[start + 2] = 4
+        # The first two particles are always the additional g->bb particles
+        out[start] = 1
+        out[start + 1] = 1
+        if n == 6 or n == 7:
+            _fill_top_decays(pdgId, start, 2 + offset, 3 + offset, 4 + offset, 5 + offset, out)
+
+
+@numba.njit
+def fill_partons_provenance_tt5F(offsets, pdgId, out):
+    '''
+    Provenance of the partons of tt (5 flavour scheme) events, same as `get_partons_provenance_tt5F` of PocketCoffea.
+    - offsets, pdgId: offsets and flat content of the pdgId of the partons
+    - out: output, provenance code of each parton (same length as `pdgId`)
+    '''
+    for iev in range(offsets.shape[0] - 1):
+        start = offsets[iev]
+        n = offsets[iev + 1] - start
+        out[start:start + n] = -1
+        offset = 0
+        if n == 5:
+            offset = 1
+            # the first particle is the additional radiation
+            out[start] = 4
+        if n == 4 or n == 5:
+            _fill_top_decays(pdgId, start, offset, 1 + offset, 2 + offset, 3 + offset, out)
+
+
+def _get_partons_provenance(kernel, pdgIds):
+    '''Run the provenance `kernel` on the jagged array `pdgIds` and wrap the int32 codes
+    in a jagged array sharing the offsets of the packed `pdgIds`, without copying the buffer.'''
+    layout = ak.to_layout(ak.to_packed(ak.without_parameters(pdgIds, behavior={})))
+    offsets = np.asarray(layout.offsets)
+    if offsets[0] != 0:
+        offsets = offsets - offsets[0]
+    pdgId = np.asarray(layout.content.to_backend_array())[:offsets[-1]]
+    out = np.empty(len(pdgId), dtype=np.int32)
+    kernel(offsets, pdgId, out)
+    return ak.Array(ak.contents.ListOffsetArray(ak.index.Index64(offsets), ak.contents.NumpyArray(out)))
+
+
+def get_partons_provenance_ttHbb(pdgIds):
+    '''Provenance codes of the partons of ttH(bb) events from their jagged array of `pdgIds`:
+    1=higgs, 2=hadronic top bquark, 3=leptonic top bquark, 4=additional radiation, 5=hadronic W (from top) decay quarks.'''
+    return _get_partons_provenance(fill_partons_provenance_ttHbb, pdgIds)
+
+
+def get_partons_provenance_ttbb4F(pdgIds):
+    '''Provenance codes of the partons of ttbb (4 flavour scheme) events from their jagged array of `pdgIds`:
+    1=g->bb, 2=hadronic top bquark, 3=leptonic top bquark, 4=additional radiation, 5=hadronic W (from top) decay quarks.'''
+    return _get_partons_provenance(fill_partons_provenance_ttbb4F, pdgIds)
+
+
+def get_partons_provenance_tt5F(pdgIds):
+    '''Provenance codes of the partons of tt (5 flavour scheme) events from their jagged array of `pdgIds`:
+    2=hadronic top bquark, 3=leptonic top bquark, 4=additional radiation, 5=hadronic W (from top) decay quarks.'''
+    return _get_partons_provenance(fill_partons_provenance_tt5F, pdgIds)
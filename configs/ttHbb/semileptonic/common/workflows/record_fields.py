@@ -0,0 +1,53 @@
+import numpy as np
+import awkward as ak
+
+def with_fields(array, fields):
+    '''Attach all the `fields` {name: values} to the record array `array` (e.g. a collection of the events) in a single pass.
+    The values are broadcast to the structure of `array` as in `ak.with_field`, but the record layout is rebuilt once
+    for all the new fields instead of once per field. Existing fields with the same name are replaced.
+    The parameters of the record (e.g. the name of the collection) and the behavior of the array are preserved.'''
+    if len(fields) == 0:
+        return array
+    names = list(fields.keys())
+
+    def attach(layouts, **kwargs):
+        base = layouts[0]
+        if not base.is_record:
+            return None
+        contents = dict(zip(base.fields, base.contents))
+        for name, values in zip(names, layouts[1:]):
+            contents[name] = values
+        return ak.contents.RecordArray(
+            list(contents.values()), list(contents.keys()), length=base.length, parameters=base.parameters
+        )
+
+    return ak.transform(attach, array, *fields.values(), behavior=array.behavior)
+
+
+def get_working_point_labels(scores, working_points):
+    '''Get the labels of the working points {name: threshold} passed by `scores` (jagged array of discriminator values):
+    the label of a working point is 1 if the score is strictly greater than its threshold, 0 otherwise (also for NaN scores).
+    The labels of all the working points are obtained from a single comparison of the flat scores with the array of thresholds.
+    Returns a dictionary {name: labels} with the same structure as `scores`, sharing the offsets of the packed `scores`.'''
+    layout = ak.to_layout(ak.to_packed(ak.without_parameters(scores, behavior={})))
+    offsets = np.asarray(layout.offsets)
+    flat_scores = np.asarray(layout.content.data)[offsets[0]:offsets[-1]]
+    # The thresholds are kept in float64, so that the float32 scores are compared exactly as with `scores > threshold`
+    thresholds = np.array(list(working_points.values()), dtype=np.float64)
+    labels = np.less.outer(thresholds, flat_scores).astype(np.int64)
+    offsets = ak.index.Index64(offsets - offsets[0])
+    return {
+        wp: ak.Array(ak.contents.ListOffsetArray(offsets, ak.contents.NumpyArray(labels[i])))
+        for i, wp in enumerate(working_points.keys())
+    }
+
+
+def get_flat_fields(collection, fields):
+    '''Get the flat content of the requested `fields` of a jagged collection and its offsets.
+    The collection is packed once, so that the flat arrays are views over the same packed buffers.'''
+    packed = ak.to_packed(ak.without_parameters(collection[fields], behavior={}))
+    counts = ak.to_numpy(ak.num(packed, axis=1))
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    flat = ak.flatten(packed, axis=1)
+    return offsets, [np.asarray(ak.to_numpy(flat[field])) for field in fields]
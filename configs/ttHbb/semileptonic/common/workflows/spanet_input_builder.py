@@ -0,0 +1,153 @@
+import threading
+import numpy as np
+import awkward as ak
+import numba
+from .record_fields import get_flat_fields
+
+# Number of features of the jets in the SPANet input:
+# log(1+pt), eta, sin(phi), cos(phi), btag_L, btag_M, btag_H
+N_JET_FEATURES = 7
+N_MET_FEATURES = 4
+N_LEPTON_FEATURES = 5
+
+@numba.njit
+def fill_spanet_inputs(jet_offsets, jet_pt, jet_eta, jet_phi, jet_btag_L, jet_btag_M, jet_btag_H,
+                       met_pt, met_phi,
+                       lep_offsets, lep_pt, lep_eta, lep_phi, lep_is_electron,
+                       event_index, jet_data, jet_mask, met_data, lep_data, event_data):
+    '''
+    Fill the SPANet input tensors in a single pass over the events.
+    - jet_offsets, jet_*: offsets and flat content of the jet collection
+    - met_*: MET arrays (one entry per event)
+    - lep_offsets, lep_*: offsets and flat content of the lepton collection. Only the leading lepton is used.
+    - event_index: indices of the events to fill, the row `i` of the outputs is filled with the event `event_index[i]`
+    - jet_data (nevents, max_jets, 7), jet_mask (nevents, max_jets): output jet tensor and mask.
+      The jets beyond `max_jets` are clipped, the missing jets are padded as jets with pt=eta=phi=0.
+    - met_data (nevents, 1, 4), lep_data (nevents, 1, 5), event_data (nevents, 1, 1): output tensors.
+      The event tensor contains log(HT), where HT is computed from all the jets in the event.
+    '''
+    max_jets = jet_data.shape[1]
+    for row in range(event_index.shape[0]):
+        iev = event_index[row]
+        start = jet_offsets[iev]
+        stop = jet_offsets[iev + 1]
+        ht = 0.
+        for ij in range(stop - start):
+            ht += abs(jet_pt[start + ij])
+        for ij in range(max_jets):
+            if ij < stop - start:
+                pt = jet_pt[start + ij]
+                phi = jet_phi[start + ij]
+                jet_data[row, ij, 0] = np.log(1. + pt)
+                jet_data[row, ij, 1] = jet_eta[start + ij]
+                jet_data[row, ij, 2] = np.sin(phi)
+                jet_data[row, ij, 3] = np.cos(phi)
+                jet_data[row, ij, 4] = jet_btag_L[start + ij]
+                jet_data[row, ij, 5] = jet_btag_M[start + ij]
+                jet_data[row, ij, 6] = jet_btag_H[start + ij]
+                jet_mask[row, ij] = pt != 0
+            else:
+                # Padded jet: pt = eta = phi = 0
+                for ifeat in range(jet_data.shape[2]):
+                    jet_data[row, ij, ifeat] = 0.
+                jet_data[row, ij, 3] = 1.
+                jet_mask[row, ij] = False
+
+        met_data[row, 0, 0] = np.log(1. + met_pt[iev])
+        met_data[row, 0, 1] = 0.
+        met_data[row, 0, 2] = np.sin(met_phi[iev])
+        met_data[row, 0, 3] = np.cos(met_phi[iev])
+
+        ilep = lep_offsets[iev]
+        if lep_offsets[iev + 1] > ilep:
+            lep_data[row, 0, 0] = np.log(1. + lep_pt[ilep])
+            lep_data[row, 0, 1] = lep_eta[ilep]
+            lep_data[row, 0, 2] = np.sin(lep_phi[ilep])
+            lep_data[row, 0, 3] = np.cos(lep_phi[ilep])
+            lep_data[row, 0, 4] = lep_is_electron[ilep]
+        else:
+            for ifeat in range(lep_data.shape[2]):
+                lep_data[row, 0, ifeat] = 0.
+
+        event_data[row, 0, 0] = np.log(ht)
+
+
+class SpanetInputBuilder:
+    '''Builder of the SPANet input tensors from the `JetGood`, `MET` and `LeptonGood` collections.
+    The flat content of the collections is read once and the tensors are filled by a compiled kernel.
+    The output buffers are preallocated and reused across chunks: they are reallocated only when
+    a chunk with more events than the current capacity is processed.
+    N.B.: the arrays returned by `build` are views of the internal buffers and they are overwritten by the next call.
+
+    :param max_jets: number of jets of the SPANet input (the jets are clipped and padded to this length)
+    :param btag_fields: names of the fields of `JetGood` with the b-tagging working points labels
+    '''
+    def __init__(self, max_jets=16, btag_fields=("btag_L", "btag_M", "btag_H")):
+        if len(btag_fields) != 3:
+            raise ValueError("The SPANet input requires exactly 3 b-tagging working points.")
+        self.max_jets = max_jets
+        self.btag_fields = tuple(btag_fields)
+        self.capacity = 0
+        self._buffers = None
+
+    def __getstate__(self):
+        # The buffers are not shipped: they are reallocated on first use
+        return {"max_jets": self.max_jets, "btag_fields": self.btag_fields, "capacity": 0, "_buffers": None}
+
+    def _allocate(self, nevents):
+        if (self._buffers is not None) and (nevents <= self.capacity):
+            return
+        self.capacity = nevents
+        self._buffers = {
+            "Jet_data": np.empty((nevents, self.max_jets, N_JET_FEATURES), dtype=np.float32),
+            "Jet_mask": np.empty((nevents, self.max_jets), dtype=bool),
+            "Met_data": np.empty((nevents, 1, N_MET_FEATURES), dtype=np.float32),
+            "Lepton_data": np.empty((nevents, 1, N_LEPTON_FEATURES), dtype=np.float32),
+            "Event_data": np.empty((nevents, 1, 1), dtype=np.float32),
+            "global_mask": np.ones((nevents, 1), dtype=bool),
+        }
+
+    def get_flat_inputs(self, events):
+        '''Read the flat content of the `JetGood`, `MET` and `LeptonGood` collections.
+        The result can be passed to `fill` several times, e.g. for different subsets of events.'''
+        jet_offsets, jet_fields = get_flat_fields(events.JetGood, ["pt", "eta", "phi", *self.btag_fields])
+        lep_offsets, lep_fields = get_flat_fields(events.LeptonGood, ["pt", "eta", "phi", "is_electron"])
+        met_fields = [ak.to_numpy(events.MET.pt), ak.to_numpy(events.MET.phi)]
+        return (jet_offsets, *jet_fields, *met_fields, lep_offsets, *lep_fields)
+
+    def fill(self, flat_inputs, event_index):
+        '''Return the input feed of the SPANet model for the events `event_index` of the flat inputs.'''
+        nevents = len(event_index)
+        self._allocate(nevents)
+        buffers = {key: value[:nevents] for key, value in self._buffers.items()}
+        fill_spanet_inputs(*flat_inputs, np.asarray(event_index, dtype=np.int64),
+                           buffers["Jet_data"], buffers["Jet_mask"], buffers["Met_data"],
+                           buffers["Lepton_data"], buffers["Event_data"])
+        return {
+            "Jet_data": buffers["Jet_data"],
+            "Jet_mask": buffers["Jet_mask"],
+            "Met_data": buffers["Met_data"],
+            "Met_mask": buffers["global_mask"],
+            "Lepton_data": buffers["Lepton_data"],
+            "Lepton_mask": buffers["global_mask"],
+            "Event_data": buffers["Event_data"],
+            "Event_mask": buffers["global_mask"],
+        }
+
+    def build(self, events):
+        '''Return the input feed of the SPANet model for the `events` of the chunk.'''
+        return self.fill(self.get_flat_inputs(events), np.arange(len(events)))
+
+
+# Builders local to each thread, so that the buffers are reused across the chunks
+# processed by the same thread, never shared by concurrent chunks and released with the thread.
+_local = threading.local()
+
+def get_spanet_input_builder(max_jets=16, btag_fields=("btag_L", "btag_M", "btag_H")):
+    builders = getattr(_local, "builders", None)
+    if builders is None:
+        builders = _local.builders = {}
+    key = (max_jets, tuple(btag_fields))
+    if key not in builders:
+        builders[key] = SpanetInputBuilder(max_jets=max_jets, btag_fields=btag_fields)
+    return builders[key]
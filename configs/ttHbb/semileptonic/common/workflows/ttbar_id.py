@@ -0,0 +1,72 @@
+import numpy as np
+import awkward as ak
+
+# Classes of genTtbarId % 100 of the tt+jets samples
+# (https://twiki.cern.ch/twiki/bin/view/CMSPublic/GenHFHadronMatcher, visited on 23.11.2023)
+TTBAR_ID_NAMES = {
+    0  : "tt+LF",
+    41 : "tt+c",
+    42 : "tt+2c",
+    43 : "tt+cc",
+    44 : "tt+c2c",
+    45 : "tt+2c2c",
+    46 : "tt+C",
+    51 : "tt+b",
+    52 : "tt+2b",
+    53 : "tt+bb",
+    54 : "tt+b2b",
+    55 : "tt+2b2b",
+    56 : "tt+B",
+}
+TTBAR_IDS = list(TTBAR_ID_NAMES.keys())
+
+# Coarse classes of the tt+jets events, indexed by the value of the ttbar class column
+TTBAR_CLASSES = ["tt+LF", "tt+C", "tt+B"]
+
+# Class of the event from genTtbarId % 100 (-1 if not in any of the classes): tt+LF: 0, tt+C: 41-46, tt+B: 51-56
+_TTBAR_CLASS_LOOKUP = np.full(100, -1, dtype=np.int8)
+_TTBAR_CLASS_LOOKUP[0] = 0
+_TTBAR_CLASS_LOOKUP[41:47] = 1
+_TTBAR_CLASS_LOOKUP[51:57] = 2
+
+# Columns of the events with genTtbarId % 100 and with the class of the event
+TTBAR_ID_FIELD = "genTtbarId_100"
+TTBAR_CLASS_FIELD = "genTtbarClass"
+
+
+def compute_ttbar_id(events):
+    '''Compute genTtbarId % 100 and the class of the tt+jets events (index in TTBAR_CLASSES, -1 for the other events)
+    as numpy arrays, in a single pass over genTtbarId. The processors attach them to the events after the preselection
+    as the columns TTBAR_ID_FIELD and TTBAR_CLASS_FIELD.'''
+    ttbar_id = (ak.to_numpy(events.genTtbarId) % 100).astype(np.int8)
+    return ttbar_id, _TTBAR_CLASS_LOOKUP[ttbar_id]
+
+
+def get_ttbar_id(events):
+    '''Get genTtbarId % 100 and the class of the tt+jets events as numpy arrays, read from the columns
+    TTBAR_ID_FIELD and TTBAR_CLASS_FIELD computed by the processor (see `compute_ttbar_id`).'''
+    if (TTBAR_ID_FIELD not in events.fields) or (TTBAR_CLASS_FIELD not in events.fields):
+        raise KeyError(f"The columns `{TTBAR_ID_FIELD}` and `{TTBAR_CLASS_FIELD}` are not available: they have to be computed "
+                       "by the processor with `compute_ttbar_id` after the preselection.")
+    return ak.to_numpy(events[TTBAR_ID_FIELD]), ak.to_numpy(events[TTBAR_CLASS_FIELD])
+
+
+def get_ttbar_class(events):
+    '''Index in TTBAR_CLASSES of the class of the tt+jets events (-1 for the other events).'''
+    return get_ttbar_id(events)[1]
+
+
+def get_ttbar_id_lookup(ids):
+    '''Boolean lookup table over genTtbarId % 100 selecting the `ids`.'''
+    for _id in ids:
+        if _id not in TTBAR_IDS:
+            raise Exception(f"The cut on genTtbarId % 100 must be an integer between 0 and 56.\nPossible choices:{TTBAR_IDS}")
+    lookup = np.zeros(100, dtype=bool)
+    lookup[list(ids)] = True
+    return lookup
+
+
+def ttbar_id_mask(events, ids):
+    '''Mask of the events with genTtbarId % 100 in `ids`, read from the ttbar id column of the events.'''
+    ttbar_id, _ = get_ttbar_id(events)
+    return get_ttbar_id_lookup(ids)[ttbar_id]
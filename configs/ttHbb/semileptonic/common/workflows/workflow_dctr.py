@@ -1,11 +1,24 @@
-import json
 import pickle
 import numpy as np
 import awkward as ak
-from dask.distributed import get_worker
 from .workflow_spanet import SpanetInferenceProcessor
+from .bjet_pairs import BJET_PAIR_OBSERVABLES
 from ..params.quantile_transformer import WeightedQuantileTransformer
+from ..executors.session_registry import get_inference_session
+from .feature_store import get_feature_store, load_features
+from ..params.lookup_tables import LookupTables
+from ..executors.fuse_dctr_model import is_fused_model, get_fused_input_features, WEIGHT_OUTPUT_NAME
 from sklearn.preprocessing import StandardScaler
+from pocket_coffea.lib.weights.weights_manager import WeightsManager
+
+# Standard scalers loaded by the current process, keyed by file path
+_scalers = {}
+
+def load_standard_scaler(filename):
+    if filename not in _scalers:
+        with open(filename, "rb") as f:
+            _scalers[filename] = pickle.load(f)
+    return _scalers[filename]
 
 def get_input_features(events, mask=None, only=None):
     input_features = {
@@ -47,48 +60,96 @@ def get_input_features(events, mask=None, only=None):
     return input_features
 
 class DCTRInferenceProcessor(SpanetInferenceProcessor):
+    # Inputs of the SPANet and DCTR models
+    required_derived_columns = SpanetInferenceProcessor.required_derived_columns + [
+        "BJetGood_Ht", "LightJetGood_Ht", *BJET_PAIR_OBSERVABLES
+    ]
+
     def __init__(self, cfg) -> None:
         super().__init__(cfg=cfg)
         if not "dctr_model" in self.workflow_options:
             raise ValueError("Key `dctr_model` not found in workflow options. Please specify the path to the ONNX model.")
         elif not self.workflow_options["dctr_model"].endswith(".onnx"):
             raise ValueError("Key `dctr_model` should be the path of an ONNX model.")
+        # The lookup tables of the DCTR parameters are compiled here and shipped to the workers with the processor
+        self.lookup_tables = LookupTables.from_params(self.params)
+
+    def define_weights(self):
+        # WeightsManager of the base processor, with the lookup tables shipped with the processor
+        # in the metadata of the chunk: the weights (e.g. `SF_njet_reweighting`) read the compiled tables instead of the files
+        self.weights_manager = WeightsManager(
+            self.params,
+            self.weights_config_allsamples[self._sample],
+            self.weights_classes,
+            storeIndividual=False,
+            metadata={
+                "year": self._year,
+                "sample": self._sample,
+                "dataset": self._dataset,
+                "part": self._samplePart,
+                "xsec": self._xsec if self._isMC else None,
+                "isMC": self._isMC,
+                "lookup_tables": self.lookup_tables,
+            }
+        )
 
     def process_extra_after_presel(self, variation) -> ak.Array:
         super().process_extra_after_presel(variation)
 
-        try:
-            worker = get_worker()
-        except ValueError:
-            worker = None
-
-        if worker is None:
-            import onnxruntime as ort
-            sess_options = ort.SessionOptions()
-            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-            model_session = ort.InferenceSession(
-                self.workflow_options["dctr_model"],
-                sess_options = sess_options,
-                providers=['CPUExecutionProvider']
+        # The scores already computed with the same model are loaded from the feature store (if configured)
+        store = get_feature_store(self.workflow_options, "dctr", self.workflow_options["dctr_model"], ["score"])
+        dctr_output, missing = load_features(store, self.events, variation, ["score"])
+
+        if np.any(missing):
+            # The session is loaded once per process (or Dask worker) by the session registry
+            model_session = get_inference_session("dctr", self.workflow_options["dctr_model"])
+
+            print(model_session)
+            print("Available providers:", model_session.get_providers())
+
+            # Here we have to distinguish between the model with 8 or 26 input features
+            input_features = get_input_features(
+                self.events,
+                mask=None if np.all(missing) else missing,
+                only=self.params.dctr["input_features"]
             )
-        else:
-            model_session = worker.data['model_session_dctr']
+            fused = is_fused_model(model_session)
+            if fused:
+                # The standardisation of the features is part of the fused graph
+                fused_features = get_fused_input_features(model_session)
+                if set(fused_features) != set(input_features.keys()):
+                    raise ValueError(f"The input features of the fused DCTR model {fused_features} do not match the configured ones {list(input_features.keys())}.")
+                data = np.empty((len(input_features[fused_features[0]]), len(fused_features)), dtype=np.float32)
+                for i, feature in enumerate(fused_features):
+                    data[:,i] = input_features[feature]
+            else:
+                data = np.stack(list(input_features.values()), axis=1).astype(np.float32)
+                # Load the standard scaler fitted during the training data preprocessing and apply the same transformation to the input data
+                scaler = load_standard_scaler(self.params.dctr["standard_scaler"]["file"])
+                data = scaler.transform(data)
 
-        print(model_session)
-        print("Available providers:", model_session.get_providers())
+            print("DCTR input type:", data.dtype)
+            print("DCTR input shape:", data.shape)
 
-        # Here we have to distinguish between the model with 8 or 26 input features
-        input_features = get_input_features(self.events, only=self.params.dctr["input_features"])
-        data = np.stack(list(input_features.values()), axis=1).astype(np.float32)
-        # Load the standard scaler fitted during the training data preprocessing and apply the same transformation to the input data
-        scaler = pickle.load(open(self.params.dctr["standard_scaler"]["file"], "rb"))
-        data = scaler.transform(data)
+            if fused:
+                score, weight = model_session.run(output_names=['output', WEIGHT_OUTPUT_NAME], input_feed={'input': data})
+                dctr_output["score"][missing] = score[:,0]
+                dctr_output["weight"] = np.full(len(missing), np.nan, dtype=np.float32)
+                dctr_output["weight"][missing] = weight[:,0]
+            else:
+                dctr_output["score"][missing] = model_session.run(output_names=['output'], input_feed={'input': data})[0][:,0]
 
-        print("DCTR input type:", data.dtype)
-        print("DCTR input shape:", data.shape)
+            if store is not None:
+                events_to_infer = self.events if np.all(missing) else self.events[missing]
+                store.save(events_to_infer, variation, {"score": dctr_output["score"][missing]})
 
-        out = ak.Array(model_session.run(output_names=['output'], input_feed={'input': data})[0][:,0])
-        dctr_weight = out / (1 - out)
+        out = ak.Array(dctr_output["score"])
+        if "weight" in dctr_output:
+            # Weight computed by the fused model, the scores loaded from the feature store are transformed here
+            dctr_weight = np.where(missing, dctr_output["weight"], dctr_output["score"] / (1 - dctr_output["score"]))
+            dctr_weight = ak.Array(dctr_weight)
+        else:
+            dctr_weight = out / (1 - out)
 
         print("DCTR output:", out)
 
@@ -99,26 +160,15 @@ class DCTRInferenceProcessor(SpanetInferenceProcessor):
 
         self.events["dctr_output"] = ak.zip(dctr_dict)
 
-        with open(self.params.dctr["weight_cuts"]["by_njet"]["file"]) as f:
-            w_cuts = json.load(f)
-        for key in w_cuts.keys():
-            w_cuts[key][2][1] = float("inf")
         # Integer index to label the different regions, based on the number of jets and the DCTR score
         # 4j: 1, 2, 3
         # 5j: 4, 5, 6
         # 6j: 7, 8, 9
         # >=7j: 10, 11, 12
-        w_dctr_index = ak.zeros_like(self.events.event, dtype=int)
-        for j, nj in enumerate([4, 5, 6, 7]):
-            if nj == 7:
-                mask_njet = self.events.nJetGood >= nj
-                w_cuts_list = w_cuts[f"njet>={nj}"]
-            else:
-                mask_njet = self.events.nJetGood == nj
-                w_cuts_list = w_cuts[f"njet={nj}"]
-            for i, cut in enumerate(w_cuts_list):
-                w_lo, w_hi = cut
-                mask = mask_njet & (self.events.dctr_output.weight >= w_lo) & (self.events.dctr_output.weight < w_hi)
-                w_dctr_index = ak.where(mask, i + 3*j + 1, w_dctr_index)
-
+        # The table of the weight cuts is shipped with the processor
+        region_index = self.lookup_tables.dctr_region_index
+        w_dctr_index = ak.Array(region_index(
+            ak.to_numpy(self.events.nJetGood),
+            ak.to_numpy(self.events.dctr_output.weight)
+        ))
         self.events["dctr_output"] = ak.with_field(self.events.dctr_output, w_dctr_index, "index")
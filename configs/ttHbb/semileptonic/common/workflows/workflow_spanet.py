@@ -1,105 +1,177 @@
 import os
 import sys
 import awkward as ak
-from dask.distributed import get_worker
+from concurrent.futures import ThreadPoolExecutor
 
 from .workflow_tthbb import ttHbbPartonMatchingProcessor
-from ..params.quantile_transformer import WeightedQuantileTransformer
+from ..params.quantile_transformer import load_quantile_transformer
+from ..executors.session_registry import get_inference_session
+from .spanet_input_builder import get_spanet_input_builder
+from .feature_store import get_feature_store, load_features
 
 import numpy as np
 
+def run_batched_inference(model_session, input_feed, output_names, batch_size=None, n_threads=1):
+    '''Run `model_session` over micro-batches of `batch_size` events.
+    The input tensors are sliced along the first axis (no copy) and the batches are run
+    concurrently on a pool of `n_threads` threads sharing the same session, since the ONNX runtime releases the GIL.
+    The outputs are written into preallocated buffers, in the original event order.
+    If `batch_size` is None the whole input is run in a single call.'''
+    nevents = len(next(iter(input_feed.values())))
+    if (batch_size is None) or (batch_size >= nevents):
+        return model_session.run(output_names=output_names, input_feed=input_feed)
+
+    def _run_batch(start):
+        stop = min(start + batch_size, nevents)
+        return start, stop, model_session.run(
+            output_names=output_names,
+            input_feed={key: value[start:stop] for key, value in input_feed.items()}
+        )
+
+    # The first batch is run synchronously to get the shape and type of the outputs
+    _, stop, outputs_batch = _run_batch(0)
+    outputs = [np.empty((nevents, *out.shape[1:]), dtype=out.dtype) for out in outputs_batch]
+    for buffer, out in zip(outputs, outputs_batch):
+        buffer[:stop] = out
+
+    def _fill_batch(start):
+        start, stop, outputs_batch = _run_batch(start)
+        for buffer, out in zip(outputs, outputs_batch):
+            buffer[start:stop] = out
+
+    starts = range(batch_size, nevents, batch_size)
+    if n_threads > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            # Consume the iterator to propagate the exceptions raised in the threads
+            list(pool.map(_fill_batch, starts))
+    else:
+        for start in starts:
+            _fill_batch(start)
+    return outputs
+
+# Number of jets of the SPANet input
+SPANET_MAX_JETS = 16
+
+def run_bucketed_inference(model_session, events, output_names, jet_buckets, batch_size=None, n_threads=1):
+    '''Run the SPANet inference grouping the events in buckets of jet multiplicity.
+    Each event goes to the smallest bucket with padding length >= its number of jets
+    (the events with more jets than the largest bucket are clipped to it) and each bucket is run
+    with its own padding length, so that the attention is not computed over the padded jets.
+    The outputs are returned in the original order of the events.'''
+    jet_buckets = np.asarray(jet_buckets)
+    builders = {max_jets: get_spanet_input_builder(max_jets=int(max_jets)) for max_jets in jet_buckets}
+    # The flat content of the collections is read once and shared by all the buckets
+    flat_inputs = builders[jet_buckets[-1]].get_flat_inputs(events)
+    njet = np.diff(flat_inputs[0])
+    bucket = np.minimum(np.searchsorted(jet_buckets, njet, side="left"), len(jet_buckets) - 1)
+
+    outputs = None
+    for ibucket, max_jets in enumerate(jet_buckets):
+        event_index = np.nonzero(bucket == ibucket)[0]
+        if len(event_index) == 0:
+            continue
+        input_feed = builders[max_jets].fill(flat_inputs, event_index)
+        outputs_bucket = run_batched_inference(model_session, input_feed, output_names, batch_size=batch_size, n_threads=n_threads)
+        if outputs is None:
+            outputs = [np.empty((len(events), *out.shape[1:]), dtype=out.dtype) for out in outputs_bucket]
+        for buffer, out in zip(outputs, outputs_bucket):
+            buffer[event_index] = out
+    return outputs
+
 class SpanetInferenceProcessor(ttHbbPartonMatchingProcessor):
+    # Inputs of the SPANet model
+    required_derived_columns = ["JetGood.btag_L", "JetGood.btag_M", "JetGood.btag_H", "LeptonGood.is_electron"]
+
     def __init__(self, cfg) -> None:
         super().__init__(cfg=cfg)
         if not "spanet_model" in self.workflow_options:
             raise ValueError("Key `spanet_model` not found in workflow options. Please specify the path to the ONNX model.")
         elif not self.workflow_options["spanet_model"].endswith(".onnx"):
             raise ValueError("Key `spanet_model` should be the path of an ONNX model.")
+        # Configuration of the inference stage:
+        # - spanet_batch_size: number of events per call to the ONNX session (None: the full chunk in a single call)
+        # - spanet_inference_threads: number of threads running the micro-batches concurrently on the same session
+        # - spanet_intra_op_num_threads: number of threads used internally by the ONNX runtime for each call
+        # - spanet_jet_buckets: padding lengths of the buckets of jet multiplicity, e.g. [6, 8, 10, 16] (None: all the events padded to 16 jets)
+        # - feature_store: local folder where the ML scores are stored and reused by later runs (None: disabled)
+        self.spanet_batch_size = self.workflow_options.get("spanet_batch_size", 8192)
+        self.spanet_inference_threads = self.workflow_options.get("spanet_inference_threads", 1)
+        self.spanet_intra_op_num_threads = self.workflow_options.get("spanet_intra_op_num_threads", 1)
+        if (self.spanet_batch_size is not None) and (self.spanet_batch_size < 1):
+            raise ValueError("Key `spanet_batch_size` should be a positive integer or None.")
+        if self.spanet_inference_threads < 1:
+            raise ValueError("Key `spanet_inference_threads` should be a positive integer.")
+        self.spanet_jet_buckets = self.workflow_options.get("spanet_jet_buckets", None)
+        if self.spanet_jet_buckets is not None:
+            self.spanet_jet_buckets = sorted(self.spanet_jet_buckets)
+            if (self.spanet_jet_buckets[0] < 1) or (self.spanet_jet_buckets[-1] != SPANET_MAX_JETS):
+                raise ValueError(f"Key `spanet_jet_buckets` should be a list of positive padding lengths, with the largest equal to {SPANET_MAX_JETS}.")
+        if self.spanet_intra_op_num_threads < 0:
+            raise ValueError("Key `spanet_intra_op_num_threads` should be a non-negative integer (0: default of the ONNX runtime).")
 
 
     def process_extra_after_presel(self, variation) -> ak.Array:
         super().process_extra_after_presel(variation)
 
-        try:
-            worker = get_worker()
-        except ValueError:
-            worker = None
-
-        if worker is None:
-            import onnxruntime as ort
-            sess_options = ort.SessionOptions()
-            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
-            sess_options.intra_op_num_threads = 1
-            model_session = ort.InferenceSession(
-                self.workflow_options["spanet_model"],
-                sess_options = sess_options,
-                providers=['CPUExecutionProvider']
-            )
-        else:
-            model_session = worker.data['model_session_spanet']
+        output_names = ["EVENT/tthbb", "EVENT/ttbb", "EVENT/ttcc", "EVENT/ttlf"]
+        fields = [key.split("/")[-1] for key in output_names]
 
-        print(model_session)
+        # The scores already computed with the same model are loaded from the feature store (if configured)
+        store = get_feature_store(self.workflow_options, "spanet", self.workflow_options["spanet_model"], fields)
+        spanet_output, missing = load_features(store, self.events, variation, fields)
 
-        btagging_algorithm = self.params.btagging.working_point[self._year]["btagging_algorithm"]
-        pad_dict = {btagging_algorithm:0., "btag_L":0, "btag_M":0, "btag_H":0,"pt":0., "phi":0., "eta":0.}
-        jets_padded = ak.zip(
-            {key : ak.fill_none(ak.pad_none(self.events.JetGood[key], 16, clip=True), value) for key, value in pad_dict.items()}
-        )
+        if np.any(missing):
+            events_to_infer = self.events if np.all(missing) else self.events[missing]
 
-        data = np.transpose(
-            np.stack([
-                np.log(1 + ak.to_numpy(jets_padded.pt)),
-                ak.to_numpy(jets_padded.eta),
-                np.sin(ak.to_numpy(jets_padded.phi)),
-                np.cos(ak.to_numpy(jets_padded.phi)),
-                ak.to_numpy(jets_padded.btag_L),
-                ak.to_numpy(jets_padded.btag_M),
-                ak.to_numpy(jets_padded.btag_H)
-            ]),
-            axes=[1,2,0]).astype(np.float32)
-
-        mask = ~ak.to_numpy(jets_padded.pt == 0)
-
-        met_data = np.stack([np.log(1+ ak.to_numpy(self.events.MET.pt)),
-                             ak.zeros_like(self.events.MET.pt).to_numpy(),
-                             np.sin(ak.to_numpy(self.events.MET.phi)),
-                             np.cos(ak.to_numpy(self.events.MET.phi))
-                             ], axis=1)[:,None,:].astype(np.float32)
-
-        lep_data = np.stack([np.log(1 + ak.to_numpy(self.events.LeptonGood[:,0].pt)),
-                             ak.to_numpy(self.events.LeptonGood[:,0].eta),
-                             np.sin(ak.to_numpy(self.events.LeptonGood[:,0].phi)),
-                             np.cos(ak.to_numpy(self.events.LeptonGood[:,0].phi)),
-                             ak.to_numpy(self.events.LeptonGood[:,0].is_electron).astype(np.int32),
-                             ], axis=1)[:,None,:].astype(np.float32)
-
-        ht_array = ak.to_numpy(np.log(self.events.JetGood_Ht[:,None, None])).astype(np.float32)
-
-        mask_global = np.ones(shape=[met_data.shape[0], 1]) == 1
+            # The session is loaded once per process (or Dask worker) by the session registry
+            model_session = get_inference_session(
+                "spanet",
+                self.workflow_options["spanet_model"],
+                intra_op_num_threads=self.spanet_intra_op_num_threads
+            )
 
-        output_names = ["EVENT/tthbb", "EVENT/ttbb", "EVENT/ttcc", "EVENT/ttlf"]
-        outputs = model_session.run(input_feed={
-            "Jet_data": data,
-            "Jet_mask": mask,
-            "Met_data": met_data,
-            "Met_mask": mask_global,
-            "Lepton_data": lep_data,
-            "Lepton_mask": mask_global,
-            "Event_data": ht_array, 
-            "Event_mask": mask_global},
-        output_names=output_names
-        )
+            print(model_session)
+
+            if self.spanet_jet_buckets is not None:
+                outputs = run_bucketed_inference(
+                    model_session,
+                    events_to_infer,
+                    output_names=output_names,
+                    jet_buckets=self.spanet_jet_buckets,
+                    batch_size=self.spanet_batch_size,
+                    n_threads=self.spanet_inference_threads
+                )
+            else:
+                # Build the SPANet input tensors in a single compiled pass over the JetGood, MET and LeptonGood collections
+                input_feed = get_spanet_input_builder(max_jets=SPANET_MAX_JETS).build(events_to_infer)
+
+                outputs = run_batched_inference(
+                    model_session,
+                    input_feed=input_feed,
+                    output_names=output_names,
+                    batch_size=self.spanet_batch_size,
+                    n_threads=self.spanet_inference_threads
+                )
+            for field, value in zip(fields, outputs):
+                spanet_output[field][missing] = value[:,1]
+
+            if store is not None:
+                store.save(events_to_infer, variation, {field: spanet_output[field][missing] for field in fields})
 
-        outputs_zipped = dict(zip(output_names, outputs))
         self.events["spanet_output"] = ak.zip(
             {
-                key.split("/")[-1]: ak.from_numpy(value[:,1]) for key, value in outputs_zipped.items()
+                field: ak.from_numpy(value) for field, value in spanet_output.items()
             }
         )
 
-        # Transform ttHbb score with quantile transformation
+        # Transform ttHbb score with quantile transformation.
+        # The transformer is loaded once per process and cached until the file is modified.
         params_quantile_transformer = self.params["quantile_transformer"][self.events.metadata["year"]]
-        transformer = WeightedQuantileTransformer(n_quantiles=params_quantile_transformer["n_quantiles"], output_distribution=params_quantile_transformer["output_distribution"])
-        transformer.load(params_quantile_transformer["file"])
+        transformer = load_quantile_transformer(
+            params_quantile_transformer["file"],
+            n_quantiles=params_quantile_transformer["n_quantiles"],
+            output_distribution=params_quantile_transformer["output_distribution"],
+            lookup_tolerance=params_quantile_transformer.get("lookup_tolerance", None)
+        )
         transformed_score = transformer.transform(self.events.spanet_output.tthbb)
         self.events["spanet_output"] = ak.with_field(self.events["spanet_output"], transformed_score, "tthbb_transformed")
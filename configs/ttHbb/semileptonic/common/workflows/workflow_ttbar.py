@@ -1,14 +1,34 @@
 import awkward as ak
 from pocket_coffea.workflows.tthbb_base_processor import ttHbbBaseProcessor
 from pocket_coffea.lib.objects import met_xy_correction
-from pocket_coffea.lib.deltaR_matching import metric_eta, metric_phi
-from pocket_coffea.lib.deltaR_matching import object_matching
-from pocket_coffea.lib.parton_provenance import get_partons_provenance_ttHbb, get_partons_provenance_ttbb4F, get_partons_provenance_tt5F
+from .deltaR_matching import object_matching, MATCHING_METHODS
+from .parton_provenance import get_partons_provenance_ttHbb, get_partons_provenance_ttbb4F, get_partons_provenance_tt5F
+from .record_fields import with_fields
+from .ttbar_id import compute_ttbar_id, TTBAR_ID_FIELD, TTBAR_CLASS_FIELD
+from .derived_columns import TTHBB_DERIVED_COLUMNS, DerivedColumns, get_config_columns, get_preselection_columns
+from ..cuts.cut_cache import get_cut_cache, fill_cut_evaluations
+from .partition_hist_manager import PartitionHistManager
 
 class ttbarPartonMatchingProcessor(ttHbbBaseProcessor):
+    # Derived columns needed by the processor, on top of the ones used by the configuration
+    required_derived_columns = []
+
     def __init__(self, cfg) -> None:
         super().__init__(cfg=cfg)
         self.dr_min = self.workflow_options["parton_jet_min_dR"]
+        # Parton-jet matching: `greedy` (pairs taken by increasing deltaR) or `hungarian` (optimal assignment)
+        self.parton_matching_method = self.workflow_options.get("parton_matching_method", "greedy")
+        if self.parton_matching_method not in MATCHING_METHODS:
+            raise ValueError(f"Key `parton_matching_method` should be one of {MATCHING_METHODS}.")
+        # The derived columns requested in the workflow options and the ones declared by the preselection cuts
+        # are computed before the preselection; the ones used by the histograms, the output columns, the categories,
+        # the subsamples, the weights and the processor after the preselection. The other derived columns are never computed.
+        self.derived_columns_before_presel = TTHBB_DERIVED_COLUMNS.resolve(
+            self.workflow_options.get("derived_columns", []), strict=True
+        ) + TTHBB_DERIVED_COLUMNS.resolve(get_preselection_columns(self.cfg))
+        self.derived_columns_after_presel = TTHBB_DERIVED_COLUMNS.resolve(
+            get_config_columns(self.cfg) | set(self.required_derived_columns)
+        )
 
     @classmethod
     def available_variations(cls):
@@ -23,21 +43,14 @@ class ttbarPartonMatchingProcessor(ttHbbBaseProcessor):
 
     def apply_object_preselection(self, variation):
         super().apply_object_preselection(variation=variation)
+        # Derived columns of the current chunk and variation, computed on first access
+        self.derived = DerivedColumns(TTHBB_DERIVED_COLUMNS, self, variation)
 
         # MET xy correction
         met_pt_corr, met_phi_corr = met_xy_correction(self.params, self.events, self._year, self._era)
 
         # Overwrite the MET collection with the corrected MET
-        self.events["MET"] = ak.with_field(
-            self.events.MET,
-            met_pt_corr,
-            "pt"
-        )
-        self.events["MET"] = ak.with_field(
-            self.events.MET,
-            met_phi_corr,
-            "phi"
-        )
+        self.events["MET"] = with_fields(self.events.MET, {"pt": met_pt_corr, "phi": met_phi_corr})
 
         if self._isMC:
             # Apply the GenJet acceptance cuts
@@ -55,35 +68,15 @@ class ttbarPartonMatchingProcessor(ttHbbBaseProcessor):
             self.events["CGenJetGood"] = self.events.GenJet[mask_acceptance & mask_c]
             self.events["LGenJetGood"] = self.events.GenJet[mask_acceptance & mask_l]
 
-    def define_common_variables_after_presel(self, variation):
+    def define_common_variables_before_presel(self, variation):
         super().define_common_variables_before_presel(variation=variation)
+        self.derived.materialize(self.derived_columns_before_presel)
 
-        # Compute deltaR(b, b) of all possible b-jet pairs.
-        # We require deltaR > 0 to exclude the deltaR between the jets with themselves
-        deltaR = ak.flatten(self.events["BJetGood"].metric_table(self.events["BJetGood"]), axis=2)
-        deltaEta = ak.flatten(self.events["BJetGood"].metric_table(self.events["BJetGood"], metric=metric_eta), axis=2)
-        deltaPhi = ak.flatten(self.events["BJetGood"].metric_table(self.events["BJetGood"], metric=metric_phi), axis=2)
-        deltaR = deltaR[deltaR > 0.]
-        deltaEta = deltaEta[deltaEta > 0.]
-        deltaPhi = deltaPhi[deltaPhi > 0.]
-
-        # Get the deltaR with no possibility of repetition of identical b-jet pairs
-
-        # Get all the possible combinations of b-jet pairs
-        pairs = ak.argcombinations(self.events["BJetGood"], 2, axis=1)
-        b1 = self.events.BJetGood[pairs.slot0]
-        b2 = self.events.BJetGood[pairs.slot1]
-
-        # Compute deltaR between the pairs
-        deltaR_unique = b1.delta_r(b2)
-        idx_pairs_sorted = ak.argsort(deltaR_unique, axis=1)
-        pairs_sorted = pairs[idx_pairs_sorted]
-
-        # Compute the minimum deltaR(b, b), deltaEta(b, b), deltaPhi(b, b) and the invariant mass of the closest b-jet pair
-        self.events["deltaRbb_min"] = ak.min(deltaR, axis=1)
-        self.events["deltaEtabb_min"] = ak.min(deltaEta, axis=1)
-        self.events["deltaPhibb_min"] = ak.min(deltaPhi, axis=1)
-        self.events["mbb"] = (self.events.BJetGood[pairs_sorted.slot0] + self.events.BJetGood[pairs_sorted.slot1]).mass
+    def define_common_variables_after_presel(self, variation):
+        super().define_common_variables_after_presel(variation=variation)
+        # Compute the derived columns (e.g. minimum deltaR(b, b), deltaEta(b, b), deltaPhi(b, b) and the invariant mass
+        # of the b-jet pairs sorted by deltaR) used by the configuration
+        self.derived.materialize(self.derived_columns_after_presel)
 
     def do_parton_matching(self) -> ak.Array:
         # Selects quarks at LHE level
@@ -93,13 +86,9 @@ class ttbarPartonMatchingProcessor(ttHbbBaseProcessor):
 
         # Get the interpretation
         if self._sample == "TTbbSemiLeptonic":
-            prov = get_partons_provenance_ttbb4F(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+            prov = get_partons_provenance_ttbb4F(quarks.pdgId)
         elif self._sample == "TTToSemiLeptonic":
-            prov = get_partons_provenance_tt5F(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+            prov = get_partons_provenance_tt5F(quarks.pdgId)
         else:
             prov = -1 * ak.ones_like(quarks)
 
@@ -110,7 +99,7 @@ class ttbarPartonMatchingProcessor(ttHbbBaseProcessor):
         # The output is an awkward array with the shape of the second argument and None where there is no matching.
         # So, calling like this, we will get out an array of matched_quarks with the dimension of the JetGood.
         matched_quarks, matched_genjets, deltaR_matched = object_matching(
-            quarks, self.events.GenJetGood, dr_min=self.dr_min
+            quarks, self.events.GenJetGood, dr_min=self.dr_min, method=self.parton_matching_method
         )
 
         # Saving leptons and neutrino parton level
@@ -155,6 +144,30 @@ class ttbarPartonMatchingProcessor(ttHbbBaseProcessor):
         self.events["nBGenJetGoodExtra"] = ak.num(self.events.BGenJetGoodExtra)
         self.events["nCGenJetGoodExtra"] = ak.num(self.events.CGenJetGoodExtra)
 
+    def define_histograms(self):
+        # HistManager filling the categories defined by partitions from the events grouped by partition index
+        self.hists_manager = PartitionHistManager(
+            self.cfg.variables,
+            self._year,
+            self._sample,
+            self._hasSubsamples,
+            self._subsamples[self._sample].keys(),
+            self._categories,
+            variations_config=self.cfg.variations_config[self._sample] if self._isMC else None,
+            processor_params=self.params,
+            weights_manager=self.weights_manager,
+            calibrators_manager=self.calibrators_manager,
+            custom_axes=self.custom_axes,
+            isMC=self._isMC,
+        )
+
+    def define_categories(self, variation):
+        # The cut masks shared by the memoised selections are cached for the events of the current chunk and variation
+        get_cut_cache().reset(self.events)
+        super().define_categories(variation=variation)
+        # Number of cut evaluations done and saved by the memoised selections (see `MemoizedSelection`)
+        fill_cut_evaluations(self.output, self.events, self._dataset, variation)
+
     def count_objects(self, variation):
         super().count_objects(variation=variation)
         if self._isMC:
@@ -164,6 +177,9 @@ class ttbarPartonMatchingProcessor(ttHbbBaseProcessor):
             self.events["nLGenJetGood"] = ak.num(self.events.LGenJetGood)
 
     def process_extra_after_presel(self, variation) -> ak.Array:
+        # genTtbarId % 100 and class of the tt+jets events, read by the cuts of the subsamples and by the weights
+        if self._isMC and ("genTtbarId" in self.events.fields):
+            self.events[TTBAR_ID_FIELD], self.events[TTBAR_CLASS_FIELD] = compute_ttbar_id(self.events)
         if self._isMC & (self._sample in ["TTbbSemiLeptonic", "TTToSemiLeptonic"]):
             self.do_parton_matching()
             self.count_partons()
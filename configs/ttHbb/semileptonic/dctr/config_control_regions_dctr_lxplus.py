@@ -17,11 +17,14 @@ import configs.ttHbb.semileptonic.common.cuts.custom_cut_functions as custom_cut
 import configs.ttHbb.semileptonic.common.cuts.custom_cuts as custom_cuts
 from configs.ttHbb.semileptonic.common.cuts.custom_cut_functions import *
 from configs.ttHbb.semileptonic.common.cuts.custom_cuts import *
+from configs.ttHbb.semileptonic.common.cuts.partition_selection import PartitionSelection, BinnedAxis, CategoricalAxis
+from configs.ttHbb.semileptonic.common.workflows.ttbar_id import TTBAR_CLASSES, get_ttbar_class
 from configs.ttHbb.semileptonic.common.weights.custom_weights import SF_top_pt
 from params.axis_settings import axis_settings
 
 import os
 import json
+from itertools import product
 localdir = os.path.dirname(os.path.abspath(__file__))
 
 # Define SPANet model path for inference
@@ -50,16 +53,23 @@ parameters = defaults.merge_parameters_from_files(default_parameters,
                                                   update=True)
 
 categories_to_calibrate = ["semilep_calibrated", "ttlf0p60", "CR1", "CR2", "CR", "SR", "4jCR1", "4jCR2", "4jSR", "5jCR1", "5jCR2", "5jSR", "6jCR1", "6jCR2", "6jSR", ">=7jCR1", ">=7jCR2", ">=7jSR"]
-with open(parameters["dctr"]["weight_cuts"]["by_njet"]["file"]) as f:
-    w_cuts = json.load(f)
-
-# Set the limit of the last quantile for each key as inf
-for key in w_cuts.keys():
-    w_cuts[key][2][1] = float("inf")
-
 with open(parameters["dctr"]["weight_cuts"]["inclusive"]["file"]) as f:
     w_cuts_inclusive = json.load(f)["weight_cuts"]["quantile0p33"]
 
+# Mutually exclusive axes of the subsamples: class of the tt+jets events and DCTR region,
+# indexed by jet multiplicity and DCTR weight bin (see `get_dctr_region_index`)
+ttbar_axis = CategoricalAxis("ttbar", get_ttbar_class, dict(enumerate(TTBAR_CLASSES)))
+dctr_axis = CategoricalAxis("dctr", "dctr_output.index", {
+    index + 1: f"{njet}_DCTR_{wbin}" for index, (njet, wbin) in enumerate(product(["4j", "5j", "6j", ">=7j"], ["L", "M", "H"]))
+})
+
+# Mutually exclusive axes of the categories: jet multiplicity, SPANet ttlf score and SPANet tthbb score
+# (CR1: tthbb < tthbb_L, CR2: tthbb_L <= tthbb < tthbb_M, SR: tthbb >= tthbb_M)
+ttlf_label = f"ttlf0p{int(100*ttlf_wp)}"
+njet_axis = BinnedAxis("njet", "nJetGood", [4, 5, 6, 7, float("inf")], ["4j", "5j", "6j", ">=7j"])
+ttlf_axis = BinnedAxis("ttlf", "spanet_output.ttlf", [-float("inf"), ttlf_wp, float("inf")], [ttlf_label, "CR_ttlf"])
+tthbb_axis = BinnedAxis("tthbb", "spanet_output.tthbb_transformed", [0., tthbb_L, tthbb_M, float("inf")], ["CR1", "CR2", "SR"])
+
 cfg = Configurator(
     parameters = parameters,
     datasets = {
@@ -94,28 +104,23 @@ cfg = Configurator(
                 'DATA_SingleMuon' : [get_HLTsel(primaryDatasets=["SingleMuon"]),
                                      get_HLTsel(primaryDatasets=["SingleEle"], invert=True)]
             },
-            'TTbbSemiLeptonic' : {
-                'TTbbSemiLeptonic_tt+LF'   : [get_genTtbarId_100_eq(0)],
-                'TTbbSemiLeptonic_tt+C'    : [get_genTtbarId_100_eq([41, 42, 43, 44, 45, 46])],
-                'TTbbSemiLeptonic_tt+B'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56])],
-                'TTbbSemiLeptonic_tt+B_4j_DCTR_L'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(4, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=4"][0])],
-                'TTbbSemiLeptonic_tt+B_4j_DCTR_M'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(4, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=4"][1])],
-                'TTbbSemiLeptonic_tt+B_4j_DCTR_H'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(4, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=4"][2])],
-                'TTbbSemiLeptonic_tt+B_5j_DCTR_L'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(5, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=5"][0])],
-                'TTbbSemiLeptonic_tt+B_5j_DCTR_M'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(5, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=5"][1])],
-                'TTbbSemiLeptonic_tt+B_5j_DCTR_H'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(5, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=5"][2])],
-                'TTbbSemiLeptonic_tt+B_6j_DCTR_L'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(6, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=6"][0])],
-                'TTbbSemiLeptonic_tt+B_6j_DCTR_M'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(6, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=6"][1])],
-                'TTbbSemiLeptonic_tt+B_6j_DCTR_H'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_eq(6, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet=6"][2])],
-                'TTbbSemiLeptonic_tt+B_>=7j_DCTR_L'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][0])],
-                'TTbbSemiLeptonic_tt+B_>=7j_DCTR_M'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][1])],
-                'TTbbSemiLeptonic_tt+B_>=7j_DCTR_H'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][2])],
-            },
-            'TTToSemiLeptonic' : {
-                'TTToSemiLeptonic_tt+LF'   : [get_genTtbarId_100_eq(0)],
-                'TTToSemiLeptonic_tt+C'    : [get_genTtbarId_100_eq([41, 42, 43, 44, 45, 46])],
-                'TTToSemiLeptonic_tt+B'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56])],
-            },
+            'TTbbSemiLeptonic' : PartitionSelection(
+                axes=[ttbar_axis, dctr_axis],
+                categories={
+                    'TTbbSemiLeptonic_tt+LF' : {"ttbar": "tt+LF"},
+                    'TTbbSemiLeptonic_tt+C' : {"ttbar": "tt+C"},
+                    'TTbbSemiLeptonic_tt+B' : {"ttbar": "tt+B"},
+                    **{f'TTbbSemiLeptonic_tt+B_{region}' : {"ttbar": "tt+B", "dctr": region} for region in dctr_axis.labels},
+                }
+            ),
+            'TTToSemiLeptonic' : PartitionSelection(
+                axes=[ttbar_axis],
+                categories={
+                    'TTToSemiLeptonic_tt+LF' : {"ttbar": "tt+LF"},
+                    'TTToSemiLeptonic_tt+C' : {"ttbar": "tt+C"},
+                    'TTToSemiLeptonic_tt+B' : {"ttbar": "tt+B"},
+                }
+            ),
         }
     },
 
@@ -133,28 +138,20 @@ cfg = Configurator(
             get_HLTsel(primaryDatasets=["SingleEle", "SingleMuon"])],
     
     preselections = [semileptonic_presel],
-    categories = {
-        "semilep": [passthrough],
-        "semilep_calibrated": [passthrough],
-        "ttlf0p60": [get_ttlf_max(ttlf_wp)],
-        "CR_ttlf": [get_ttlf_min(ttlf_wp)],
-        "CR1": [get_ttlf_max(ttlf_wp), get_CR1(tthbb_L)],
-        "CR2": [get_ttlf_max(ttlf_wp), get_CR2(tthbb_L, tthbb_M)],
-        "CR": [get_ttlf_max(ttlf_wp), get_CR1(tthbb_M)],
-        "SR": [get_ttlf_max(ttlf_wp), get_SR(tthbb_M)],
-        "4jCR1": [get_ttlf_max(ttlf_wp), get_CR1(tthbb_L), get_nObj_eq(4, coll="JetGood")],
-        "4jCR2": [get_ttlf_max(ttlf_wp), get_CR2(tthbb_L, tthbb_M), get_nObj_eq(4, coll="JetGood")],
-        "4jSR": [get_ttlf_max(ttlf_wp), get_SR(tthbb_M), get_nObj_eq(4, coll="JetGood")],
-        "5jCR1": [get_ttlf_max(ttlf_wp), get_CR1(tthbb_L), get_nObj_eq(5, coll="JetGood")],
-        "5jCR2": [get_ttlf_max(ttlf_wp), get_CR2(tthbb_L, tthbb_M), get_nObj_eq(5, coll="JetGood")],
-        "5jSR": [get_ttlf_max(ttlf_wp), get_SR(tthbb_M), get_nObj_eq(5, coll="JetGood")],
-        "6jCR1": [get_ttlf_max(ttlf_wp), get_CR1(tthbb_L), get_nObj_eq(6, coll="JetGood")],
-        "6jCR2": [get_ttlf_max(ttlf_wp), get_CR2(tthbb_L, tthbb_M), get_nObj_eq(6, coll="JetGood")],
-        "6jSR": [get_ttlf_max(ttlf_wp), get_SR(tthbb_M), get_nObj_eq(6, coll="JetGood")],
-        ">=7jCR1": [get_ttlf_max(ttlf_wp), get_CR1(tthbb_L), get_nObj_min(7, coll="JetGood")],
-        ">=7jCR2": [get_ttlf_max(ttlf_wp), get_CR2(tthbb_L, tthbb_M), get_nObj_min(7, coll="JetGood")],
-        ">=7jSR": [get_ttlf_max(ttlf_wp), get_SR(tthbb_M), get_nObj_min(7, coll="JetGood")],
-    },
+    categories = PartitionSelection(
+        axes=[njet_axis, ttlf_axis, tthbb_axis],
+        categories={
+            "semilep": {},
+            "semilep_calibrated": {},
+            "ttlf0p60": {"ttlf": ttlf_label},
+            "CR1": {"ttlf": ttlf_label, "tthbb": "CR1"},
+            "CR2": {"ttlf": ttlf_label, "tthbb": "CR2"},
+            "CR": {"ttlf": ttlf_label, "tthbb": ["CR1", "CR2"]},
+            "SR": {"ttlf": ttlf_label, "tthbb": "SR"},
+            **{f"{njet}{region}": {"njet": njet, "ttlf": ttlf_label, "tthbb": region}
+               for njet in njet_axis.labels for region in tthbb_axis.labels},
+        }
+    ),
 
     weights_classes = common_weights + [SF_ele_trigger, SF_top_pt],
     weights= {
@@ -16,6 +16,7 @@ import custom_cuts
 import custom_weights
 from custom_cut_functions import *
 from custom_cuts import *
+from configs.ttHbb.semileptonic.common.cuts.cut_cache import MemoizedSelection
 from custom_weights import DCTRWeight
 from params.axis_settings import axis_settings
 import configs.ttHbb.semileptonic.common.params.quantile_transformer as quantile_transformer
@@ -91,14 +92,14 @@ cfg = Configurator(
                      ] #All the years
         },
         "subsamples": {
-            'DATA_SingleEle'  : {
+            'DATA_SingleEle'  : MemoizedSelection({
                 'DATA_SingleEle' : [get_HLTsel(primaryDatasets=["SingleEle"])]
-            },
-            'DATA_SingleMuon' : {
+            }),
+            'DATA_SingleMuon' : MemoizedSelection({
                 'DATA_SingleMuon' : [get_HLTsel(primaryDatasets=["SingleMuon"]),
                                      get_HLTsel(primaryDatasets=["SingleEle"], invert=True)]
-            },
-            'TTbbSemiLeptonic' : {
+            }),
+            'TTbbSemiLeptonic' : MemoizedSelection({
                 'TTbbSemiLeptonic_tt+LF'   : [get_genTtbarId_100_eq(0)],
                 'TTbbSemiLeptonic_tt+C'    : [get_genTtbarId_100_eq([41, 42, 43, 44, 45, 46])],
                 'TTbbSemiLeptonic_tt+B'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56])],
@@ -114,12 +115,12 @@ cfg = Configurator(
                 'TTbbSemiLeptonic_tt+B_>=7j_DCTR_L'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][0])],
                 'TTbbSemiLeptonic_tt+B_>=7j_DCTR_M'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][1])],
                 'TTbbSemiLeptonic_tt+B_>=7j_DCTR_H'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][2])],
-            },
-            'TTToSemiLeptonic' : {
+            }),
+            'TTToSemiLeptonic' : MemoizedSelection({
                 'TTToSemiLeptonic_tt+LF'   : [get_genTtbarId_100_eq(0)],
                 'TTToSemiLeptonic_tt+C'    : [get_genTtbarId_100_eq([41, 42, 43, 44, 45, 46])],
                 'TTToSemiLeptonic_tt+B'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56])],
-            },
+            }),
         }
     },
 
@@ -138,7 +139,7 @@ cfg = Configurator(
             get_HLTsel(primaryDatasets=["SingleEle", "SingleMuon"])],
     
     preselections = [semileptonic_presel],
-    categories = {
+    categories = MemoizedSelection({
         "semilep": [passthrough],
         #"semilep_calibrated": [passthrough],
         "ttlf0p60": [get_ttlf_max(ttlf_wp)],
@@ -159,7 +160,7 @@ cfg = Configurator(
         ">=7jCR1": [get_ttlf_max(ttlf_wp), get_CR1(tthbb_L), get_nObj_min(7, coll="JetGood")],
         ">=7jCR2": [get_ttlf_max(ttlf_wp), get_CR2(tthbb_L, tthbb_M), get_nObj_min(7, coll="JetGood")],
         ">=7jSR": [get_ttlf_max(ttlf_wp), get_SR(tthbb_M), get_nObj_min(7, coll="JetGood")],
-    },
+    }),
 
     weights_classes=[DCTRWeight],
     weights_classes = common_weights + [SF_ele_trigger],
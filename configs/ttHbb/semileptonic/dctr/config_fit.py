@@ -13,11 +13,13 @@ from configs.ttHbb.semileptonic.common.workflows.workflow_dctr import DCTRInfere
 from configs.ttHbb.semileptonic.common.executors import onnx_executor as onnx_executor
 import configs.ttHbb.semileptonic.common.params.quantile_transformer as quantile_transformer
 from configs.ttHbb.semileptonic.common.params.quantile_transformer import WeightedQuantileTransformer
+from configs.ttHbb.semileptonic.common.params.lookup_tables import load_weight_cuts
 
 import configs.ttHbb.semileptonic.common.cuts.custom_cut_functions as custom_cut_functions
 import configs.ttHbb.semileptonic.common.cuts.custom_cuts as custom_cuts
 from configs.ttHbb.semileptonic.common.cuts.custom_cut_functions import *
 from configs.ttHbb.semileptonic.common.cuts.custom_cuts import *
+from configs.ttHbb.semileptonic.common.cuts.cut_cache import MemoizedSelection
 from configs.ttHbb.semileptonic.common.weights.custom_weights import SF_top_pt, SF_LHE_pdf_weight
 from configs.ttHbb.semileptonic.common.weights.custom_btag_calib_total import SF_btag_withcalib_complete_ttsplit
 from params.axis_settings import axis_settings
@@ -68,12 +70,8 @@ print("samples_with_qcd_only: ", samples_with_qcd_only)
 
 assert len(set(samples_with_qcd_and_pdf) & set(samples_with_qcd_only)) == 0, f"Samples with QCD only and QCD+PDF overlap: {set(samples_with_qcd_and_pdf) & set(samples_with_qcd_only)}"
 
-with open(parameters["dctr"]["weight_cuts"]["by_njet"]["file"]) as f:
-    w_cuts = json.load(f)
-
-# Set the limit of the last quantile for each key as inf
-for key in w_cuts.keys():
-    w_cuts[key][2][1] = float("inf")
+# Weight cuts by jet multiplicity, with the limit of the last quantile for each key set as inf
+w_cuts = load_weight_cuts(parameters["dctr"]["weight_cuts"]["by_njet"]["file"])
 
 with open(parameters["dctr"]["weight_cuts"]["inclusive"]["file"]) as f:
     w_cuts_inclusive = json.load(f)["weight_cuts"]["quantile0p33"]
@@ -93,14 +91,14 @@ cfg = Configurator(
                      ] #All the years
         },
         "subsamples": {
-            'DATA_SingleEle'  : {
+            'DATA_SingleEle'  : MemoizedSelection({
                 'DATA_SingleEle' : [get_HLTsel(primaryDatasets=["SingleEle"])]
-            },
-            'DATA_SingleMuon' : {
+            }),
+            'DATA_SingleMuon' : MemoizedSelection({
                 'DATA_SingleMuon' : [get_HLTsel(primaryDatasets=["SingleMuon"]),
                                      get_HLTsel(primaryDatasets=["SingleEle"], invert=True)]
-            },
-            'TTbbSemiLeptonic' : {
+            }),
+            'TTbbSemiLeptonic' : MemoizedSelection({
                 'TTbbSemiLeptonic_tt+LF'   : [get_genTtbarId_100_eq(0)],
                 'TTbbSemiLeptonic_tt+C'    : [get_genTtbarId_100_eq([41, 42, 43, 44, 45, 46])],
                 'TTbbSemiLeptonic_tt+B'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56])],
@@ -116,12 +114,12 @@ cfg = Configurator(
                 'TTbbSemiLeptonic_tt+B_>=7j_DCTR_L'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][0])],
                 'TTbbSemiLeptonic_tt+B_>=7j_DCTR_M'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][1])],
                 'TTbbSemiLeptonic_tt+B_>=7j_DCTR_H'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56]), get_nObj_min(7, coll="JetGood"), get_w_dctr_interval(*w_cuts["njet>=7"][2])],
-            },
-            'TTToSemiLeptonic' : {
+            }),
+            'TTToSemiLeptonic' : MemoizedSelection({
                 #'TTToSemiLeptonic_tt+LF'   : [get_genTtbarId_100_eq(0)],
                 'TTToSemiLeptonic_tt+C'    : [get_genTtbarId_100_eq([41, 42, 43, 44, 45, 46])],
                 'TTToSemiLeptonic_tt+B'    : [get_genTtbarId_100_eq([51, 52, 53, 54, 55, 56])],
-            },
+            }),
         }
     },
 
@@ -139,14 +137,14 @@ cfg = Configurator(
             get_HLTsel(primaryDatasets=["SingleEle", "SingleMuon"])],
     
     preselections = [semileptonic_presel],
-    categories = {
+    categories = MemoizedSelection({
         "semilep": [passthrough],
         "CR_ttlf": [get_ttlf_min(ttlf_wp)],
         "CR_ttlf_0p60": [get_ttlf_min(0.6)],
         "CR_ttcc": [get_ttlf_max(ttlf_wp), get_CR(0, tthbb_L), get_ttcc_min(ttcc_wp)],
         "CR": [get_ttlf_max(ttlf_wp), get_CR(tthbb_L, tthbb_M)],
         "SR": [get_ttlf_max(ttlf_wp), get_SR(tthbb_M)]
-    },
+    }),
 
     weights_classes = common_weights + [SF_ele_trigger, SF_top_pt, SF_QCD_renorm_scale, SF_QCD_factor_scale, SF_LHE_pdf_weight, SF_btag_withcalib_complete_ttsplit],
     weights= {
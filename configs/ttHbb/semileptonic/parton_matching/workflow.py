@@ -3,11 +3,13 @@ import awkward as ak
 import numba
 
 from pocket_coffea.workflows.tthbb_base_processor import ttHbbBaseProcessor
-from pocket_coffea.lib.deltaR_matching import object_matching
+from configs.ttHbb.semileptonic.common.workflows.deltaR_matching import object_matching
 from pocket_coffea.lib.parton_provenance import *
+from configs.ttHbb.semileptonic.common.workflows.parton_provenance import get_partons_provenance_ttHbb, get_partons_provenance_ttbb4F, get_partons_provenance_tt5F
+from configs.ttHbb.semileptonic.common.workflows.genpart_index import GenPartIndexMixin
 
 
-class PartonMatchingProcessor(ttHbbBaseProcessor):
+class PartonMatchingProcessor(GenPartIndexMixin, ttHbbBaseProcessor):
     def __init__(self, cfg) -> None:
         super().__init__(cfg=cfg)
         self.dr_min = self.workflow_options["parton_jet_min_dR"]
@@ -22,13 +24,10 @@ class PartonMatchingProcessor(ttHbbBaseProcessor):
 
         # Select b-quarks at Gen level, coming from H->bb decay
         if self._sample == 'ttHTobb':
-            higgs = self.events.GenPart[
-                (self.events.GenPart.pdgId == 25)
-                & (self.events.GenPart.hasFlags(['fromHardProcess']))
-            ]
-            higgs = higgs[ak.num(higgs.childrenIdxG, axis=2) == 2]
+            # Daughters of the Higgs bosons from the hard process decaying to two particles,
+            # from the decay tree of the generator particles built once for the chunk
             higgs_partons = ak.with_field(
-                ak.flatten(higgs.children, axis=2), 25, "from_part"
+                self.genpart_index.hard_process_daughters(25, flags=['fromHardProcess'], ndaughters=2), 25, "from_part"
             )
             # DO NOT sort b-quarks by pt
             # if not we are not able to match them with the provenance
@@ -39,20 +38,14 @@ class PartonMatchingProcessor(ttHbbBaseProcessor):
 
         # Get the interpretation
         if self._sample == "ttHTobb":
-            prov = get_partons_provenance_ttHbb(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+            prov = get_partons_provenance_ttHbb(quarks.pdgId)
             self.events["HiggsParton"] = self.events.LHEPart[
                 self.events.LHEPart.pdgId == 25
             ]
         elif self._sample == "TTbbSemiLeptonic":
-            prov = get_partons_provenance_ttbb4F(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+            prov = get_partons_provenance_ttbb4F(quarks.pdgId)
         elif self._sample == "TTToSemiLeptonic":
-             prov = get_partons_provenance_tt5F(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+             prov = get_partons_provenance_tt5F(quarks.pdgId)
         else:
             prov = -1 * ak.ones_like(quarks)
 
@@ -1,109 +1,63 @@
 import sys
+import numpy as np
 import awkward as ak
 import numba
 
 from pocket_coffea.workflows.tthbb_base_processor import ttHbbBaseProcessor
-from pocket_coffea.lib.deltaR_matching import object_matching
-from pocket_coffea.lib.parton_provenance import *
+from configs.ttHbb.semileptonic.common.workflows.deltaR_matching import object_matching
+from configs.ttHbb.semileptonic.common.workflows.genpart_index import GenPartIndexMixin
+from configs.ttHbb.semileptonic.common.workflows.record_fields import with_fields
 
 
-class PartonMatchingProcessorWithFSR(ttHbbBaseProcessor):
+class PartonMatchingProcessorWithFSR(GenPartIndexMixin, ttHbbBaseProcessor):
     def __init__(self, cfg) -> None:
         super().__init__(cfg=cfg)
         self.dr_min = self.workflow_options["parton_jet_min_dR"]
         self.dr_min_postfsr = self.workflow_options.get("parton_jet_min_dR_postfsr", 1.)
+        # Trace the W decays and the FSR emissions with the events split across the numba threads
+        self.parallel_fsr_tracing = self.workflow_options.get("parallel_fsr_tracing", False)
 
     def do_parton_matching_ttHbb(self) -> ak.Array:
 
         genparts = self.events.GenPart
-        
-        children_idxG = ak.without_parameters(genparts.childrenIdxG, behavior={})
-        children_idxG_flat = ak.flatten(children_idxG, axis=1)
-        genparts_flat = ak.flatten(genparts)
-        genparts_offsets = np.concatenate([[0],np.cumsum(ak.to_numpy(ak.num(genparts, axis=1), allow_missing=True))])
-        local_index_all = ak.local_index(genparts, axis=1)
+        # Decay tree of the generator particles, built once for the chunk and queried by compiled traversals
+        index = self.genpart_index
+        genparts_flat = index.genparts_flat
 
         # Get the initial partons, first copy
-        initial = genparts.genPartIdxMother == 0
-        hard_process = (genparts.hasFlags(['fromHardProcess','isPrompt','isHardProcess', 'isFirstCopy'])) & (genparts.status !=21) # exclude incoming particles
-        genparts_hard = genparts[hard_process]
+        initial = index.genPartIdxMother == 0
+        hard_process = index.has_flags(['fromHardProcess','isPrompt','isHardProcess', 'isFirstCopy']) & (index.status != 21) # exclude incoming particles
 
-        
-        higgs = genparts_hard[genparts_hard.pdgId == 25]
-        top = genparts_hard[genparts_hard.pdgId == 6]
-        antitop = genparts_hard[genparts_hard.pdgId == -6]
+        higgs = index.select(hard_process & (index.pdgId == 25))
+        top = index.select(hard_process & (index.pdgId == 6))
+        antitop = index.select(hard_process & (index.pdgId == -6))
         
         # I want to take hardProcess, final state, BEFORE FSR particles, which have higgs, top, antitop as parents
         # These will become the hard particles 
-        from_higgs = genparts_hard.parent.pdgId == 25
-        from_top = genparts_hard.parent.pdgId == 6
-        from_antitop = genparts_hard.parent.pdgId == -6
-
-        genparts_initial = genparts[initial]
+        mother_pdgId = index.mother_pdgId
+        from_higgs = hard_process & (mother_pdgId == 25)
+        from_top = hard_process & (mother_pdgId == 6)
+        from_antitop = hard_process & (mother_pdgId == -6)
 
-        isr = genparts_initial[(genparts_initial.hasFlags(['fromHardProcess','isPrompt','isHardProcess'])) &
-                                  (genparts_initial.status == 23) & (genparts_initial.pdgId != 25)& (abs(genparts_initial.pdgId) != 6)]
-        has_isr = ak.num(isr)!=0
-        isr_idx = ak.flatten(ak.fill_none(ak.pad_none(local_index_all[initial][(genparts_initial.hasFlags(['fromHardProcess','isPrompt','isHardProcess'])) &
-                                  (genparts_initial.status == 23) & (genparts_initial.pdgId != 25)& (abs(genparts_initial.pdgId) != 6)], 1), 0))
+        isr = initial & index.has_flags(['fromHardProcess','isPrompt','isHardProcess']) & \
+            (index.status == 23) & (index.pdgId != 25) & (abs(index.pdgId) != 6)
+        # The first particle of the event is taken if there is no ISR
+        isr_idxG, _ = index.select_first(isr, 1)
+        isr_idxG = np.where(isr_idxG[:, 0] >= 0, isr_idxG[:, 0], index.offsets[:-1])
 
         ######
-        # Get the hard process particles
-        part_from_top = genparts_hard[from_top]
-        W_from_top = ak.flatten(part_from_top[part_from_top.pdgId ==24])
-        b_from_top = ak.flatten(part_from_top[part_from_top.pdgId ==5])
-        part_from_antitop = genparts_hard[from_antitop]
-        W_from_antitop = ak.flatten(part_from_antitop[part_from_antitop.pdgId == -24])
-        b_from_antitop = ak.flatten(part_from_antitop[part_from_antitop.pdgId == -5])
-
-        b_from_top_idx = ak.flatten(local_index_all[hard_process][from_top][part_from_top.pdgId ==5])
-        W_from_top_idx = ak.flatten(local_index_all[hard_process][from_top][part_from_top.pdgId == 24])
-        b_from_antitop_idx = ak.flatten(local_index_all[hard_process][from_antitop][part_from_antitop.pdgId == -5])
-        W_from_antitop_idx = ak.flatten(local_index_all[hard_process][from_antitop][part_from_antitop.pdgId == -24])
+        # Get the hard process particles, as global indices in the flat GenPart collection
+        b_from_top_idxG = index.select_exactly(from_top & (index.pdgId == 5), 1, "b-quarks from top")[:, 0]
+        W_from_top_idxG = index.select_exactly(from_top & (index.pdgId == 24), 1, "W from top")[:, 0]
+        b_from_antitop_idxG = index.select_exactly(from_antitop & (index.pdgId == -5), 1, "b-quarks from antitop")[:, 0]
+        W_from_antitop_idxG = index.select_exactly(from_antitop & (index.pdgId == -24), 1, "W from antitop")[:, 0]
 
         # This works because they are the firstCopy of the hard_process particles with higgs as parent. We are skipping all the decay chain of the higgs
-        b_from_higgs_idx = local_index_all[hard_process][from_higgs]
-        b_from_higgs = genparts_hard[from_higgs]
-
-        #--------------
-        # Converting local index to global index, already corrected with the offsets
-        b_from_top_idxG = ak.to_numpy(b_from_top_idx + genparts_offsets[:-1], allow_missing=False)
-        W_from_top_idxG = ak.to_numpy(W_from_top_idx + genparts_offsets[:-1], allow_missing=False)
-        b_from_antitop_idxG = ak.to_numpy(b_from_antitop_idx + genparts_offsets[:-1], allow_missing=False)
-        W_from_antitop_idxG = ak.to_numpy(W_from_antitop_idx + genparts_offsets[:-1], allow_missing=False)
-        isr_idxG = ak.to_numpy(isr_idx + genparts_offsets[:-1], allow_missing=False)
-        b_from_higgs_idxG = ak.to_numpy(b_from_higgs_idx + genparts_offsets[:-1], allow_missing=False)
-
-        # Some inputs needed for numba functions for indexing
-        
-        genparts_flat_eta = ak.without_parameters(genparts_flat.eta, behavior={})
-        genparts_flat_phi = ak.without_parameters(genparts_flat.phi, behavior={})
-        genparts_flat_pt = ak.without_parameters(genparts_flat.pt, behavior={})
-        genparts_flat_pdgId = ak.without_parameters(genparts_flat.pdgId, behavior={})
-        genparts_flat_statusFlags = ak.without_parameters(genparts_flat.statusFlags, behavior={})
-        
-        firstgenpart_idxG = ak.firsts(genparts[:,0].children).genPartIdxMotherG
-        firstgenpart_idxG_numpy = ak.to_numpy( firstgenpart_idxG, allow_missing=False)
-        local_ind = ak.to_numpy(ak.local_index(firstgenpart_idxG), allow_missing=False)
-        nevents = firstgenpart_idxG_numpy.shape[0]
+        b_from_higgs_idxG = index.select_exactly(from_higgs, 2, "partons from higgs")
 
         ### Analyze the W decay
-        W_from_top_islep, W_from_top_decay = analyze_W_flat( W_from_top_idxG, 
-                                                             children_idxG_flat,
-                                                             genparts_flat_statusFlags,
-                                                             genparts_flat_pdgId,
-                                                             firstgenpart_idxG_numpy,
-                                                             genparts_offsets,
-                                                             nevents)
-                                                            
-
-        W_from_antitop_islep, W_from_antitop_decay = analyze_W_flat( W_from_antitop_idxG, 
-                                                                     children_idxG_flat,
-                                                                     genparts_flat_statusFlags,
-                                                                     genparts_flat_pdgId,
-                                                                     firstgenpart_idxG_numpy,
-                                                                     genparts_offsets,
-                                                                     nevents)
+        W_from_top_islep, W_from_top_decay = index.W_decays(W_from_top_idxG)
+        W_from_antitop_islep, W_from_antitop_decay = index.W_decays(W_from_antitop_idxG)
         
         # assuming semilep only
         W_had_decay_idx = np.where(~W_from_top_islep[:,None],W_from_top_decay, W_from_antitop_decay )
@@ -118,16 +72,7 @@ class PartonMatchingProcessorWithFSR(ttHbbBaseProcessor):
                                         W_had_decay_idx,
                                         ], axis=1)
 
-        parton_decay_id = analyze_parton_decays_flat_nomesons(part_input_G,
-                                                              children_idxG_flat,
-                                                              genparts_flat_eta,
-                                                              genparts_flat_phi,
-                                                              genparts_flat_pt,
-                                                              genparts_flat_pdgId,
-                                                              self.dr_min_postfsr,
-                                                              firstgenpart_idxG_numpy,
-                                                              genparts_offsets,
-                                                              nevents)
+        parton_decay_id = index.hardest_emissions(part_input_G, self.dr_min_postfsr)
 
         
         b_from_top_lastcopy = genparts_flat[parton_decay_id[:,0]]
@@ -167,11 +112,9 @@ class PartonMatchingProcessorWithFSR(ttHbbBaseProcessor):
         )
 
         #Saving stuff
-        self.events["JetGoodMatched"] = ak.with_field(
-            matched_jets, deltaR_matched, "dRMatchedJet"
+        self.events["JetGoodMatched"] = with_fields(
+            matched_jets, {"dRMatchedJet": deltaR_matched, "provenance": matched_quarks.provenance}
         )
-        self.events["JetGoodMatched"] = ak.with_field(
-            self.events.JetGoodMatched, matched_quarks.provenance, "provenance")
         
         self.events["PartonInitial"] = quarks_initial
         self.events["PartonLastCopy"] = quarks_lastcopy
@@ -1,6 +1,7 @@
 import awkward as ak
 from pocket_coffea.workflows.tthbb_base_processor import ttHbbBaseProcessor
 from dask.distributed import get_worker
+from configs.ttHbb.semileptonic.common.workflows.ttbar_id import compute_ttbar_id, TTBAR_ID_FIELD, TTBAR_CLASS_FIELD
 
 import numpy as np
 
@@ -10,6 +11,9 @@ class TestDaskProcessor(ttHbbBaseProcessor):
 
 
     def process_extra_after_presel(self, variation) -> ak.Array:
+        # genTtbarId % 100 and class of the tt+jets events, read by the cuts of the subsamples and by the weights
+        if self._isMC and ("genTtbarId" in self.events.fields):
+            self.events[TTBAR_ID_FIELD], self.events[TTBAR_CLASS_FIELD] = compute_ttbar_id(self.events)
 
         try:
             worker = get_worker()
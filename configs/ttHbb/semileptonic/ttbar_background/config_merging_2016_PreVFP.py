@@ -4,6 +4,7 @@ from pocket_coffea.parameters.histograms import *
 from pocket_coffea.parameters.cuts import passthrough
 
 from configs.ttHbb.semileptonic.common.workflows.workflow_ttbar import ttbarPartonMatchingProcessor
+from configs.ttHbb.semileptonic.common.cuts.partition_selection import PartitionSelection, BinnedAxis, CategoricalAxis, get_lepton_flavour
 
 import custom_cut_functions
 import custom_cuts
@@ -23,22 +24,22 @@ defaults.register_configuration_dir("config_dir", localdir+"/params")
 exclude_data = ["DATA_SingleEle", "DATA_SingleMuon"]
 exclude_nonttbar = ["ttHTobb", "TTTo2L2Nu", "SingleTop", "WJetsToLNu_HT"] + exclude_data
 
-# Electron and muon categories
-ele_categories_dict = {
-    "SingleEle_>=4j==3b" : [ get_nElectron(1, coll="ElectronGood"), get_nObj_eq(3, coll="BJetGood") ],
-    "SingleEle_>=4j>=4b" : [ get_nElectron(1, coll="ElectronGood"), get_nBtagMin(4, coll="BJetGood") ],
-    "SingleEle_==4j>=4b" : [ get_nElectron(1, coll="ElectronGood"), get_nObj_eq(4, coll="JetGood"), get_nBtagMin(4, coll="BJetGood") ],
-    "SingleEle_==5j>=4b" : [ get_nElectron(1, coll="ElectronGood"), get_nObj_eq(5, coll="JetGood"), get_nBtagMin(4, coll="BJetGood") ],
-    "SingleEle_>=6j>=4b" : [ get_nElectron(1, coll="ElectronGood"), get_nObj_min(6, coll="JetGood"), get_nBtagMin(4, coll="BJetGood") ],
-}
+# Mutually exclusive axes of the categories: lepton flavour, jet multiplicity and b-jet multiplicity.
+# The lepton flavour relies on the semileptonic preselection (exactly one good lepton).
+lepton_axis = CategoricalAxis("lepton", get_lepton_flavour, {0: "SingleEle", 1: "SingleMuon"})
+njet_axis = BinnedAxis("njet", "nJetGood", [4, 5, 6, float("inf")], ["==4j", "==5j", ">=6j"])
+nbjet_axis = BinnedAxis("nbjet", "nBJetGood", [3, 4, float("inf")], ["==3b", ">=4b"])
 
-muon_categories_dict = {
-    "SingleMuon_>=4j==3b" : [ get_nMuon(1, coll="MuonGood"), get_nObj_eq(3, coll="BJetGood") ],
-    "SingleMuon_>=4j>=4b" : [ get_nMuon(1, coll="MuonGood"), get_nBtagMin(4, coll="BJetGood") ],
-    "SingleMuon_==4j>=4b" : [ get_nMuon(1, coll="MuonGood"), get_nObj_eq(4, coll="JetGood"), get_nBtagMin(4, coll="BJetGood") ],
-    "SingleMuon_==5j>=4b" : [ get_nMuon(1, coll="MuonGood"), get_nObj_eq(5, coll="JetGood"), get_nBtagMin(4, coll="BJetGood") ],
-    "SingleMuon_>=6j>=4b" : [ get_nMuon(1, coll="MuonGood"), get_nObj_min(6, coll="JetGood"), get_nBtagMin(4, coll="BJetGood") ],
+# Electron and muon categories, as unions of the bins of jet and b-jet multiplicity
+jet_categories_dict = {
+    ">=4j==3b" : {"nbjet": "==3b"},
+    ">=4j>=4b" : {"nbjet": ">=4b"},
+    "==4j>=4b" : {"njet": "==4j", "nbjet": ">=4b"},
+    "==5j>=4b" : {"njet": "==5j", "nbjet": ">=4b"},
+    ">=6j>=4b" : {"njet": ">=6j", "nbjet": ">=4b"},
 }
+ele_categories_dict = {f"SingleEle_{cat}" : {"lepton": "SingleEle", **bins} for cat, bins in jet_categories_dict.items()}
+muon_categories_dict = {f"SingleMuon_{cat}" : {"lepton": "SingleMuon", **bins} for cat, bins in jet_categories_dict.items()}
 
 ele_categories = list(ele_categories_dict.keys())
 muon_categories = list(muon_categories_dict.keys())
@@ -126,11 +127,14 @@ cfg = Configurator(
     skim = [get_nObj_min(4, 15., "Jet"),
             get_HLTsel(primaryDatasets=["SingleEle", "SingleMuon"])],
     preselections = [semileptonic_presel_nobtag],
-    categories = {
-        "baseline": [passthrough],
-        **muon_categories_dict,
-        **ele_categories_dict,
-    },
+    categories = PartitionSelection(
+        axes=[lepton_axis, njet_axis, nbjet_axis],
+        categories={
+            "baseline": {},
+            **muon_categories_dict,
+            **ele_categories_dict,
+        }
+    ),
 
     weights = {
         "common": {
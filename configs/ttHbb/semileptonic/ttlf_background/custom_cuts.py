@@ -2,6 +2,7 @@ from collections.abc import Iterable
 import awkward as ak
 import custom_cut_functions as cuts_f
 from pocket_coffea.lib.cut_definition import Cut
+from configs.ttHbb.semileptonic.common.workflows.ttbar_id import get_ttbar_id_lookup
 
 semileptonic_presel = Cut(
     name="semileptonic",
@@ -71,6 +72,8 @@ def get_genTtbarId_100_eq(genTtbarId, name=None):
             name = f"genTtbarId_100_eq_{genTtbarId}"
         if isinstance(genTtbarId, Iterable):
             name = f"genTtbarId_100_eq_" + "_".join([str(s) for s in genTtbarId])
+    # The IDs are checked when the cut is defined, the mask is read from the ttbar id column of the events
+    get_ttbar_id_lookup([genTtbarId] if type(genTtbarId) == int else genTtbarId)
     return Cut(name=name, params={"genTtbarId" : genTtbarId}, function=cuts_f.eq_genTtbarId_100)
 
 def get_SR(tthbb_transformed_wp, name=None):
@@ -1,25 +1,22 @@
-from pocket_coffea.lib.weights.weights import WeightLambda, WeightWrapper, WeightData, WeightDataMultiVariation
+from pocket_coffea.lib.weights.weights import WeightWrapper, WeightData, WeightDataMultiVariation
 import numpy as np
 import awkward as ak
-import correctionlib
+from configs.ttHbb.semileptonic.common.weights.correction_cache import get_correction
+from configs.ttHbb.semileptonic.common.weights.weight_cache import ShapeInvariantWeight, cache_shape_invariant
+from configs.ttHbb.semileptonic.common.workflows.genpart_index import SAMPLES_TOP
 
-samples_top = ["TTbbSemiLeptonic", "TTToSemiLeptonic", "TTTo2L2Nu"]
+samples_top = SAMPLES_TOP
 
-SF_top_pt = WeightLambda.wrap_func(
-    name="sf_top_pt",
-    function=lambda params, metadata, events, size, shape_variations:
-            get_sf_top_pt(events, metadata),
-    has_variations=False
-    )
 
 def get_sf_top_pt(events, metadata):
+    '''Top pT reweighting from the pT of the last copy of the top and anti-top quarks (`top_pt`, `antitop_pt`),
+    computed by the processor from its GenPart index (see `GenPartIndexMixin.compute_top_pt`).'''
     if metadata["sample"] in samples_top:
         #print("Computing top pt reweighting for sample: ", metadata["sample"])
-        part = events.GenPart
-        part = part[~ak.is_none(part.parent, axis=1)]
-        part = part[part.hasFlags("isLastCopy")]
-        part = part[abs(part.pdgId) == 6]
-        part = part[ak.argsort(part.pdgId, ascending=False)]
+        if ("top_pt" not in events.fields) or ("antitop_pt" not in events.fields):
+            raise KeyError(f"The top pT reweighting requires the columns `top_pt` and `antitop_pt`, not computed by the workflow for sample {metadata['sample']}.")
+        top_pt = ak.to_numpy(events.top_pt)
+        antitop_pt = ak.to_numpy(events.antitop_pt)
 
         arg = {
             "a": 0.103,
@@ -27,32 +24,37 @@ def get_sf_top_pt(events, metadata):
             "c": -0.000134,
             "d": 0.973
         }
-        top_weight = arg["a"] * np.exp(arg["b"] * part.pt[:,0]) + arg["c"] * part.pt[:,0] + arg["d"]
-        antitop_weight = arg["a"] * np.exp(arg["b"] * part.pt[:,1]) + arg["c"] * part.pt[:,1] + arg["d"]
-        weight = np.sqrt(ak.prod([top_weight, antitop_weight], axis=0))
-        # for i in range(10):
-            # print("Top pt: {},   Top SF: {},   AntiTop pt :  {},   AntiTop SF: {}".format(part.pt[i,0], top_weight[i], part.pt[i,1], antitop_weight[i]))
-        return weight#, np.zeros(np.shape(weight)), ak.copy(weight)
+        top_weight = arg["a"] * np.exp(arg["b"] * top_pt) + arg["c"] * top_pt + arg["d"]
+        antitop_weight = arg["a"] * np.exp(arg["b"] * antitop_pt) + arg["c"] * antitop_pt + arg["d"]
+        weight = np.sqrt(top_weight * antitop_weight)
+        return weight
     else:
         return np.ones(len(events), dtype=np.float64)
 
+class SF_top_pt(ShapeInvariantWeight, WeightWrapper):
+    '''Top pT reweighting of the tt samples. It is a generator-level weight:
+    it is computed for the nominal shape variation and reused for the other shape variations.'''
+    name = "sf_top_pt"
+    has_variations = False
+
+    @cache_shape_invariant
+    def compute(self, events, size, shape_variation):
+        return WeightData(
+            name = self.name,
+            nominal = get_sf_top_pt(events, self._metadata)
+        )
+
 def sf_ttlf_calib(params, sample, year, njets, jetsHt):
     '''Correction to tt+LF background computed by correcting tt+LF to data minus the other backgrounds in 2D:
     njets-JetsHT bins. Each year has a different correction stored in the correctionlib format.'''
-    cset = correctionlib.CorrectionSet.from_file(
-        params.ttlf_calibration[year]["file"]
-    )
-    corr = cset[params.ttlf_calibration[year]["name"]]
+    corr = get_correction(params.ttlf_calibration[year]["file"], params.ttlf_calibration[year]["name"])
     w = corr.evaluate(ak.to_numpy(njets), ak.to_numpy(jetsHt))
     return w
 
 def sf_ttlf_calib_with_ttcc_variations(params, sample, year, njets, jetsHt, variations):
     '''Correction to tt+LF background computed by correcting tt+LF to data minus the other backgrounds in 2D:
     njets-JetsHT bins. Each year has a different correction stored in the correctionlib format.'''
-    cset = correctionlib.CorrectionSet.from_file(
-        params.ttlf_calibration[year]["file"]
-    )
-    corr = cset[params.ttlf_calibration[year]["name"]]
+    corr = get_correction(params.ttlf_calibration[year]["file"], params.ttlf_calibration[year]["name"])
     output = {}
     for variation in variations:
         if variation == 'nominal':
@@ -66,7 +68,7 @@ def sf_ttlf_calib_with_ttcc_variations(params, sample, year, njets, jetsHt, vari
             ]
     return output
 
-class SF_ttlf_calib(WeightWrapper):
+class SF_ttlf_calib(ShapeInvariantWeight, WeightWrapper):
     name = "sf_ttlf_calib"
     has_variations = False
 
@@ -74,6 +76,11 @@ class SF_ttlf_calib(WeightWrapper):
         super().__init__(params, metadata)
         self.jet_coll = "JetGood"
 
+    def cache_inputs(self, events):
+        # The correction depends on the shape variation only through the number of jets and HT
+        return [events[f"n{self.jet_coll}"], ak.sum(events[self.jet_coll].pt, axis=1)]
+
+    @cache_shape_invariant
     def compute(self, events, size, shape_variation):
         jetsHt = ak.sum(events[self.jet_coll].pt, axis=1)
         out = sf_ttlf_calib(self._params,
@@ -88,7 +95,7 @@ class SF_ttlf_calib(WeightWrapper):
             nominal = out["nominal"][0]
             )
 
-class SF_ttlf_calib_with_ttcc_variations(WeightWrapper):
+class SF_ttlf_calib_with_ttcc_variations(ShapeInvariantWeight, WeightWrapper):
     name = "sf_ttlf_calib_with_ttcc_variations"
     has_variations = True
 
@@ -97,6 +104,11 @@ class SF_ttlf_calib_with_ttcc_variations(WeightWrapper):
         self.jet_coll = "JetGood"
         self._variations = params.systematic_variations.weight_variations.ttlf_calibration[metadata["year"]]
 
+    def cache_inputs(self, events):
+        # The correction depends on the shape variation only through the number of jets and HT
+        return [events[f"n{self.jet_coll}"], ak.sum(events[self.jet_coll].pt, axis=1)]
+
+    @cache_shape_invariant
     def compute(self, events, size, shape_variation):
         jetsHt = ak.sum(events[self.jet_coll].pt, axis=1)
         if shape_variation == "nominal":
@@ -1,12 +1,15 @@
 import awkward as ak
 from pocket_coffea.workflows.tthbb_base_processor import ttHbbBaseProcessor
 from pocket_coffea.lib.objects import btagging
-from pocket_coffea.lib.deltaR_matching import metric_eta, metric_phi
-from pocket_coffea.lib.deltaR_matching import object_matching
-from pocket_coffea.lib.parton_provenance import get_partons_provenance_ttHbb, get_partons_provenance_ttbb4F, get_partons_provenance_tt5F
+from configs.ttHbb.semileptonic.common.workflows.deltaR_matching import object_matching
+from configs.ttHbb.semileptonic.common.workflows.parton_provenance import get_partons_provenance_ttHbb, get_partons_provenance_ttbb4F, get_partons_provenance_tt5F
+from configs.ttHbb.semileptonic.common.workflows.bjet_pairs import compute_bjet_pair_observables
+from configs.ttHbb.semileptonic.common.workflows.record_fields import with_fields, get_working_point_labels
+from configs.ttHbb.semileptonic.common.workflows.genpart_index import GenPartIndexMixin
+from configs.ttHbb.semileptonic.common.workflows.ttbar_id import compute_ttbar_id, TTBAR_ID_FIELD, TTBAR_CLASS_FIELD
 from custom_weights import get_sf_top_pt
 
-class ttbarBackgroundProcessor(ttHbbBaseProcessor):
+class ttbarBackgroundProcessor(GenPartIndexMixin, ttHbbBaseProcessor):
     def __init__(self, cfg) -> None:
         super().__init__(cfg=cfg)
         self.dr_min = self.workflow_options["parton_jet_min_dR"]
@@ -48,62 +51,24 @@ class ttbarBackgroundProcessor(ttHbbBaseProcessor):
             "is_electron"
         )
 
-        # Compute deltaR(b, b) of all possible b-jet pairs.
-        # We require deltaR > 0 to exclude the deltaR between the jets with themselves
-        deltaR = ak.flatten(self.events["BJetGood"].metric_table(self.events["BJetGood"]), axis=2)
-        deltaEta = ak.flatten(self.events["BJetGood"].metric_table(self.events["BJetGood"], metric=metric_eta), axis=2)
-        deltaPhi = ak.flatten(self.events["BJetGood"].metric_table(self.events["BJetGood"], metric=metric_phi), axis=2)
-        deltaR = deltaR[deltaR > 0.]
-        deltaEta = deltaEta[deltaEta > 0.]
-        deltaPhi = deltaPhi[deltaPhi > 0.]
-
-        # Get the deltaR with no possibility of repetition of identical b-jet pairs
-
-        # Get all the possible combinations of b-jet pairs
-        pairs = ak.argcombinations(self.events["BJetGood"], 2, axis=1)
-        b1 = self.events.BJetGood[pairs.slot0]
-        b2 = self.events.BJetGood[pairs.slot1]
-
-        # Compute deltaR between the pairs
-        deltaR_unique = b1.delta_r(b2)
-        idx_pairs_sorted = ak.argsort(deltaR_unique, axis=1)
-        pairs_sorted = pairs[idx_pairs_sorted]
-
-        # Compute the minimum deltaR(b, b), deltaEta(b, b), deltaPhi(b, b)
-        self.events["deltaRbb_min"] = ak.min(deltaR, axis=1)
-        self.events["deltaEtabb_min"] = ak.min(deltaEta, axis=1)
-        self.events["deltaPhibb_min"] = ak.min(deltaPhi, axis=1)
-
-        # Compute the invariant mass of the closest b-jet pair, the minimum and maximum invariant mass of all b-jet pairs
-        mbb = (self.events.BJetGood[pairs_sorted.slot0] + self.events.BJetGood[pairs_sorted.slot1]).mass
-        ptbb = (self.events.BJetGood[pairs_sorted.slot0] + self.events.BJetGood[pairs_sorted.slot1]).pt
-        htbb = self.events.BJetGood[pairs_sorted.slot0].pt + self.events.BJetGood[pairs_sorted.slot1].pt
-        self.events["mbb_closest"] = mbb[:,0]
-        self.events["mbb_min"] = ak.min(mbb, axis=1)
-        self.events["mbb_max"] = ak.max(mbb, axis=1)
-        self.events["deltaRbb_avg"] = ak.mean(deltaR_unique, axis=1)
-        self.events["ptbb_closest"] = ptbb[:,0]
-        self.events["htbb_closest"] = htbb[:,0]
+        # Compute the observables of the b-jet pairs with a single compiled loop over the unique b-jet pairs:
+        # minimum deltaR(b, b), deltaEta(b, b), deltaPhi(b, b), average deltaR(b, b),
+        # invariant mass, pT and HT of the closest b-jet pair, minimum and maximum invariant mass of all b-jet pairs
+        for name, value in compute_bjet_pair_observables(self.events["BJetGood"]).items():
+            self.events[name] = value
 
         # Save top and anti-top pT
         samples_top = self.workflow_options["samples_top"]
         if self._isMC & (self._sample in samples_top):
-            mask_tops = ~ak.is_none(self.events.GenPart.parent, axis=1) & self.events.GenPart.hasFlags("isLastCopy") & (abs(self.events.GenPart.pdgId) == 6)
-            part = self.events.GenPart[mask_tops]
-            assert all(ak.num(part.pt, axis=1) == 2), f"There should be exactly 2 tops in the event. Please check the mask to select the top and anti-top GenParticles. Sample: {self._sample}"
-            top = part[part.pdgId == 6][:,0]
-            antitop = part[part.pdgId == -6][:,0]
-            self.events["top_pt"] = top.pt
-            self.events["antitop_pt"] = antitop.pt
+            # From the decay tree of the generator particles, built once for the chunk and shared with the parton matching
+            ntops = self.compute_top_pt()
+            assert all(ntops == 2), f"There should be exactly 2 tops in the event. Please check the mask to select the top and anti-top GenParticles. Sample: {self._sample}"
             self.events["sf_top_pt"] = get_sf_top_pt(self.events, self.events.metadata)
 
         # Define labels for btagged jets at different working points
-        for wp, val in self.params.btagging.working_point[self._year]["btagging_WP"].items():
-            self.events["JetGood"] = ak.with_field(
-                self.events.JetGood,
-                ak.values_astype(self.events.JetGood[self.params.btagging.working_point[self._year]["btagging_algorithm"]] > val, int),
-                f"btag_{wp}"
-            )
+        btagging_wp = self.params.btagging.working_point[self._year]
+        labels = get_working_point_labels(self.events.JetGood[btagging_wp["btagging_algorithm"]], btagging_wp["btagging_WP"])
+        self.events["JetGood"] = with_fields(self.events.JetGood, {f"btag_{wp}": value for wp, value in labels.items()})
 
     def do_parton_matching(self) -> ak.Array:
         # Selects quarks at LHE level
@@ -113,13 +78,10 @@ class ttbarBackgroundProcessor(ttHbbBaseProcessor):
 
         # Select b-quarks at Gen level, coming from H->bb decay
         if self._sample in ['ttHTobb', 'ttHTobb_ttToSemiLep']:
-            higgs = self.events.GenPart[
-                (self.events.GenPart.pdgId == 25)
-                & (self.events.GenPart.hasFlags(['fromHardProcess']))
-            ]
-            higgs = higgs[ak.num(higgs.childrenIdxG, axis=2) == 2]
+            # Daughters of the Higgs bosons from the hard process decaying to two particles,
+            # from the decay tree of the generator particles built once for the chunk
             higgs_partons = ak.with_field(
-                ak.flatten(higgs.children, axis=2), 25, "from_part"
+                self.genpart_index.hard_process_daughters(25, flags=['fromHardProcess'], ndaughters=2), 25, "from_part"
             )
             # DO NOT sort b-quarks by pt
             # if not we are not able to match them with the provenance
@@ -130,20 +92,14 @@ class ttbarBackgroundProcessor(ttHbbBaseProcessor):
 
         # Get the interpretation
         if self._sample in ['ttHTobb', 'ttHTobb_ttToSemiLep']:
-            prov = get_partons_provenance_ttHbb(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+            prov = get_partons_provenance_ttHbb(quarks.pdgId)
             self.events["HiggsParton"] = self.events.LHEPart[
                 self.events.LHEPart.pdgId == 25
             ]
         elif self._sample == "TTbbSemiLeptonic":
-            prov = get_partons_provenance_ttbb4F(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+            prov = get_partons_provenance_ttbb4F(quarks.pdgId)
         elif self._sample == "TTToSemiLeptonic":
-            prov = get_partons_provenance_tt5F(
-                ak.Array(quarks.pdgId, behavior={}), ak.ArrayBuilder()
-            ).snapshot()
+            prov = get_partons_provenance_tt5F(quarks.pdgId)
         else:
             prov = -1 * ak.ones_like(quarks)
 
@@ -180,6 +136,9 @@ class ttbarBackgroundProcessor(ttHbbBaseProcessor):
         )  # use count since we have None
 
     def process_extra_after_presel(self, variation) -> ak.Array:
+        # genTtbarId % 100 and class of the tt+jets events, read by the cuts of the subsamples and by the weights
+        if self._isMC and ("genTtbarId" in self.events.fields):
+            self.events[TTBAR_ID_FIELD], self.events[TTBAR_CLASS_FIELD] = compute_ttbar_id(self.events)
         if self._isMC & (self._sample in ["ttHTobb", "ttHTobb_ttToSemiLep", "TTbbSemiLeptonic", "TTToSemiLeptonic"]):
             self.do_parton_matching()
             self.count_partons()